@@ -0,0 +1,31 @@
+"""Opaque keyset cursors shared by the Django API and the FastAPI gateway.
+
+A cursor holds the sort key of the last row on a page, e.g.
+``(departure_time, id)``, JSON-encoded and base64'd so clients treat it as an
+opaque token. The next page is everything strictly after that key.
+"""
+import base64
+import json
+from datetime import datetime
+
+
+def encode(values):
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode(cursor, size):
+    """Return the key values stored in ``cursor``, or None for an empty cursor.
+
+    Raises ValueError if the cursor is malformed or holds the wrong number of values.
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError('Invalid cursor')
+    return values
@@ -0,0 +1,259 @@
+"""Request, query and latency metrics shared by the Django API and the FastAPI gateway.
+
+A small in-process registry of counters and histograms rendered in the
+Prometheus text format (``Registry.render``), so neither service needs a
+client library. Each service keeps one registry, records every request
+through ``RequestMetrics`` from its middleware and serves the result on
+``/metrics``.
+
+Database time is attributed to the request that spent it: the middleware
+opens a ``RequestStats`` with ``track`` and the services' query hooks call
+``QueryLog.record``, which adds to the stats of the current context.
+``sync_to_async`` and ``asyncio.to_thread`` copy the context into their
+worker threads, so queries run there are counted too. Queries slower than
+``QueryLog.threshold_ms`` are kept, with the project frames of the stack
+that ran them, in a short ring buffer.
+
+Recording costs a lock and a bisect per observation; stacks are only taken
+for slow queries.
+"""
+import bisect
+import math
+import os
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Seconds; the upper bounds of each histogram bucket (+Inf is implied).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UNMATCHED = 'unmatched'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def lines(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}{_labels(self.labels, labels)} {_number(value)}'
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket..., count above the last bucket, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, *labels):
+        counts = self._values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    def lines(self):
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = _labels(self.labels, labels, [('le', _number(bound))])
+                yield f'{self.name}_bucket{le} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labels, labels)} {_number(counts[-1])}'
+            yield f'{self.name}_count{_labels(self.labels, labels)} {cumulative}'
+
+
+class Registry:
+    """Named metrics plus collectors read at scrape time.
+
+    A collector is a callable returning ``(name, kind, help, value)`` tuples,
+    for numbers a component already keeps (pool sizes, websocket counters).
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def collect(self, collector):
+        self._collectors.append(collector)
+        return collector
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.lines())
+        for collector in self._collectors:
+            for name, kind, help, value in collector():
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {kind}')
+                lines.append(f'{name} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class RequestStats:
+    """Queries and DB time spent on behalf of one request."""
+
+    __slots__ = ('label', 'queries', 'db_seconds')
+
+    def __init__(self, label):
+        self.label = label
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+_current = ContextVar('carpool_request_stats', default=None)
+
+
+@contextmanager
+def track(label):
+    """Count the queries run in this context (see ``QueryLog.record``) into a new ``RequestStats``."""
+    stats = RequestStats(label)
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+class QueryLog:
+    """Adds each query to the current ``RequestStats`` and samples the slow ones."""
+
+    def __init__(self, threshold_ms=100, size=50, root=PROJECT_ROOT, stack_depth=8, ignore=()):
+        self.threshold_ms = threshold_ms
+        self.root = root
+        # Files whose frames say nothing about the caller, e.g. the query hook itself.
+        self.ignore = {__file__, *ignore}
+        self.stack_depth = stack_depth
+        self.slow_total = 0
+        self._samples = deque(maxlen=size)
+
+    def record(self, sql, seconds):
+        stats = _current.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += seconds
+        if self.threshold_ms is not None and seconds * 1000 >= self.threshold_ms:
+            self.slow_total += 1
+            self._samples.append({
+                'at': time.time(),
+                'duration_ms': round(seconds * 1000, 2),
+                'request': stats.label if stats is not None else None,
+                'sql': sql[:2000],
+                'stack': self._stack(),
+            })
+
+    def _stack(self):
+        """Project frames that led to the query, innermost last, without this module or dependencies."""
+        frames = []
+        for frame in traceback.extract_stack()[:-2]:
+            filename = frame.filename
+            if (filename.startswith(self.root) and 'site-packages' not in filename
+                    and filename not in self.ignore):
+                frames.append(f'{os.path.relpath(filename, self.root)}:{frame.lineno} in {frame.name}')
+        return frames[-self.stack_depth:]
+
+    def samples(self):
+        """Slow queries, most recent first."""
+        return list(reversed(self._samples))
+
+
+class RequestMetrics:
+    """The per-route request metrics both services export."""
+
+    def __init__(self, registry, queries):
+        self.queries = queries
+        self.requests = registry.counter(
+            'carpool_http_requests_total', 'Requests handled, by route, method and status.',
+            ('route', 'method', 'status'))
+        self.latency = registry.histogram(
+            'carpool_http_request_duration_seconds', 'Time to produce a response, by route.',
+            ('route', 'method'))
+        self.response_size = registry.histogram(
+            'carpool_http_response_size_bytes', 'Response body size, by route.',
+            ('route',), SIZE_BUCKETS)
+        self.db_queries = registry.histogram(
+            'carpool_db_queries_per_request', 'Database queries run for one request, by route.',
+            ('route',), QUERY_COUNT_BUCKETS)
+        self.db_time = registry.histogram(
+            'carpool_db_time_per_request_seconds', 'Time spent in database queries for one request, by route.',
+            ('route',))
+        registry.collect(lambda: [(
+            'carpool_db_slow_queries_total', 'counter',
+            'Queries slower than the slow-query threshold.', queries.slow_total,
+        )])
+
+    def observe(self, route, method, status, seconds, size, stats):
+        self.requests.inc(route, method, str(status))
+        self.latency.observe(seconds, route, method)
+        if size is not None:
+            self.response_size.observe(size, route)
+        self.db_queries.observe(stats.queries, route)
+        self.db_time.observe(stats.db_seconds, route)
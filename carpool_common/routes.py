@@ -0,0 +1,191 @@
+"""Route matching shared by the Django API and the FastAPI gateway.
+
+A geocoded ride has a route: origin, optional waypoints, destination, joined
+by straight segments. A rider's trip matches a ride when the route passes
+within ``radius`` meters of the pickup and, further along, of the drop-off.
+
+Every route is rasterized onto a grid of ``CELL_DEGREES`` cells, stored as
+``core_routecell`` rows. Each row records how far along the route (in meters)
+the ride enters and leaves that cell, plus a copy of the ride's departure time
+so one ``(cell, departure_time)`` index serves both the place and the window.
+``candidates_sql`` prunes rides with those rows, and ``match`` runs the exact
+distance and order check on the few that are left.
+
+Like ``carpool_common.search``, SQL comes back as ``(sql, params)`` pairs.
+"""
+import json
+import math
+
+RIDE_TABLE = 'core_ride'
+CELL_TABLE = 'core_routecell'
+COLUMNS = ('origin_lat', 'origin_lon', 'destination_lat', 'destination_lon', 'waypoints')
+# Ride columns copied into or derived as core_routecell rows.
+INDEXED_COLUMNS = COLUMNS + ('departure_time',)
+# ~5.5 km of latitude per cell: a 100 km corridor is about 20 rows per ride.
+CELL_DEGREES = 0.05
+MAX_WAYPOINTS = 25
+DEFAULT_RADIUS_M = 2000
+MAX_RADIUS_M = 50_000
+EARTH_RADIUS_M = 6_371_000
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+
+def distance_m(lat1, lon1, lat2, lon2):
+    """Great-circle (haversine) distance in meters."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def parse_point(value):
+    """``(lat, lon)`` from ``"6.52,3.38"``; raises ValueError if malformed or out of range."""
+    try:
+        lat, lon = (float(part) for part in value.split(','))
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError('Expected "lat,lon".')
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError('Coordinates out of range.')
+    return lat, lon
+
+
+def route_points(origin_lat, origin_lon, destination_lat, destination_lon, waypoints):
+    """The route as ``[(lat, lon), ...]``, or None if either endpoint isn't geocoded.
+
+    ``waypoints`` is a list of ``[lat, lon]`` pairs, or its JSON text as
+    stored by SQLite.
+    """
+    if None in (origin_lat, origin_lon, destination_lat, destination_lon):
+        return None
+    if isinstance(waypoints, str):
+        waypoints = json.loads(waypoints)
+    return [(origin_lat, origin_lon), *(tuple(point) for point in waypoints or ()), (destination_lat, destination_lon)]
+
+
+def cell_key(cell_lat, cell_lon):
+    """One integer per grid cell, so a set of cells is a plain ``IN`` list.
+
+    Unique as long as ``CELL_DEGREES`` is at least 0.004 (under 50 000 cells per row).
+    """
+    return cell_lat * 100_000 + cell_lon
+
+
+def _segment_cells(start, end, cell_degrees):
+    """``(cell, t_enter, t_exit)`` for every grid cell the segment crosses, in order (t in 0..1)."""
+    x0, y0 = start[0] / cell_degrees, start[1] / cell_degrees
+    x1, y1 = end[0] / cell_degrees, end[1] / cell_degrees
+    i, j = math.floor(x0), math.floor(y0)
+    steps = abs(math.floor(x1) - i) + abs(math.floor(y1) - j)
+    dx, dy = x1 - x0, y1 - y0
+    step_i, step_j = (1 if dx > 0 else -1), (1 if dy > 0 else -1)
+    # Grid traversal (Amanatides & Woo): t at which the segment crosses the next row/column boundary.
+    next_i = ((i + (step_i > 0)) - x0) / dx if dx else math.inf
+    next_j = ((j + (step_j > 0)) - y0) / dy if dy else math.inf
+    delta_i = abs(1 / dx) if dx else math.inf
+    delta_j = abs(1 / dy) if dy else math.inf
+    t = 0.0
+    for _ in range(steps):
+        if next_i < next_j:
+            crossing, next_i = next_i, next_i + delta_i
+            yield (i, j), t, crossing
+            i += step_i
+        else:
+            crossing, next_j = next_j, next_j + delta_j
+            yield (i, j), t, crossing
+            j += step_j
+        t = crossing
+    yield (i, j), t, 1.0
+
+
+def route_cells(points, cell_degrees=CELL_DEGREES):
+    """``[(cell_key, enter_m, exit_m)]`` for every cell the route crosses.
+
+    ``enter_m``/``exit_m`` are the first and last distance along the route
+    at which it is inside the cell.
+    """
+    cells = {}
+    offset = 0.0
+    for start, end in zip(points, points[1:]):
+        length = distance_m(*start, *end)
+        for cell, t_enter, t_exit in _segment_cells(start, end, cell_degrees):
+            enter, exit_ = offset + t_enter * length, offset + t_exit * length
+            if cell in cells:
+                enter, exit_ = min(enter, cells[cell][0]), max(exit_, cells[cell][1])
+            cells[cell] = (enter, exit_)
+        offset += length
+    return [(cell_key(*cell), enter, exit_) for cell, (enter, exit_) in cells.items()]
+
+
+def covering_cells(lat, lon, radius_m, cell_degrees=CELL_DEGREES):
+    """Keys of the cells overlapping the box around a circle."""
+    # A little slack for the difference between the box's flat-earth size and haversine distances.
+    radius_m *= 1.01
+    dlat = radius_m / METERS_PER_DEGREE
+    dlon = radius_m / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+    return [
+        cell_key(i, j)
+        for i in range(math.floor((lat - dlat) / cell_degrees), math.floor((lat + dlat) / cell_degrees) + 1)
+        for j in range(math.floor((lon - dlon) / cell_degrees), math.floor((lon + dlon) / cell_degrees) + 1)
+    ]
+
+
+def candidates_sql(pickup, dropoff, radius_m, after=None, before=None, placeholder='%s'):
+    """WHERE condition on ``core_ride`` for rides that may pass ``pickup`` and then ``dropoff``.
+
+    A superset of the matches: confirm each candidate with ``match``.
+    ``after``/``before`` bound the departure time; pass them already adapted
+    for the database, like any other query parameter.
+    """
+    p = placeholder
+    pickup_cells = covering_cells(*pickup, radius_m)
+    dropoff_cells = covering_cells(*dropoff, radius_m)
+    where = [f"p.cell IN ({', '.join([p] * len(pickup_cells))})"]
+    params = list(pickup_cells)
+    for bound, op in ((after, '>='), (before, '<')):
+        if bound is not None:
+            where.append(f"p.departure_time {op} {p}")
+            params.append(bound)
+    where.append(f"d.cell IN ({', '.join([p] * len(dropoff_cells))})")
+    params.extend(dropoff_cells)
+    sql = (
+        f"{RIDE_TABLE}.id IN (SELECT p.ride_id FROM {CELL_TABLE} p "
+        f"JOIN {CELL_TABLE} d ON d.ride_id = p.ride_id "
+        f"WHERE {' AND '.join(where)} AND p.enter_m < d.exit_m)"
+    )
+    return sql, params
+
+
+def _nearest_on_route(points, lengths, lat, lon):
+    """``[(distance_m, along_m)]`` from the point to each segment, and how far along the route the closest spot is."""
+    # Flat-earth projection around the point; within about 0.1% of haversine at matching radii.
+    scale = math.cos(math.radians(lat))
+    projected = [((p_lon - lon) * scale * METERS_PER_DEGREE, (p_lat - lat) * METERS_PER_DEGREE) for p_lat, p_lon in points]
+    found = []
+    offset = 0.0
+    for (ax, ay), (bx, by), length in zip(projected, projected[1:], lengths):
+        dx, dy = bx - ax, by - ay
+        norm = dx * dx + dy * dy
+        t = min(1.0, max(0.0, -(ax * dx + ay * dy) / norm)) if norm else 0.0
+        found.append((math.hypot(ax + t * dx, ay + t * dy), offset + t * length))
+        offset += length
+    return found
+
+
+def match(points, pickup, dropoff, radius_m):
+    """``(pickup_distance_m, dropoff_distance_m)`` if the route serves the trip, else None.
+
+    The route must come within ``radius_m`` of the pickup before it comes
+    within ``radius_m`` of the drop-off.
+    """
+    lengths = [distance_m(*a, *b) for a, b in zip(points, points[1:])]
+    near_pickup = [(along, d) for d, along in _nearest_on_route(points, lengths, *pickup) if d <= radius_m]
+    near_dropoff = [(along, d) for d, along in _nearest_on_route(points, lengths, *dropoff) if d <= radius_m]
+    if not near_pickup or not near_dropoff:
+        return None
+    # Board as early and leave as late as the route allows.
+    pickup_along, pickup_d = min(near_pickup)
+    dropoff_along, dropoff_d = max(near_dropoff)
+    if pickup_along >= dropoff_along:
+        return None
+    return pickup_d, dropoff_d
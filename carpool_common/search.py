@@ -0,0 +1,101 @@
+"""Ride search shared by the Django API and the FastAPI gateway.
+
+Rides carry normalized ``origin_key``/``destination_key`` columns. Matching
+rows are found through an index -- pg_trgm GIN indexes on PostgreSQL, an FTS5
+trigram table on SQLite -- and ranked exact > word prefix > substring.
+Callers order by that rank and then by departure time.
+
+Everything here returns ``(sql, params)`` pairs so it works with both the
+Django ORM (``RawSQL``/``extra``) and raw DB-API cursors.
+"""
+import re
+import unicodedata
+
+RIDE_TABLE = 'core_ride'
+FTS_TABLE = 'core_ride_search'
+FIELDS = ('origin', 'destination')
+# FTS5's trigram tokenizer cannot match terms shorter than a trigram.
+MIN_FTS_TERM = 3
+
+FTS_CREATE_SQL = f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(origin_key, destination_key, tokenize='trigram')"
+FTS_DROP_SQL = f"DROP TABLE IF EXISTS {FTS_TABLE}"
+FTS_REBUILD_SQL = (
+    f"INSERT INTO {FTS_TABLE} (rowid, origin_key, destination_key) "
+    f"SELECT id, origin_key, destination_key FROM {RIDE_TABLE}"
+)
+FTS_DELETE_SQL = f"DELETE FROM {FTS_TABLE} WHERE rowid = %s"
+FTS_INSERT_SQL = f"INSERT INTO {FTS_TABLE} (rowid, origin_key, destination_key) VALUES (%s, %s, %s)"
+
+TRGM_CREATE_SQL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    f"CREATE INDEX IF NOT EXISTS core_ride_origin_key_trgm ON {RIDE_TABLE} USING gin (origin_key gin_trgm_ops)",
+    f"CREATE INDEX IF NOT EXISTS core_ride_destination_key_trgm ON {RIDE_TABLE} USING gin (destination_key gin_trgm_ops)",
+]
+TRGM_DROP_SQL = [
+    "DROP INDEX IF EXISTS core_ride_origin_key_trgm",
+    "DROP INDEX IF EXISTS core_ride_destination_key_trgm",
+]
+
+
+def normalize(text):
+    """Lowercase, strip accents and collapse punctuation/whitespace to single spaces."""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(re.sub(r'[\W_]+', ' ', text.lower()).split())
+
+
+def _keys(field):
+    if field is None:
+        fields = FIELDS
+    elif field in FIELDS:
+        fields = (field,)
+    else:
+        raise ValueError(f"Unknown search field: {field}")
+    return [f'{RIDE_TABLE}.{name}_key' for name in fields]
+
+
+def match_sql(vendor, term, field=None, placeholder='%s'):
+    """WHERE condition on ``core_ride`` for rides matching ``term``, or None if it is blank.
+
+    ``field`` limits the match to ``'origin'`` or ``'destination'``.
+    """
+    term = normalize(term)
+    if not term:
+        return None
+    keys = _keys(field)
+    if vendor == 'sqlite' and len(term) >= MIN_FTS_TERM:
+        columns = ' '.join(key.split('.')[1] for key in keys)
+        phrase = '"' + term.replace('"', '""') + '"'
+        sql = f"{RIDE_TABLE}.id IN (SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH {placeholder})"
+        return sql, ['{%s} : %s' % (columns, phrase)]
+    # normalize() leaves no LIKE wildcards in the term. On PostgreSQL the
+    # trigram GIN indexes serve this substring match.
+    sql = '(' + ' OR '.join(f'{key} LIKE {placeholder}' for key in keys) + ')'
+    return sql, [f'%{term}%'] * len(keys)
+
+
+def rank_sql(term, field=None, placeholder='%s'):
+    """Match-quality expression: 3 for an exact key, 2 for a word prefix, 1 otherwise."""
+    term = normalize(term)
+    keys = _keys(field)
+    exact = ' OR '.join(f'{key} = {placeholder}' for key in keys)
+    prefix = ' OR '.join(f'{key} LIKE {placeholder} OR {key} LIKE {placeholder}' for key in keys)
+    sql = f'CASE WHEN {exact} THEN 3 WHEN {prefix} THEN 2 ELSE 1 END'
+    params = [term] * len(keys) + [f'{term}%', f'% {term}%'] * len(keys)
+    return sql, params
+
+
+def matches(term, keys):
+    """Python equivalent of ``match_sql`` for already-normalized ``keys``, for rows that aren't in the table."""
+    term = normalize(term)
+    return bool(term) and any(term in key for key in keys)
+
+
+def rank(term, keys):
+    """Python equivalent of ``rank_sql``."""
+    term = normalize(term)
+    if any(key == term for key in keys):
+        return 3
+    if any(key.startswith(term) or f' {term}' in key for key in keys):
+        return 2
+    return 1
@@ -0,0 +1,89 @@
+"""JWT access-token verification shared by the Django API and the FastAPI gateway.
+
+Tokens are SimpleJWT access tokens: HS256, signed with the shared
+``CARPOOL_SECRET_KEY``, carrying ``exp``, ``token_type`` and ``user_id``.
+``verify`` checks all of them, so a refresh token is never accepted in place
+of an access token. ``TokenCache`` remembers verified tokens so a client
+sending the same token again costs a dictionary lookup instead of a decode.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+
+ALGORITHM = 'HS256'
+USER_ID_CLAIM = 'user_id'
+TOKEN_TYPE_CLAIM = 'token_type'
+ACCESS_TOKEN_TYPE = 'access'
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+def verify(token, secret_key):
+    """The claims of a valid, unexpired access token. Raises InvalidToken."""
+    try:
+        claims = jwt.decode(token, secret_key, algorithms=[ALGORITHM], options={'require': ['exp']})
+    except jwt.PyJWTError:
+        raise InvalidToken('Token is invalid or expired')
+    if claims.get(TOKEN_TYPE_CLAIM) != ACCESS_TOKEN_TYPE:
+        raise InvalidToken('Token has wrong type')
+    if USER_ID_CLAIM not in claims:
+        raise InvalidToken('Token contained no recognizable user identification')
+    return claims
+
+
+class TokenCache:
+    """LRU of already-verified tokens and their claims.
+
+    An entry lives until the token's ``exp`` (or ``ttl`` seconds when the
+    token has none), so a cached token is never accepted after it expires.
+    Only successfully verified tokens are stored. Safe to share between
+    threads.
+    """
+
+    def __init__(self, secret_key, maxsize=10000, ttl=300, clock=time.time):
+        self.secret_key = secret_key
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expires_at, claims = entry
+            if self.clock() >= expires_at:
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return claims
+
+    def put(self, token, claims):
+        expires_at = claims.get('exp', self.clock() + self.ttl)
+        with self._lock:
+            self._entries[token] = (expires_at, claims)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def verify(self, token):
+        """Claims for ``token``, decoding it only on a cache miss. Raises InvalidToken."""
+        claims = self.get(token)
+        if claims is not None:
+            self.hits += 1
+            return claims
+        self.misses += 1
+        claims = verify(token, self.secret_key)
+        self.put(token, claims)
+        return claims
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,6 +1,12 @@
 import os
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'carpool_django.settings')
 
 application = get_asgi_application()
+
+if settings.DEBUG:
+    # What runserver does for WSGI: serve the admin's static files in development.
+    from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
+    application = ASGIStaticFilesHandler(application)
@@ -1,9 +1,13 @@
 import os
+import sys
 from pathlib import Path
 from datetime import timedelta
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# carpool_common (shared with the FastAPI gateway) lives at the repository root
+sys.path.append(str(BASE_DIR.parent))
+
 
 SECRET_KEY = os.environ.get('CARPOOL_SECRET_KEY', 'dev-secret-for-carpool-backend')
 
@@ -24,6 +28,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover the other middleware too (see core.instrumentation).
+    'core.instrumentation.MetricsMiddleware',
+    # Routes the reads of safe requests to CARPOOL_DB_REPLICAS (see core.replicas); unused without replicas.
+    'core.replicas.ReplicaMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -53,6 +61,15 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'carpool_django.wsgi.application'
+ASGI_APPLICATION = 'carpool_django.asgi.application'
+
+# Serve GETs of the hot read endpoints from async views (core.async_views). They pay off under
+# ASGI; set to 0 when serving through WSGI, where every async view would need its own event loop.
+CARPOOL_ASYNC_READS = os.environ.get('CARPOOL_ASYNC_READS', '1') == '1'
+
+# Queries taking at least this many milliseconds are sampled, with their stack, for
+# /api/metrics/slow-queries/ (see core.instrumentation).
+CARPOOL_SLOW_QUERY_MS = float(os.environ.get('CARPOOL_SLOW_QUERY_MS', '100'))
 
 # Database configuration - use PostgreSQL in Docker, SQLite otherwise
 if os.environ.get('DOCKER_ENV'):
@@ -71,9 +88,33 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'carpool.db',
+            # Concurrent writers queue for the lock when their transaction starts instead of failing
+            # halfway through it (e.g. two bookings racing for the last seats).
+            'OPTIONS': {'transaction_mode': 'IMMEDIATE', 'timeout': 20},
+            # A file rather than shared-cache memory, whose table locks fail instead of waiting; the
+            # concurrency tests need that.
+            'TEST': {'NAME': BASE_DIR / 'test_carpool.db'},
         }
     }
 
+# Read replicas for GET/HEAD/OPTIONS requests (see core.replicas), comma-separated: host[:port] of
+# PostgreSQL standbys of the primary (same database and credentials) in Docker, SQLite files otherwise.
+CARPOOL_READ_REPLICAS = []
+for number, replica in enumerate(filter(None, os.environ.get('CARPOOL_DB_REPLICAS', '').split(',')), 1):
+    alias = f'replica{number}'
+    if os.environ.get('DOCKER_ENV'):
+        host, _, port = replica.strip().partition(':')
+        DATABASES[alias] = dict(DATABASES['default'], HOST=host, PORT=port or DATABASES['default']['PORT'])
+    else:
+        DATABASES[alias] = dict(DATABASES['default'], NAME=replica.strip())
+    # Tests run against the primary only.
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    CARPOOL_READ_REPLICAS.append(alias)
+if CARPOOL_READ_REPLICAS:
+    DATABASE_ROUTERS = ['core.replicas.ReplicaRouter']
+# Seconds a user keeps reading from the primary after a write, so replica lag never hides it.
+CARPOOL_REPLICA_STICKY_SECONDS = float(os.environ.get('CARPOOL_REPLICA_STICKY_SECONDS', '10'))
+
 AUTH_PASSWORD_VALIDATORS = []
 
 LANGUAGE_CODE = 'en-us'
@@ -90,9 +131,16 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 AUTH_USER_MODEL = 'core.User'
 
 # Django REST Framework + SimpleJWT
+# Claims-based JWT authentication skips the user-row lookup per request (see core.authentication);
+# set CARPOOL_CLAIMS_AUTH=0 for SimpleJWT's own class.
+CARPOOL_CLAIMS_AUTH = os.environ.get('CARPOOL_CLAIMS_AUTH', '1') == '1'
+# Seconds a user's active/deactivated/deleted status is cached for claims-based authentication.
+CARPOOL_AUTH_USER_TTL = int(os.environ.get('CARPOOL_AUTH_USER_TTL', '60'))
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'core.authentication.ClaimsJWTAuthentication' if CARPOOL_CLAIMS_AUTH
+        else 'rest_framework_simplejwt.authentication.JWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
@@ -107,3 +155,20 @@ SIMPLE_JWT = {
 
 # CORS - allow external frontend repos to access this API (development default)
 CORS_ALLOW_ALL_ORIGINS = True
+
+# Cache for read-heavy ride responses (see core.caching). Local memory per process by default;
+# point CARPOOL_CACHE_BACKEND at e.g. django.core.cache.backends.redis.RedisCache to share it between workers
+# (the core.E001 system check fails with the per-process default when CARPOOL_WORKERS > 1).
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CARPOOL_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CARPOOL_CACHE_LOCATION', 'carpool'),
+        'TIMEOUT': int(os.environ.get('CARPOOL_CACHE_TIMEOUT', '3600')),
+    }
+}
+if CACHES['default']['BACKEND'] == 'django.core.cache.backends.locmem.LocMemCache':
+    # LocMemCache culls a third of its entries once it holds 300 (Django's default), far fewer than the
+    # ride details, availabilities and list pages a worker serves; other backends don't take this option.
+    CACHES['default']['OPTIONS'] = {'MAX_ENTRIES': int(os.environ.get('CARPOOL_CACHE_MAX_ENTRIES', '50000'))}
+# Worker processes serving the API; uvicorn and gunicorn take their worker count from WEB_CONCURRENCY too.
+CARPOOL_WORKERS = int(os.environ.get('CARPOOL_WORKERS', os.environ.get('WEB_CONCURRENCY', '1')))
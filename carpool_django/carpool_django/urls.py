@@ -1,5 +1,6 @@
 from django.contrib import admin
 from django.urls import path, include
+from core.instrumentation import metrics_view
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
@@ -10,4 +11,5 @@ urlpatterns = [
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/', include('core.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import User, Vehicle, Ride, Booking
+from .models import User, Vehicle, Ride, RideSchedule, Booking, GpsPoint
 
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
@@ -16,6 +16,16 @@ class RideAdmin(admin.ModelAdmin):
     list_display = ('id', 'driver', 'origin', 'destination', 'departure_time', 'available_seats')
 
 
+@admin.register(RideSchedule)
+class RideScheduleAdmin(admin.ModelAdmin):
+    list_display = ('id', 'driver', 'origin', 'destination', 'departure_time', 'weekdays', 'starts_on', 'ends_on')
+
+
 @admin.register(Booking)
 class BookingAdmin(admin.ModelAdmin):
     list_display = ('id', 'ride', 'passenger', 'seats', 'created_at')
+
+
+@admin.register(GpsPoint)
+class GpsPointAdmin(admin.ModelAdmin):
+    list_display = ('id', 'ride', 'recorded_at', 'lat', 'lon', 'speed')
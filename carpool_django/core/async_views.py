@@ -0,0 +1,216 @@
+"""Async read path for the hottest endpoints: ride list, detail and availability, and ``users/me``.
+
+DRF views are synchronous, so under ASGI each of them holds a thread for the
+whole request. These views answer GET/HEAD themselves with Django's async ORM
+(cache lookups go through ``caching.lookup`` in one hop), and ``read_path``
+hands every other method to the usual DRF view. They keep the DRF views' behaviour: the same querysets and
+serializers, the same cache entries (``core.caching``), the same validators
+(``core.conditional``) and the same JWT authentication.
+
+Requests the async path doesn't cover are declined (the view returns None) and
+go to the DRF view. These are renderers other than JSON, such as the browsable
+API, and ride route searches, which check routes in Python over the ORM. A
+ride list cache miss is rendered by the viewset's own paginators in a single
+``sync_to_async`` hop.
+"""
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.http import Http404, HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions, mixins
+from rest_framework.views import exception_handler
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from . import caching, replicas, schedules
+from .authentication import ClaimsJWTAuthentication
+from .conditional import aconditional, alist_validators, aobject_validators
+from .models import Ride, User
+from .serializers import UserProfileSerializer
+from .views import RideViewSet, UserProfileView
+
+# Ride list parameters that need the sync path (see RideQuerySet.along_route).
+SYNC_LIST_PARAMS = ('pickup', 'dropoff')
+
+
+def read_path(async_view, sync_view):
+    """One URL: GET/HEAD through ``async_view`` unless it declines, everything else through ``sync_view``."""
+    sync_view = sync_to_async(sync_view)
+
+    async def view(request, *args, **kwargs):
+        if request.method in ('GET', 'HEAD'):
+            response = await async_view(request, *args, **kwargs)
+            if response is not None:
+                return response
+        return await sync_view(request, *args, **kwargs)
+
+    # Like DRF's views: JWT requests carry no CSRF token.
+    return csrf_exempt(view)
+
+
+class Read:
+    """A DRF request and view instance for one async read, as ``as_view()`` would set them up."""
+
+    def __init__(self, request, view_class, action=None, **kwargs):
+        view = view_class(action_map={'get': action, 'head': action}) if action else view_class()
+        view.args, view.kwargs = (), kwargs
+        self.request = view.request = view.initialize_request(request, **kwargs)
+        view.format_kwarg = view.get_format_suffix(**kwargs)
+        self.view = view
+
+    def negotiate(self):
+        """False if the client wants something other than JSON, which the DRF view renders."""
+        try:
+            renderer, media_type = self.view.perform_content_negotiation(self.request)
+        except exceptions.NotAcceptable:
+            return False
+        self.request.accepted_renderer, self.request.accepted_media_type = renderer, media_type
+        return renderer.format == 'json'
+
+    async def authenticate(self, users=None):
+        """Set ``request.user`` from the JWT like the view's authentication class, with at most one hop.
+
+        ``users`` loads the user from that queryset instead, for views that
+        need the whole row anyway.
+        """
+        authentication = self.view.get_authenticators()[0]
+        header = authentication.get_header(self.request)
+        raw_token = header and authentication.get_raw_token(header)
+        if not raw_token:
+            self.request.user = AnonymousUser()
+            return None
+        token = authentication.get_validated_token(raw_token)
+        if users is None and isinstance(authentication, ClaimsJWTAuthentication):
+            user = await sync_to_async(authentication.get_user)(token)
+        else:
+            user = await self._load_user(token, users if users is not None else User.objects)
+        self.request.user, self.request.auth = user, token
+        return user
+
+    @staticmethod
+    async def _load_user(token, users):
+        # As SimpleJWT's JWTAuthentication.get_user.
+        try:
+            user_id = token[jwt_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+        try:
+            user = await users.aget(**{jwt_settings.USER_ID_FIELD: user_id})
+        except User.DoesNotExist:
+            raise exceptions.AuthenticationFailed("User not found", code='user_not_found')
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed("User is inactive", code='user_inactive')
+        return user
+
+    def render(self, data, status=200, headers=None):
+        renderer = self.request.accepted_renderer
+        content = renderer.render(data, self.request.accepted_media_type, {'request': self.request, 'view': self.view})
+        response = HttpResponse(content, status=status, content_type=renderer.media_type, headers=headers)
+        response['Vary'] = 'Accept'
+        return response
+
+    def error(self, exc):
+        """The response DRF's exception handling would give."""
+        if isinstance(exc, Http404):
+            exc = exceptions.NotFound(*exc.args)
+        if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+            exc.auth_header = self.view.get_authenticate_header(self.request)
+        response = exception_handler(exc, {'request': self.request, 'view': self.view})
+        headers = {name: value for name, value in response.items() if name.lower() != 'content-type'}
+        return self.render(response.data, response.status_code, headers)
+
+    async def cached(self, render, make_key, *args):
+        """``RideViewSet._cached`` for async renders that return data; the key is ``make_key(*args)``."""
+        key, data = await sync_to_async(caching.lookup)(make_key, *args)
+        if data is not None:
+            return self.render(data, headers={'X-Cache': 'HIT'})
+        with replicas.primary():
+            data = await render()
+        await caching.aput(key, data)
+        return self.render(data, headers={'X-Cache': 'MISS'})
+
+
+async def _serve(read, handle, users=None):
+    if not read.negotiate():
+        return None
+    try:
+        await read.authenticate(users)
+        return await handle()
+    except (exceptions.APIException, Http404) as exc:
+        return read.error(exc)
+
+
+def _list_key(request):
+    return caching.list_key(request, schedules.window_state())
+
+
+async def ride_list(request):
+    if any(param in request.GET for param in SYNC_LIST_PARAMS):
+        return None
+    read = Read(request, RideViewSet, 'list')
+
+    async def validators():
+        # As RideViewSet.list: the validators skip the booking stats annotation.
+        queryset = read.view._filter(Ride.objects.all())
+        return await alist_validators(read.request, queryset, *await schedules.astate())
+
+    async def render():
+        return await read.cached(render_page, _list_key, read.request)
+
+    async def render_page():
+        # Schedule occurrences and both paginators are sync; render the page in one hop.
+        response = await sync_to_async(mixins.ListModelMixin.list)(read.view, read.request)
+        return response.data
+
+    return await _serve(read, lambda: aconditional(read.request, validators, render))
+
+
+async def _ride(read, pk):
+    try:
+        return await read.view.get_queryset().aget(pk=pk)
+    except Ride.DoesNotExist:
+        raise Http404("No Ride matches the given query.")
+
+
+async def _ride_response(read, pk, kind, serialize):
+    """Detail-style ride response: conditional, then cached, then ``serialize(ride)``."""
+    if not str(pk).isdigit():
+        raise Http404("No Ride matches the given query.")
+
+    async def render():
+        return await read.cached(lambda: _serialized(read, pk, serialize), caching.ride_key, kind, int(pk))
+
+    return await aconditional(read.request, lambda: aobject_validators(read.request, Ride.objects, pk), render)
+
+
+async def _serialized(read, pk, serialize):
+    return serialize(await _ride(read, pk))
+
+
+async def ride_detail(request, pk):
+    read = Read(request, RideViewSet, 'retrieve', pk=pk)
+    return await _serve(read, lambda: _ride_response(
+        read, pk, 'detail', lambda ride: read.view.get_serializer(ride).data,
+    ))
+
+
+async def ride_availability(request, pk):
+    read = Read(request, RideViewSet, 'availability', pk=pk)
+    return await _serve(read, lambda: _ride_response(read, pk, 'availability', lambda ride: {
+        "ride_id": ride.id,
+        "total_seats": ride.available_seats,
+        "booked_seats": ride.seats_booked,
+        "available_seats": ride.seats_remaining
+    }))
+
+
+async def profile(request):
+    read = Read(request, UserProfileView)
+
+    async def handle():
+        if read.request.user.is_anonymous:
+            raise exceptions.NotAuthenticated()
+        return read.render(UserProfileSerializer(read.request.user).data)
+
+    # The user comes with the profile's counts and vehicles, so authentication is the only query.
+    return await _serve(read, handle, UserProfileSerializer.preload(User.objects))
@@ -0,0 +1,78 @@
+"""JWT authentication that trusts the token's claims instead of loading the user.
+
+SimpleJWT's ``JWTAuthentication`` reads the user row on every request, although
+most views only need ``request.user`` for its id (``filter(passenger=...)``,
+ownership checks, ``save(driver=...)``). ``ClaimsJWTAuthentication`` verifies the
+token with ``carpool_common.tokens`` (the gateway's verifier, with its cache of
+verified tokens) and returns ``User.from_claims``: a user whose other fields are
+loaded on first use.
+
+A token outlives changes to its user, so whether the user still exists and is
+active is checked through the cache (``user_status``) for at most
+``CARPOOL_AUTH_USER_TTL`` seconds at a time. Saving or deleting a user drops
+its entry straight away (see core.signals); with a per-process cache backend,
+other workers notice within the TTL.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from rest_framework import exceptions
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from carpool_common import tokens
+from .models import User
+
+CACHE_ALIAS = 'default'
+# Cache values: users that don't exist are remembered like deactivated ones.
+ACTIVE, INACTIVE, MISSING = 'active', 'inactive', 'missing'
+
+verified_tokens = tokens.TokenCache(jwt_settings.SIGNING_KEY)
+
+
+def _status_key(user_id):
+    return f'auth:user:{user_id}:status'
+
+
+def user_status(user_id):
+    """ACTIVE, INACTIVE or MISSING, from the cache or one ``is_active`` lookup."""
+    cache = caches[CACHE_ALIAS]
+    status = cache.get(_status_key(user_id))
+    if status is None:
+        is_active = User.objects.filter(pk=user_id).values_list('is_active', flat=True).first()
+        status = MISSING if is_active is None else ACTIVE if is_active else INACTIVE
+        cache.set(_status_key(user_id), status, timeout=settings.CARPOOL_AUTH_USER_TTL)
+    return status
+
+
+def forget_user(user_id, using=None):
+    """Drop the cached status of ``user_id`` once the current transaction commits."""
+    transaction.on_commit(lambda: caches[CACHE_ALIAS].delete(_status_key(user_id)), using=using)
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """``JWTAuthentication`` with the user built from the token (see module docstring).
+
+    ``request.auth`` is the token's claims dict.
+    """
+
+    def get_validated_token(self, raw_token):
+        try:
+            return verified_tokens.verify(raw_token.decode() if isinstance(raw_token, bytes) else raw_token)
+        except tokens.InvalidToken as exc:
+            raise InvalidToken({'detail': str(exc), 'code': 'token_not_valid'})
+
+    def get_user(self, validated_token):
+        try:
+            user_id = User._meta.pk.to_python(validated_token[tokens.USER_ID_CLAIM])
+        except DjangoValidationError:
+            raise InvalidToken({'detail': "Token contained no recognizable user identification",
+                                'code': 'token_not_valid'})
+        status = user_status(user_id)
+        if status == MISSING:
+            raise exceptions.AuthenticationFailed("User not found", code='user_not_found')
+        if status == INACTIVE:
+            raise exceptions.AuthenticationFailed("User is inactive", code='user_inactive')
+        return User.from_claims(user_id)
@@ -0,0 +1,791 @@
+"""In-process benchmark scenarios for the Django API and the FastAPI gateway.
+
+``manage.py seed_bench`` fills the database with ``bench-`` users, vehicles,
+rides and bookings; ``manage.py bench`` runs the scenarios below against them
+through Django's test client and FastAPI's ``TestClient``, on whatever database
+Django is configured for (SQLite or Postgres). No server is involved, so
+results measure the application rather than the HTTP stack.
+
+Every request is recorded per endpoint with its latency, status and query
+count: Django queries as captured on the request's connection, gateway
+queries as connections taken from its pool. ``Results`` turns the samples
+into p50/p95/p99 and throughput, and ``compare`` flags regressions between
+two runs' JSON.
+"""
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, reset_queries, transaction
+from django.db.models import F
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import Booking, GpsPoint, Ride, User
+
+USERNAME_PREFIX = 'bench-'
+# Bump when scenarios change what they request, so old results aren't compared against new ones.
+SCENARIO_VERSION = 2
+# Extra queries per request tolerated by ``compare``: threads racing to fill the same cache entry
+# (booking_burst) move the mean a little between runs, but one more query per request is a regression.
+QUERY_TOLERANCE = 0.5
+# Ride table sizes search_scale measures at.
+SEARCH_SIZES = (10_000, 100_000, 1_000_000)
+# Websocket subscriber counts gps_fanout measures with.
+SUBSCRIBERS = (1000, 5000)
+# Messages gps_ingest sends per round.
+INGEST_BATCH = 100
+# Fixes per second trail_ingest submits, and for how long.
+TRAIL_RATE = 5000
+TRAIL_SECONDS = 10
+# Vehicles reporting positions in the positions scenario, and the updates timed together.
+POSITION_VEHICLES = 50_000
+POSITION_BATCH = 1000
+# Items per request in bulk_writes.
+BULK_BATCH = 50
+# Fixes gps_frames encodes and decodes together.
+FRAME_BATCH = 100
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class Results:
+    """Latency, status and query count of every request in one scenario, by endpoint."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.checks = {}
+        self.started = time.perf_counter()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, ms, queries, status):
+        with self._lock:
+            self.samples[endpoint].append((ms, queries, status))
+
+    def django(self, client, endpoint, method, path, data=None, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = getattr(client, method)(path, data, **kwargs)
+            ms = (time.perf_counter() - started) * 1000
+        self.add(endpoint, ms, len(queries), response.status_code)
+        return response
+
+    def gateway(self, client, endpoint, path, **kwargs):
+        # The replica pool is the primary's unless GATEWAY_DB_REPLICA is set.
+        pools = {client.app.state.db, client.app.state.replica}
+        acquired = sum(pool.metrics()['acquired_total'] for pool in pools)
+        started = time.perf_counter()
+        response = client.get(path, **kwargs)
+        ms = (time.perf_counter() - started) * 1000
+        self.add(endpoint, ms, sum(pool.metrics()['acquired_total'] for pool in pools) - acquired,
+                 response.status_code)
+        return response
+
+    def finish(self):
+        self.finished = time.perf_counter()
+        return self
+
+    def summary(self):
+        wall = (self.finished or time.perf_counter()) - self.started
+        requests = sum(len(samples) for samples in self.samples.values())
+        return {
+            'wall_s': round(wall, 3),
+            'requests': requests,
+            'throughput_rps': round(requests / wall, 1) if wall else 0.0,
+            'endpoints': {endpoint: _endpoint_summary(samples) for endpoint, samples in self.samples.items()},
+            'checks': self.checks,
+        }
+
+
+def _endpoint_summary(samples):
+    timings = [ms for ms, _, _ in samples]
+    queries = [count for _, count, _ in samples]
+    return {
+        'requests': len(samples),
+        'p50_ms': round(percentile(timings, 50), 2),
+        'p95_ms': round(percentile(timings, 95), 2),
+        'p99_ms': round(percentile(timings, 99), 2),
+        'max_ms': round(max(timings), 2),
+        # Requests per second one thread serves this endpoint at.
+        'rps': round(len(timings) * 1000 / sum(timings), 1),
+        'queries_mean': round(sum(queries) / len(queries), 2),
+        'queries_max': max(queries),
+        'statuses': dict(Counter(str(status) for _, _, status in samples)),
+    }
+
+
+class Context:
+    """The seeded data the scenarios draw from, and tokens for its users."""
+
+    def __init__(self, requests, seed, concurrency, search_sizes=SEARCH_SIZES, subscribers=SUBSCRIBERS,
+                 trail_rate=TRAIL_RATE, trail_seconds=TRAIL_SECONDS):
+        self.requests = requests
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.concurrency = concurrency
+        self.search_sizes = sorted(search_sizes)
+        self.subscribers = list(subscribers)
+        self.trail_rate = trail_rate
+        self.trail_seconds = trail_seconds
+        users = list(User.objects.filter(username__startswith=USERNAME_PREFIX).order_by('pk'))
+        if not users:
+            raise ValueError("No benchmark data; run `manage.py seed_bench` first.")
+        self.users = users
+        self.tokens = {}
+        now = timezone.now()
+        self.upcoming = list(
+            Ride.objects.filter(driver__username__startswith=USERNAME_PREFIX, departure_time__gte=now)
+            .order_by('pk').values_list('pk', 'origin', 'destination', 'origin_lat', 'origin_lon',
+                                        'destination_lat', 'destination_lon')
+        )
+        self.ride_count = Ride.objects.count()
+
+    def token(self, user):
+        if user.pk not in self.tokens:
+            self.tokens[user.pk] = str(AccessToken.for_user(user))
+        return self.tokens[user.pk]
+
+    def auth(self, user):
+        return {'HTTP_AUTHORIZATION': f'Bearer {self.token(user)}'}
+
+    def user(self):
+        # Skewed like the data: low ids are the busiest users (see seed_bench).
+        return self.users[min(len(self.users) - 1, int(self.rng.paretovariate(1.2)) - 1)]
+
+
+def _client():
+    # Errors are results too: record a 500 instead of stopping the run.
+    return Client(raise_request_exception=False)
+
+
+def ride_list(ctx):
+    """Ride listings as the app pages through them: page numbers, cursors, filters, details."""
+    results, client = Results(), _client()
+    pages = max(1, ctx.ride_count // 20)
+    for _ in range(ctx.requests):
+        user = ctx.user()
+        page = min(pages, int(ctx.rng.expovariate(0.5)) + 1)
+        results.django(client, 'GET /api/rides/?page', 'get', f'/api/rides/?page={page}', **ctx.auth(user))
+        response = results.django(client, 'GET /api/rides/?cursor', 'get',
+                                  '/api/rides/?available_only=true&cursor=', **ctx.auth(user))
+        next_link = response.json().get('next') if response.status_code == 200 else None
+        if next_link:
+            results.django(client, 'GET /api/rides/?cursor', 'get', next_link, **ctx.auth(user))
+        ride_id = ctx.rng.choice(ctx.upcoming)[0]
+        results.django(client, 'GET /api/rides/{id}/', 'get', f'/api/rides/{ride_id}/', **ctx.auth(user))
+        results.django(client, 'GET /api/rides/{id}/availability/', 'get',
+                       f'/api/rides/{ride_id}/availability/', **ctx.auth(user))
+    return results.finish()
+
+
+def cache_reads(ctx):
+    """The same ride reads against a cold cache (cleared before each) and a warm one.
+
+    The warm pass repeats the reads once the cache holds them. Both passes
+    record the ``X-Cache`` header of every response and the hits and misses
+    ``core.caching`` counted, so a warm run that misses shows up in the checks.
+    """
+    from . import caching
+
+    results, client = Results(), _client()
+    pages = max(1, ctx.ride_count // 20)
+    reads = []
+    for _ in range(ctx.requests):
+        ride_id = ctx.rng.choice(ctx.upcoming)[0]
+        reads.append((ctx.user(), [
+            ('GET /api/rides/?page', f'/api/rides/?page={min(pages, int(ctx.rng.expovariate(0.5)) + 1)}'),
+            ('GET /api/rides/{id}/', f'/api/rides/{ride_id}/'),
+            ('GET /api/rides/{id}/availability/', f'/api/rides/{ride_id}/availability/'),
+        ]))
+
+    def read_all(label, clear):
+        headers = Counter()
+        before = dict(caching.stats)
+        for user, paths in reads:
+            for endpoint, path in paths:
+                if clear:
+                    caches['default'].clear()
+                response = results.django(client, f'{endpoint} {label}', 'get', path, **ctx.auth(user))
+                headers[response.get('X-Cache', 'none')] += 1
+        results.checks[label] = {'x_cache': dict(headers),
+                                 **{key: caching.stats[key] - before[key] for key in ('hits', 'misses')}}
+
+    read_all('cold', clear=True)
+    for user, paths in reads:
+        for _, path in paths:
+            client.get(path, **ctx.auth(user))
+    read_all('warm', clear=False)
+    return results.finish()
+
+
+def search(ctx):
+    """Text and route searches on the Django API and the gateway's ``/search``."""
+    from fastapi.testclient import TestClient
+
+    results, client = Results(), _client()
+    with TestClient(_gateway_app()) as gateway:
+        for _ in range(ctx.requests):
+            user = ctx.user()
+            _, origin, destination, *route = ctx.rng.choice(ctx.upcoming)
+            term = origin.split()[0]
+            results.django(client, 'GET /api/rides/?search', 'get', '/api/rides/',
+                           {'search': term}, **ctx.auth(user))
+            results.gateway(gateway, 'GATEWAY /search?q', '/search',
+                            params={'q': f'{term} {destination.split()[0]}', 'token': ctx.token(user)})
+            if None not in route:
+                pickup, dropoff = f'{route[0]},{route[1]}', f'{route[2]},{route[3]}'
+                results.django(client, 'GET /api/rides/?pickup&dropoff', 'get', '/api/rides/',
+                               {'pickup': pickup, 'dropoff': dropoff}, **ctx.auth(user))
+                results.gateway(gateway, 'GATEWAY /search?pickup&dropoff', '/search',
+                                params={'pickup': pickup, 'dropoff': dropoff, 'token': ctx.token(user)})
+    return results.finish()
+
+
+def search_scale(ctx):
+    """Ride search on the Django API as the ride table grows to each of ``ctx.search_sizes`` rides.
+
+    Tops the table up with copies of the seeded routes departing over the
+    next two weeks, then searches a city (matching a large share of the
+    rides) or a full pickup spot. The cache is cleared before every request
+    so each one runs the query. Everything runs in a transaction that is
+    rolled back, so the gateway, which reads through its own connections,
+    isn't measured here; it runs the same carpool_common.search SQL.
+    """
+    results, client = Results(), _client()
+    now = timezone.now()
+    with transaction.atomic():
+        for size in ctx.search_sizes:
+            started = time.perf_counter()
+            rides = _route_copies(ctx, size - Ride.objects.count(), now)
+            while batch := list(itertools.islice(rides, 5000)):
+                Ride.objects.bulk_create(batch)
+            # With DEBUG on, the inserts fill the query log that the request captures count from.
+            reset_queries()
+            results.checks[f'seed_{size}_rides_s'] = round(time.perf_counter() - started, 1)
+            for _ in range(ctx.requests):
+                origin = ctx.rng.choice(ctx.upcoming)[1]
+                term = origin.split()[0] if ctx.rng.random() < 0.5 else origin
+                caches['default'].clear()
+                results.django(client, f'GET /api/rides/?search @ {size} rides', 'get', '/api/rides/',
+                               {'search': term}, **ctx.auth(ctx.user()))
+        transaction.set_rollback(True)
+    return results.finish()
+
+
+def _route_copies(ctx, count, now):
+    """``count`` rides on the seeded routes, departing over the next two weeks."""
+    for i in range(count):
+        _, origin, destination, *_ = ctx.rng.choice(ctx.upcoming)
+        yield Ride(driver=ctx.users[i % len(ctx.users)], origin=origin, destination=destination,
+                   departure_time=now + timedelta(seconds=ctx.rng.uniform(0, 14 * 86400)), available_seats=4)
+
+
+def booking_burst(ctx):
+    """Many passengers booking the same five open rides at once, from ``concurrency`` threads.
+
+    Most attempts are turned away once the seats are gone, as in a real rush.
+    Checks afterwards that no ride was overbooked, then cancels the bookings
+    it made so the data is unchanged for the next run.
+    """
+    results = Results()
+    open_rides = Ride.objects.filter(driver__username__startswith=USERNAME_PREFIX, departure_time__gte=timezone.now(),
+                                     available_seats__gt=F('seats_booked'))
+    rides = ctx.rng.sample(sorted(open_rides.values_list('pk', flat=True)), 5)
+    attempts = [(ctx.rng.choice(ctx.users), ctx.rng.choice(rides)) for _ in range(ctx.requests)]
+    for user, _ in attempts:
+        ctx.token(user)
+    started = timezone.now()
+
+    def book(chunk):
+        client = _client()
+        try:
+            for user, ride_id in chunk:
+                results.django(client, 'POST /api/bookings/', 'post', '/api/bookings/', {'ride': ride_id, 'seats': 1},
+                               content_type='application/json', **ctx.auth(user))
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(ctx.concurrency) as pool:
+        list(pool.map(book, [attempts[i::ctx.concurrency] for i in range(ctx.concurrency)]))
+    results.finish()
+
+    overbooked = Ride.objects.filter(pk__in=rides).exclude(seats_booked__lte=F('available_seats'))
+    results.checks['overbooked_rides'] = overbooked.count()
+    made = Booking.objects.filter(ride__in=rides, created_at__gte=started)
+    results.checks['bookings_made'] = made.count()
+    for booking in made:
+        booking.cancel()
+    return results
+
+
+def bulk_writes(ctx):
+    """``POST .../bulk/`` against one request per item, for creating rides and booking them.
+
+    Every round creates ``BULK_BATCH`` rides and books a seat on each, once
+    through the bulk endpoints and once item by item; a sample is the whole
+    batch either way, so the two compare directly. There are
+    ``ctx.requests // BULK_BATCH`` rounds (at least one). The rides, and their
+    bookings with them, are deleted afterwards.
+    """
+    results, client = Results(), _client()
+    driver, passenger = ctx.users[0], ctx.users[1]
+    departure = timezone.now() + timedelta(days=1)
+    created = []
+    try:
+        for _ in range(max(1, ctx.requests // BULK_BATCH)):
+            for bulk in (True, False):
+                mode = 'bulk' if bulk else 'one by one'
+                rides = []
+                for _ in range(BULK_BATCH):
+                    _, origin, destination, *_ = ctx.rng.choice(ctx.upcoming)
+                    rides.append({'origin': origin, 'destination': destination, 'available_seats': 4,
+                                  'price_cents': 1500, 'departure_time': departure.isoformat()})
+                ride_ids = _post_items(results, client, f'POST /api/rides/ x{BULK_BATCH} {mode}', '/api/rides/',
+                                       rides, bulk, ctx.auth(driver))
+                created.extend(ride_ids)
+                _post_items(results, client, f'POST /api/bookings/ x{BULK_BATCH} {mode}', '/api/bookings/',
+                            [{'ride': ride_id, 'seats': 1} for ride_id in ride_ids], bulk, ctx.auth(passenger))
+        results.finish()
+        results.checks['rides_created'] = len(created)
+        results.checks['bookings_made'] = Booking.objects.filter(ride__in=created).count()
+    finally:
+        Ride.objects.filter(pk__in=created).delete()
+    return results
+
+
+def _post_items(results, client, endpoint, path, items, bulk, auth):
+    """POST ``items`` in one bulk request or one request each, as one sample; returns the created ids."""
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        if bulk:
+            response = client.post(f'{path}bulk/', items, content_type='application/json', **auth)
+            status = response.status_code
+            ids = [result.get('id') for result in response.json().get('results', ())] if status < 500 else []
+        else:
+            responses = [client.post(path, item, content_type='application/json', **auth) for item in items]
+            status = next((response.status_code for response in responses if response.status_code != 201), 201)
+            ids = [response.json()['id'] for response in responses if response.status_code == 201]
+        ms = (time.perf_counter() - started) * 1000
+    results.add(endpoint, ms, len(queries), status)
+    return [pk for pk in ids if pk is not None]
+
+
+def profile(ctx):
+    """``users/me``, which the app fetches on every launch."""
+    results, client = Results(), _client()
+    for _ in range(ctx.requests):
+        results.django(client, 'GET /api/users/me/', 'get', '/api/users/me/', **ctx.auth(ctx.user()))
+    return results.finish()
+
+
+def gps_fanout(ctx):
+    """One driver streaming fixes over the gateway websocket to each of ``ctx.subscribers`` riders.
+
+    Records every delivery (from sending a fix until one subscriber was
+    handed it) and every fix (until the last subscriber was).
+    """
+    from fastapi.testclient import TestClient
+
+    results = Results()
+    began = timezone.now()
+    ride = Ride.objects.select_related('driver').get(pk=ctx.upcoming[0][0])
+    with TestClient(_gateway_app()) as gateway:
+        for count in ctx.subscribers:
+            gateway.portal.call(_fan_out, gateway.app, ctx, results, ride, count)
+    results.finish()
+    # The gateway's trail writer has flushed by now (on shutdown); drop what it stored.
+    GpsPoint.objects.filter(ride=ride, recorded_at__gte=began).delete()
+    return results
+
+
+async def _fan_out(app, ctx, results, ride, count):
+    pool = app.state.db
+    ride_id = ride.pk
+    # Only the driver's fixes are stored on the trail, like in production.
+    driver = ctx.token(ride.driver)
+    # Riders may have several devices when there are fewer users than subscribers.
+    riders = [ctx.token(ctx.users[1 + i % (len(ctx.users) - 1)]) for i in range(count)]
+    sockets = [await _Socket(app, f'/ws/gps?token={rider}&ride_ids={ride_id}').connect() for rider in riders]
+    publisher = await _Socket(app, f'/ws/gps?token={driver}').connect()
+    try:
+        for n in range(ctx.requests):
+            timestamp = time.time()
+            acquired = pool.metrics()['acquired_total']
+            started = time.perf_counter()
+            publisher.send_text(json.dumps({'token': driver, 'ride_id': ride_id, 'lat': 6.5 + n * 1e-4, 'lon': 3.4,
+                                            'speed': 12.0, 'timestamp': timestamp}))
+            delivered = await asyncio.gather(*(_receive_fix(socket, timestamp) for socket in sockets))
+            for at in delivered:
+                results.add(f'WS /ws/gps delivery to {count}', ((at or time.perf_counter()) - started) * 1000, 0,
+                            200 if at else 504)
+            results.add(f'WS /ws/gps fix to {count}', (time.perf_counter() - started) * 1000,
+                        pool.metrics()['acquired_total'] - acquired, 200 if all(delivered) else 504)
+    finally:
+        for socket in [*sockets, publisher]:
+            await socket.close()
+
+
+async def _receive_fix(socket, timestamp, timeout=10):
+    """When ``socket`` was handed the fix sent at ``timestamp`` (skipping older positions), or None on timeout."""
+    async def receive():
+        while True:
+            at, text = await socket.receive()
+            if json.loads(text).get('gps', {}).get('timestamp') == timestamp:
+                return at
+
+    try:
+        return await asyncio.wait_for(receive(), timeout)
+    except asyncio.TimeoutError:
+        return None
+
+
+def gps_ingest(ctx):
+    """Messages per second one driver's websocket gets through: JSON fixes vs binary frames.
+
+    JSON fixes either repeat the connection's token, which the session
+    accepts without verifying it again, or each carry a new token, which costs
+    a full verification as every fix did before. Binary frames are covered by
+    the connection's token. Every round sends ``INGEST_BATCH`` messages and
+    waits until the gateway has handled them; its sample is the time per
+    message, so an endpoint's req/s is its messages per second.
+    """
+    from fastapi.testclient import TestClient
+
+    from fastapi_app import frames
+
+    results = Results()
+    began = timezone.now()
+    ride_id = ctx.upcoming[0][0]
+    driver = Ride.objects.get(pk=ride_id).driver
+    token = ctx.token(driver)
+
+    def fix(n):
+        return {'ride_id': ride_id, 'lat': 6.5 + n * 1e-6, 'lon': 3.4, 'heading': 90.0, 'speed': 12.0,
+                'timestamp': time.time()}
+
+    def json_fix(n, token=token):
+        return json.dumps({'token': token, **fix(n)})
+
+    fresh = [str(AccessToken.for_user(driver)) for _ in range(ctx.requests * INGEST_BATCH)]
+    variants = {
+        'WS /ws/gps JSON fix': json_fix,
+        'WS /ws/gps JSON fix, new token': lambda n: json_fix(n, fresh[n]),
+        'WS /ws/gps binary frame': lambda n: frames.encode([fix(n)]),
+    }
+    with TestClient(_gateway_app()) as gateway:
+        for endpoint, message in variants.items():
+            gateway.portal.call(_ingest, gateway.app, ctx, results, token, endpoint, message)
+    results.finish()
+    GpsPoint.objects.filter(ride_id=ride_id, recorded_at__gte=began).delete()
+    return results
+
+
+async def _ingest(app, ctx, results, token, endpoint, message):
+    socket = await _Socket(app, f'/ws/gps?token={token}').connect()
+    try:
+        for round_ in range(ctx.requests):
+            messages = [message(round_ * INGEST_BATCH + i) for i in range(INGEST_BATCH)]
+            started = time.perf_counter()
+            for data in messages:
+                (socket.send_bytes if isinstance(data, bytes) else socket.send_text)(data)
+            # Handled in order, so this error reply comes back once the batch went through.
+            socket.send_text('null')
+            _, reply = await socket.receive()
+            ms = (time.perf_counter() - started) * 1000 / INGEST_BATCH
+            results.add(endpoint, ms, 0, 200 if json.loads(reply) == {'error': 'Expected a JSON object'} else 500)
+    finally:
+        await socket.close()
+
+
+def trail_ingest(ctx):
+    """Sustained GPS persistence: ``ctx.trail_rate`` fixes/s submitted to a ``TrailWriter`` for ``ctx.trail_seconds``.
+
+    Fixes go to the writer the way the websocket handler hands them over, spread
+    over the upcoming rides, and the writer stores them in the configured
+    database. Every batch write is a sample; the checks report the points
+    flushed per second while the load lasted, the points dropped because the
+    queue was full and the deepest the queue got.
+    """
+    # Points the gateway's pools at Django's database.
+    _gateway_app()
+    results = Results()
+    began = timezone.now()
+    ride_ids = [ride[0] for ride in ctx.upcoming[:100]]
+    asyncio.run(_feed_trail(ctx, results, ride_ids))
+    results.finish()
+    GpsPoint.objects.filter(ride_id__in=ride_ids, recorded_at__gte=began).delete()
+    return results
+
+
+async def _feed_trail(ctx, results, ride_ids):
+    from fastapi_app import db, ingest
+
+    pool = db.create_pool()
+    await pool.open()
+    writer = ingest.TrailWriter(pool)
+    writer.start()
+    loop = asyncio.get_running_loop()
+    endpoint = f'trail batch write at {ctx.trail_rate} fixes/s'
+    sent = peak = flushes = 0
+    started = loop.time()
+    try:
+        while (elapsed := loop.time() - started) < ctx.trail_seconds:
+            # Catch up to the rate whenever the loop got to run late.
+            due = int(elapsed * ctx.trail_rate) - sent
+            writer.submit([{'ride_id': ride_ids[(sent + i) % len(ride_ids)], 'lat': 6.5 + (sent + i) * 1e-7,
+                            'lon': 3.4, 'heading': 90.0, 'speed': 12.0, 'timestamp': time.time()}
+                           for i in range(due)])
+            sent += due
+            peak = max(peak, writer.queue.qsize())
+            if writer.flushes != flushes:
+                # Polled, so a tick with two flushes records the later one only.
+                flushes = writer.flushes
+                results.add(endpoint, writer.last_flush_ms, 1, 200)
+            await asyncio.sleep(0.01)
+        flushed = writer.flushed
+    finally:
+        await writer.stop()
+        await pool.close()
+    results.checks = {
+        'submitted': sent,
+        'flushed_per_s': round(flushed / ctx.trail_seconds, 1),
+        'dropped': writer.dropped,
+        'peak_queue': peak,
+        'queue_capacity': writer.queue.maxsize,
+        'failed_batches': writer.failed_batches,
+    }
+
+
+def positions(ctx):
+    """The gateway's ``PositionStore`` tracking ``POSITION_VEHICLES`` moving vehicles, and radius queries on it.
+
+    Vehicles start spread over a ~40 km square and every update moves one a
+    few dozen meters, so some cross grid cells. Updates are timed per batch of
+    ``POSITION_BATCH`` (a single upsert takes microseconds); ``nearby()`` is
+    timed per call at 1 km and 5 km, from random points in the square.
+    """
+    from fastapi_app.positions import PositionStore
+
+    results = Results()
+    rng = ctx.rng
+    store = PositionStore()
+    now = time.time()
+    fixes = [{'ride_id': ride_id, 'lat': 6.3 + rng.random() * 0.36, 'lon': 3.2 + rng.random() * 0.36,
+              'heading': 0.0, 'speed': 10.0, 'timestamp': now} for ride_id in range(1, POSITION_VEHICLES + 1)]
+    started = time.perf_counter()
+    for fix in fixes:
+        store.update(fix)
+    results.checks['initial_upserts_per_s'] = round(len(fixes) / (time.perf_counter() - started))
+
+    endpoint = f'PositionStore.update x{POSITION_BATCH}'
+    upserts, upsert_seconds = 0, 0.0
+    for round_ in range(ctx.requests):
+        batch = []
+        for fix in rng.sample(fixes, POSITION_BATCH):
+            fix = dict(fix, lat=fix['lat'] + rng.uniform(-3e-4, 3e-4), lon=fix['lon'] + rng.uniform(-3e-4, 3e-4),
+                       timestamp=now + round_ + 1)
+            fixes[fix['ride_id'] - 1] = fix
+            batch.append(fix)
+        started = time.perf_counter()
+        for fix in batch:
+            store.update(fix)
+        elapsed = time.perf_counter() - started
+        upserts, upsert_seconds = upserts + len(batch), upsert_seconds + elapsed
+        results.add(endpoint, elapsed * 1000, 0, 200)
+        for radius in (1000, 5000):
+            lat, lon = 6.3 + rng.random() * 0.36, 3.2 + rng.random() * 0.36
+            started = time.perf_counter()
+            found = store.nearby(lat, lon, radius, limit=50)
+            results.add(f'PositionStore.nearby {radius // 1000} km', (time.perf_counter() - started) * 1000, 0,
+                        200 if found else 404)
+    results.checks['upserts_per_s'] = round(upserts / upsert_seconds)
+    results.checks['vehicles'] = len(store)
+    return results.finish()
+
+
+def gps_frames(ctx):
+    """The same fixes as JSON messages and as one binary frame (``fastapi_app.frames``): CPU and bytes per fix.
+
+    JSON is what the gateway sends subscribers that didn't opt into frames:
+    one ``{"ride_id": ..., "gps": {...}}`` message per fix, serialized like
+    Starlette's ``send_json``; decoding it validates the fix, as
+    ``frames.decode`` does. Every round times each codec on a batch of
+    ``FRAME_BATCH`` fixes; the checks give microseconds and bytes per fix.
+    """
+    from fastapi_app import frames
+
+    results = Results()
+    rng = ctx.rng
+    totals = defaultdict(float)
+    size = {}
+
+    def dumps(fix):
+        return json.dumps({'ride_id': fix['ride_id'], 'gps': fix}, separators=(',', ':'), ensure_ascii=False)
+
+    codecs = {
+        'JSON': (lambda batch: [dumps(fix) for fix in batch],
+                 lambda messages: [frames.fix_from_json(json.loads(message)['gps']) for message in messages]),
+        'binary': (frames.encode, frames.decode),
+    }
+    for _ in range(ctx.requests):
+        now = time.time()
+        batch = [frames.fix_from_json({'ride_id': rng.randrange(1, 10 ** 6), 'lat': 6.3 + rng.random() * 0.36,
+                                       'lon': 3.2 + rng.random() * 0.36, 'heading': rng.uniform(0, 360),
+                                       'speed': rng.uniform(0, 30), 'timestamp': now})
+                 for _ in range(FRAME_BATCH)]
+        for name, (encode, decode) in codecs.items():
+            started = time.perf_counter()
+            encoded = encode(batch)
+            encoded_at = time.perf_counter()
+            decoded = decode(encoded)
+            decoded_at = time.perf_counter()
+            results.add(f'{name} encode x{FRAME_BATCH}', (encoded_at - started) * 1000, 0, 200)
+            results.add(f'{name} decode x{FRAME_BATCH}', (decoded_at - encoded_at) * 1000, 0,
+                        200 if len(decoded) == FRAME_BATCH else 500)
+            totals[f'{name} encode'] += encoded_at - started
+            totals[f'{name} decode'] += decoded_at - encoded_at
+            size[name] = sum(map(len, encoded)) if isinstance(encoded, list) else len(encoded)
+    fixes = ctx.requests * FRAME_BATCH
+    for name in codecs:
+        for step in ('encode', 'decode'):
+            results.checks[f'{name.lower()}_{step}_us_per_fix'] = round(totals[f'{name} {step}'] * 1e6 / fixes, 2)
+        results.checks[f'{name.lower()}_bytes_per_fix'] = round(size[name] / FRAME_BATCH, 1)
+    return results.finish()
+
+
+class _Socket:
+    """A websocket client calling the gateway's ASGI app directly, in the app's event loop.
+
+    Thousands of them need no threads or network sockets, and the app's
+    messages are timestamped as it hands them over, so latencies measure the
+    application like the rest of this module.
+    """
+
+    def __init__(self, app, url, subprotocols=()):
+        path, _, query = url.partition('?')
+        self.app = app
+        self.scope = {
+            'type': 'websocket', 'asgi': {'version': '3.0'}, 'scheme': 'ws', 'http_version': '1.1',
+            'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': query.encode(),
+            'headers': [(b'host', b'testserver')], 'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+            'subprotocols': list(subprotocols), 'state': {},
+        }
+        self._incoming = asyncio.Queue()
+        self._outgoing = asyncio.Queue()
+        self._task = None
+
+    async def connect(self):
+        self._incoming.put_nowait({'type': 'websocket.connect'})
+        self._task = asyncio.create_task(self.app(self.scope, self._incoming.get, self._send))
+        _, message = await self._outgoing.get()
+        if message['type'] != 'websocket.accept':
+            raise RuntimeError(f"{self.scope['path']} refused the connection: {message}")
+        return self
+
+    async def _send(self, message):
+        self._outgoing.put_nowait((time.perf_counter(), message))
+
+    def send_text(self, text):
+        self._incoming.put_nowait({'type': 'websocket.receive', 'text': text})
+
+    def send_bytes(self, data):
+        self._incoming.put_nowait({'type': 'websocket.receive', 'bytes': data})
+
+    async def receive(self):
+        """``(perf_counter() when the app sent it, text or bytes)`` of the next message."""
+        at, message = await self._outgoing.get()
+        if message['type'] != 'websocket.send':
+            raise RuntimeError(f"{self.scope['path']} closed the connection: {message}")
+        return at, message['text'] if message.get('text') is not None else message['bytes']
+
+    async def close(self):
+        # Let the app finish sends already handed over, as it would before a client's close arrived.
+        await asyncio.sleep(0)
+        self._incoming.put_nowait({'type': 'websocket.disconnect', 'code': 1000})
+        await self._task
+
+
+def _gateway_app():
+    """The gateway app, pointed at Django's database."""
+    from fastapi_app import db, main
+
+    database = settings.DATABASES['default']
+    if connection.vendor == 'sqlite':
+        db.DOCKER_ENV, db.DATABASE = None, str(database['NAME'])
+    else:
+        db.DOCKER_ENV = '1'
+        db.DB_CONFIG = {
+            'dbname': database['NAME'], 'user': database['USER'], 'password': database['PASSWORD'],
+            'host': database['HOST'], 'port': database['PORT'],
+        }
+    return main.app
+
+
+def run(name, ctx):
+    """Run scenario ``name`` from a cold cache, with random choices that don't depend on the other scenarios run."""
+    caches['default'].clear()
+    ctx.rng = random.Random(f'{ctx.seed}:{name}')
+    return SCENARIOS[name](ctx).summary()
+
+
+SCENARIOS = {
+    'ride_list': ride_list,
+    'cache_reads': cache_reads,
+    'search': search,
+    'search_scale': search_scale,
+    'booking_burst': booking_burst,
+    'bulk_writes': bulk_writes,
+    'profile': profile,
+    'gps_fanout': gps_fanout,
+    'gps_ingest': gps_ingest,
+    'trail_ingest': trail_ingest,
+    'positions': positions,
+    'gps_frames': gps_frames,
+}
+
+
+def compare(current, baseline, threshold):
+    """Regressions of ``current`` against ``baseline`` (both ``bench`` JSON), as readable lines.
+
+    An endpoint regresses when its p95 latency grows, or its throughput drops,
+    by more than ``threshold`` (a fraction), or when it makes more queries
+    (beyond ``QUERY_TOLERANCE``).
+    """
+    if baseline.get('meta', {}).get('scenario_version') != current['meta']['scenario_version']:
+        return ["Baseline was recorded with a different scenario version; not comparable."]
+    regressions = []
+    for name, scenario in current['scenarios'].items():
+        base_scenario = baseline['scenarios'].get(name)
+        if base_scenario is None:
+            continue
+        for endpoint, stats in scenario['endpoints'].items():
+            base = base_scenario['endpoints'].get(endpoint)
+            if base is None:
+                continue
+            label = f"{name} {endpoint}"
+            if stats['p95_ms'] > base['p95_ms'] * (1 + threshold):
+                regressions.append(f"{label}: p95 {base['p95_ms']} -> {stats['p95_ms']} ms")
+            if stats['rps'] < base['rps'] * (1 - threshold):
+                regressions.append(f"{label}: {base['rps']} -> {stats['rps']} req/s")
+            if stats['queries_mean'] > base['queries_mean'] + QUERY_TOLERANCE:
+                regressions.append(f"{label}: {base['queries_mean']} -> {stats['queries_mean']} queries per request")
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,68 @@
+"""Helpers for the bulk create endpoints.
+
+A bulk payload is a JSON list validated with one ``many=True`` serializer.
+Items succeed or fail individually, and the response reports each one by
+its position in the payload.
+"""
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+BULK_MAX_ITEMS = 500
+
+
+def bulk_items(data):
+    if not isinstance(data, list) or not data:
+        raise ValidationError("Expected a non-empty list of objects.")
+    if len(data) > BULK_MAX_ITEMS:
+        raise ValidationError(f"At most {BULK_MAX_ITEMS} objects per request.")
+    return data
+
+
+def referenced_ids(items, field):
+    """Integer ids that ``items`` refer to through ``field``, for loading them with one query."""
+    ids = set()
+    for item in items:
+        if isinstance(item, dict):
+            try:
+                ids.add(int(item.get(field)))
+            except (TypeError, ValueError):
+                pass
+    return ids
+
+
+def validate_items(serializer_class, items, context):
+    """Validate ``items``; returns ``({index: validated_data}, {index: errors})``."""
+    serializer = serializer_class(data=items, many=True, context=context)
+    if serializer.is_valid():
+        return dict(enumerate(serializer.validated_data)), {}
+    errors = _item_errors(serializer.errors)
+    # A ListSerializer keeps no validated data once any item fails, so run the good ones again.
+    good = [index for index in range(len(items)) if index not in errors]
+    serializer = serializer_class(data=[items[index] for index in good], many=True, context=context)
+    if not serializer.is_valid():
+        errors.update((good[index], error) for index, error in _item_errors(serializer.errors).items())
+        return {}, errors
+    return dict(zip(good, serializer.validated_data)), errors
+
+
+def _item_errors(errors):
+    # Depending on the DRF version, list errors are a list with an entry per item or a dict of failing indexes.
+    if isinstance(errors, dict):
+        return dict(errors)
+    return {index: error for index, error in enumerate(errors) if error}
+
+
+def bulk_response(count, created, errors):
+    """``created`` maps payload index to the new object's id, ``errors`` to its validation errors."""
+    results = [
+        {"index": index, "id": created[index]} if index in created else {"index": index, "errors": errors[index]}
+        for index in range(count)
+    ]
+    if not created:
+        code = status.HTTP_400_BAD_REQUEST
+    elif errors:
+        code = status.HTTP_207_MULTI_STATUS
+    else:
+        code = status.HTTP_201_CREATED
+    return Response({"created": len(created), "failed": len(errors), "results": results}, status=code)
@@ -0,0 +1,123 @@
+"""Read-through cache for ride responses.
+
+Cached entries are addressed by generation numbers rather than deleted:
+
+- every ride has its own generation, covering its detail and availability
+  responses;
+- all ride list responses share one list generation, plus a digest of the
+  query string.
+
+``invalidate_rides`` (called from the Ride/Booking/User signals once the
+transaction commits) bumps the rides' generations and the list generation, so
+stale entries simply stop being looked up and age out of the backend. It also
+bumps the ``rides`` ``CacheGeneration`` row the gateway's ``/search`` cache
+checks.
+Generations start from the current time in milliseconds, so a generation key
+that was evicted never comes back at a number that old entries still use.
+
+Async views read through ``lookup``, which finds the generation and the entry
+in one call: the bundled cache backends implement the async API as a thread
+hop per call, so one ``sync_to_async(lookup)`` costs half as much.
+"""
+import hashlib
+import time
+
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import CacheGeneration
+
+CACHE_ALIAS = 'default'
+# Bump when the shape of cached ride responses changes.
+KEY_VERSION = 1
+LIST_GENERATION_KEY = 'rides:list:generation'
+SCHEDULE_GENERATION_KEY = 'schedules:generation'
+
+stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def _cache():
+    return caches[CACHE_ALIAS]
+
+
+def _ride_generation_key(ride_id):
+    return f'rides:{ride_id}:generation'
+
+
+def generation(key):
+    cache = _cache()
+    value = cache.get(key, version=KEY_VERSION)
+    if value is None:
+        value = int(time.time() * 1000)
+        if not cache.add(key, value, timeout=None, version=KEY_VERSION):
+            value = cache.get(key, version=KEY_VERSION)
+    return value
+
+
+def _bump(key):
+    cache = _cache()
+    try:
+        cache.incr(key, version=KEY_VERSION)
+    except ValueError:
+        # Missing: the next read starts a fresh generation.
+        pass
+
+
+def list_key(request, window):
+    """Key for a ride list response; includes the host because ``next`` links are absolute.
+
+    ``window`` is ``schedules.window_state()``: lists show schedule occurrences from now on.
+    """
+    params = sorted((k, v) for k, values in request.query_params.lists() for v in values)
+    digest = hashlib.md5(repr((request.get_host(), window, params)).encode()).hexdigest()
+    return f'rides:list:{generation(LIST_GENERATION_KEY)}:{digest}'
+
+
+def ride_key(kind, ride_id):
+    return f'rides:{ride_id}:{kind}:{generation(_ride_generation_key(ride_id))}'
+
+
+def get(key):
+    data = _cache().get(key, version=KEY_VERSION)
+    stats['hits' if data is not None else 'misses'] += 1
+    return data
+
+
+def lookup(make_key, *args):
+    """``(key, cached data or None)`` for ``make_key(*args)``, e.g. ``lookup(ride_key, 'detail', 1)``."""
+    key = make_key(*args)
+    return key, get(key)
+
+
+def put(key, data):
+    _cache().set(key, data, version=KEY_VERSION)
+
+
+async def aput(key, data):
+    await _cache().aset(key, data, version=KEY_VERSION)
+
+
+def invalidate_rides(ride_ids, using=None):
+    """Forget cached responses that include any of ``ride_ids``, once the current transaction commits."""
+    ride_ids = list(ride_ids)
+    if not ride_ids:
+        return
+
+    def bump():
+        stats['invalidations'] += 1
+        for ride_id in ride_ids:
+            _bump(_ride_generation_key(ride_id))
+        _bump(LIST_GENERATION_KEY)
+        CacheGeneration.bump(CacheGeneration.RIDES, using=using)
+
+    transaction.on_commit(bump, using=using)
+
+
+def invalidate_schedules(using=None):
+    """Forget expanded schedule occurrences and the ride lists showing them."""
+    def bump():
+        stats['invalidations'] += 1
+        _bump(SCHEDULE_GENERATION_KEY)
+        _bump(LIST_GENERATION_KEY)
+
+    transaction.on_commit(bump, using=using)
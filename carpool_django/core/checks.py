@@ -0,0 +1,24 @@
+"""System checks for settings the app relies on but Django can't validate (``manage.py check``)."""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Error, Tags, register
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """The default cache must be shared when several workers serve the API.
+
+    Ride response invalidations (core.caching) and replica pins
+    (core.replicas) are written to it; with a per-process cache they only
+    reach the worker that made them, and the others keep serving stale rides
+    until the entries time out.
+    """
+    if settings.CARPOOL_WORKERS > 1 and isinstance(caches['default'], LocMemCache):
+        return [Error(
+            f"The default cache is a per-process LocMemCache, but {settings.CARPOOL_WORKERS} workers serve the API.",
+            hint="Set CARPOOL_CACHE_BACKEND and CARPOOL_CACHE_LOCATION to a shared cache such as Redis, "
+                 "or serve the API with one worker.",
+            id='core.E001',
+        )]
+    return []
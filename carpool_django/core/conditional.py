@@ -0,0 +1,108 @@
+"""Conditional GET (``If-None-Match`` / ``If-Modified-Since``) for API views.
+
+Validators come from ``updated_at`` columns so a ``304`` can be answered
+before the object is loaded or serialized:
+
+- a single object: its ``updated_at``;
+- a list: ``MAX(updated_at)`` and ``COUNT(*)`` over the filtered queryset,
+  which changes on every insert, update and delete.
+
+ETags also cover the query string, host and renderer, since those shape the
+body. Lists get no ``Last-Modified``: deleting a row doesn't move
+``MAX(updated_at)``, so only the ETag can tell.
+"""
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+
+def make_etag(request, *parts):
+    params = sorted((k, v) for k, values in request.query_params.lists() for v in values)
+    fingerprint = (request.get_host(), request.path, request.accepted_renderer.format, params) + parts
+    return '"%s"' % hashlib.md5(repr(fingerprint).encode()).hexdigest()
+
+
+def object_validators(request, queryset, pk):
+    """``(etag, last_modified)`` for one row, or ``(None, None)`` if it doesn't exist."""
+    if not str(pk).isdigit():
+        return None, None
+    return _object_validators(request, pk, queryset.filter(pk=pk).values_list('updated_at', flat=True).first())
+
+
+async def aobject_validators(request, queryset, pk):
+    if not str(pk).isdigit():
+        return None, None
+    return _object_validators(request, pk, await queryset.filter(pk=pk).values_list('updated_at', flat=True).afirst())
+
+
+def _object_validators(request, pk, updated_at):
+    if updated_at is None:
+        return None, None
+    return make_etag(request, pk, updated_at.isoformat()), updated_at
+
+
+def list_validators(request, queryset, *parts):
+    """``parts`` covers anything else the list shows, e.g. ride schedule occurrences."""
+    stats = queryset.order_by().aggregate(last=Max('updated_at'), count=Count('pk'))
+    return _list_validators(request, stats, parts)
+
+
+async def alist_validators(request, queryset, *parts):
+    stats = await queryset.order_by().aaggregate(last=Max('updated_at'), count=Count('pk'))
+    return _list_validators(request, stats, parts)
+
+
+def _list_validators(request, stats, parts):
+    last = stats['last'].isoformat() if stats['last'] else None
+    return make_etag(request, last, stats['count'], *parts), None
+
+
+def conditional(request, validators, render):
+    """Return 304 if the client's copy is current, otherwise ``render()`` with validators attached.
+
+    ``validators`` is a callable returning ``(etag, last_modified)``; it only
+    runs for GET/HEAD.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return render()
+    etag, last_modified = validators()
+    not_modified = _not_modified(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+    return _attach(render(), etag, last_modified)
+
+
+async def aconditional(request, validators, render):
+    """``conditional`` for async views: ``validators`` and ``render`` are coroutine functions."""
+    if request.method not in ('GET', 'HEAD'):
+        return await render()
+    etag, last_modified = await validators()
+    not_modified = _not_modified(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+    return _attach(await render(), etag, last_modified)
+
+
+def _timestamp(last_modified):
+    # HTTP dates have one-second resolution.
+    return int(last_modified.timestamp()) if last_modified else None
+
+
+def _not_modified(request, etag, last_modified):
+    if etag is None:
+        return None
+    request = getattr(request, '_request', request)
+    not_modified = get_conditional_response(request, etag=etag, last_modified=_timestamp(last_modified))
+    if not_modified is not None:
+        not_modified['ETag'] = etag
+    return not_modified
+
+
+def _attach(response, etag, last_modified):
+    if etag is not None and response.status_code == 200:
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(_timestamp(last_modified))
+    return response
@@ -0,0 +1,84 @@
+"""Per-request latency, query and response-size metrics for the Django API.
+
+``MetricsMiddleware`` (first in ``MIDDLEWARE``) times every request and
+records it under its route: the URL pattern's name, e.g. ``ride-detail``, so
+``/api/rides/1/`` and ``/api/rides/2/`` share one series. Queries reach the
+current request's stats through an ``execute_wrapper`` installed on each
+database connection when it is created, which also works for queries run
+by async views in ``sync_to_async`` threads. ``/metrics`` serves the
+registry in the Prometheus text format; ``/api/metrics/slow-queries/`` lists
+the latest queries slower than ``CARPOOL_SLOW_QUERY_MS`` (admins only).
+"""
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+
+from carpool_common import metrics
+
+registry = metrics.Registry()
+queries = metrics.QueryLog(settings.CARPOOL_SLOW_QUERY_MS, ignore=(__file__,))
+requests = metrics.RequestMetrics(registry, queries)
+
+
+def _record_query(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries.record(sql, time.perf_counter() - started)
+
+
+def install_query_hook(sender, connection, **kwargs):
+    # connection_created fires again after every reconnect of the same wrapper.
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+connection_created.connect(install_query_hook, dispatch_uid='core.instrumentation.install_query_hook')
+
+
+def _route(request):
+    match = request.resolver_match
+    if match is None:
+        return metrics.UNMATCHED
+    return match.view_name or match.route
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        with metrics.track(f'{request.method} {request.path}') as stats:
+            response = self.get_response(request)
+        self._observe(request, response, started, stats)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with metrics.track(f'{request.method} {request.path}') as stats:
+            response = await self.get_response(request)
+        self._observe(request, response, started, stats)
+        return response
+
+    def _observe(self, request, response, started, stats):
+        # A streamed body is produced after the middleware returns; its size is left out.
+        size = None if response.streaming else len(response.content)
+        requests.observe(_route(request), request.method, response.status_code,
+                         time.perf_counter() - started, size, stats)
+
+
+def metrics_view(request):
+    return HttpResponse(registry.render(), content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,103 @@
+import json
+import subprocess
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from core import benchmarks
+from core.models import Booking, Ride, User, Vehicle
+
+
+def _sizes(value):
+    return [int(size) for size in value.split(',')]
+
+
+class Command(BaseCommand):
+    help = ("Run benchmark scenarios in process against the seeded data (see `manage.py seed_bench`) and "
+            "report p50/p95/p99 latency, throughput and queries per endpoint. --output stores the results "
+            "as JSON; --compare fails when an endpoint regressed past --threshold against a stored run.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', action='append', dest='scenarios', choices=sorted(benchmarks.SCENARIOS),
+                            help="Scenario to run (repeatable). Default: all.")
+        parser.add_argument('--requests', type=int, default=200, help="Iterations per scenario.")
+        parser.add_argument('--concurrency', type=int, default=8, help="Threads for booking_burst.")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--search-sizes', type=_sizes, default=benchmarks.SEARCH_SIZES,
+                            help="Comma-separated ride counts search_scale grows the table to "
+                                 "(default: 10000,100000,1000000).")
+        parser.add_argument('--subscribers', type=_sizes, default=benchmarks.SUBSCRIBERS,
+                            help="Comma-separated websocket subscriber counts for gps_fanout (default: 1000,5000).")
+        parser.add_argument('--trail-rate', type=int, default=benchmarks.TRAIL_RATE,
+                            help=f"Fixes per second trail_ingest submits (default: {benchmarks.TRAIL_RATE}).")
+        parser.add_argument('--trail-seconds', type=float, default=benchmarks.TRAIL_SECONDS,
+                            help=f"How long trail_ingest keeps submitting (default: {benchmarks.TRAIL_SECONDS}).")
+        parser.add_argument('--output', help="Write the results to this JSON file.")
+        parser.add_argument('--compare', help="JSON results of an earlier run to check for regressions.")
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help="Allowed p95/throughput change before an endpoint counts as regressed (0.2 = 20%%).")
+
+    def handle(self, *args, **options):
+        try:
+            ctx = benchmarks.Context(options['requests'], options['seed'], options['concurrency'],
+                                     options['search_sizes'], options['subscribers'],
+                                     options['trail_rate'], options['trail_seconds'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        report = {'meta': self._meta(options), 'scenarios': {}}
+        for name in options['scenarios'] or benchmarks.SCENARIOS:
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{name}"))
+            summary = benchmarks.run(name, ctx)
+            report['scenarios'][name] = summary
+            self._print(summary)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}.")
+        if options['compare']:
+            regressions = benchmarks.compare(report, benchmarks.load(options['compare']), options['threshold'])
+            for line in regressions:
+                self.stderr.write(line)
+            if regressions:
+                raise CommandError(f"{len(regressions)} regression(s) against {options['compare']}.")
+            self.stdout.write(self.style.SUCCESS(f"No regressions against {options['compare']}."))
+
+    def _meta(self, options):
+        try:
+            commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                    cwd=settings.BASE_DIR).stdout.strip() or None
+        except OSError:
+            commit = None
+        return {
+            'scenario_version': benchmarks.SCENARIO_VERSION,
+            'recorded_at': timezone.now().isoformat(),
+            'commit': commit,
+            'database': connection.vendor,
+            'requests': options['requests'],
+            'concurrency': options['concurrency'],
+            'seed': options['seed'],
+            'search_sizes': list(options['search_sizes']),
+            'subscribers': list(options['subscribers']),
+            'trail_rate': options['trail_rate'],
+            'trail_seconds': options['trail_seconds'],
+            'settings': {name: getattr(settings, name, None)
+                         for name in ('DEBUG', 'CARPOOL_ASYNC_READS', 'CARPOOL_CLAIMS_AUTH')},
+            'data': {model.__name__: model.objects.count() for model in (User, Vehicle, Ride, Booking)},
+        }
+
+    def _print(self, summary):
+        self.stdout.write(f"  {summary['requests']} requests in {summary['wall_s']:.1f}s "
+                          f"({summary['throughput_rps']} req/s)")
+        for endpoint, stats in summary['endpoints'].items():
+            statuses = ' '.join(f"{status}x{count}" for status, count in sorted(stats['statuses'].items()))
+            self.stdout.write(
+                f"  {endpoint:<40} p50 {stats['p50_ms']:>7.1f}  p95 {stats['p95_ms']:>7.1f}  "
+                f"p99 {stats['p99_ms']:>7.1f} ms  {stats['rps']:>7.1f} req/s  "
+                f"{stats['queries_mean']:>5.1f} queries  [{statuses}]"
+            )
+        for check, value in summary['checks'].items():
+            self.stdout.write(f"  {check}: {value}")
@@ -0,0 +1,57 @@
+import resource
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import export
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+class Command(BaseCommand):
+    help = ("Time the streaming exports (core.export) against the configured database and report rows/s, "
+            "MB/s and peak RSS. Memory should not grow with the number of rows; pass --materialize to "
+            "compare with loading the same rows into a list first.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dataset', action='append', dest='datasets', choices=sorted(export.DATASETS),
+                            help="Dataset to export (repeatable). Default: all.")
+        parser.add_argument('--format', action='append', dest='formats', choices=sorted(export.ENCODERS),
+                            help="Encoding (repeatable). Default: all.")
+        parser.add_argument('--chunk-size', type=int, default=export.CHUNK_SIZE)
+        parser.add_argument('--since', help="Watermark, as for ?since=.")
+        parser.add_argument('--materialize', action='store_true',
+                            help="Also time list(queryset) + encode, as a non-streaming export would.")
+
+    def handle(self, *args, **options):
+        since, since_id = export.parse_since(options['since'])
+        self.stdout.write(f"peak RSS before: {_peak_rss_mb():.1f} MB")
+        for dataset in options['datasets'] or export.DATASETS:
+            fields = export.DATASETS[dataset][1]
+            for encoding in options['formats'] or export.ENCODERS:
+                encoder = export.ENCODERS[encoding](fields)
+                queryset = export.rows(dataset, since, since_id)
+                rows = queryset.count()
+                self._report(f"{dataset}.{encoding}", rows,
+                             lambda: export.stream(queryset, encoder, options['chunk_size']))
+                if options['materialize']:
+                    self._report(f"{dataset}.{encoding} (list)", rows,
+                                 lambda: [encoder.encode(list(queryset.all()))])
+
+    def _report(self, label, rows, chunks):
+        rss_before = _peak_rss_mb()
+        started = time.perf_counter()
+        size = 0
+        for chunk in chunks():
+            size += len(chunk)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"  {label:<24} {rows:>9} rows in {elapsed:6.2f}s  {rows / elapsed if elapsed else 0:>9.0f} rows/s  "
+            f"{size / elapsed / 1e6 if elapsed else 0:>6.1f} MB/s  peak RSS {_peak_rss_mb():.1f} MB "
+            f"(+{_peak_rss_mb() - rss_before:.1f})"
+        )
@@ -0,0 +1,118 @@
+import math
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from carpool_common import routes
+from core.benchmarks import percentile
+from core.models import Ride, User
+
+# Area the synthetic corridors are drawn in (roughly south-west Nigeria).
+BOUNDS = ((6.2, 9.0), (2.8, 6.0))
+
+
+def _along(start, end, fraction, jitter_m, rng):
+    """A point ``fraction`` of the way from ``start`` to ``end``, moved up to ``jitter_m`` off the line."""
+    lat = start[0] + (end[0] - start[0]) * fraction
+    lon = start[1] + (end[1] - start[1]) * fraction
+    offset = rng.uniform(-jitter_m, jitter_m) / routes.METERS_PER_DEGREE
+    return lat + offset, lon + offset / max(math.cos(math.radians(lat)), 1e-6)
+
+
+class Command(BaseCommand):
+    help = ("Time route matching (RideQuerySet.along_route) against checking every ride in the "
+            "departure window, on synthetic corridors. Runs in a transaction that is rolled back "
+            "unless --keep is given.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rides', type=int, default=100_000)
+        parser.add_argument('--corridors', type=int, default=20)
+        parser.add_argument('--queries', type=int, default=100)
+        parser.add_argument('--radius', type=float, default=routes.DEFAULT_RADIUS_M)
+        parser.add_argument('--window-hours', type=float, default=24,
+                            help="Departure window of each query.")
+        parser.add_argument('--days', type=int, default=30, help="Spread departures over this many days.")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--keep', action='store_true', help="Commit the synthetic rides.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        with transaction.atomic():
+            self._run(rng, options)
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+    def _run(self, rng, options):
+        (lat_lo, lat_hi), (lon_lo, lon_hi) = BOUNDS
+        corridors = []
+        while len(corridors) < options['corridors']:
+            start = (rng.uniform(lat_lo, lat_hi), rng.uniform(lon_lo, lon_hi))
+            end = (rng.uniform(lat_lo, lat_hi), rng.uniform(lon_lo, lon_hi))
+            if 30_000 <= routes.distance_m(*start, *end) <= 150_000:
+                corridors.append((start, end))
+
+        driver, _ = User.objects.get_or_create(username='route-bench')
+        now = timezone.now()
+        started = time.perf_counter()
+        batch = []
+        for _ in range(options['rides']):
+            start, end = rng.choice(corridors)
+            a, b = sorted(rng.uniform(0, 1) for _ in range(2))
+            if rng.random() < 0.5:
+                start, end, a, b = end, start, 1 - b, 1 - a
+            origin = _along(start, end, a, 300, rng)
+            destination = _along(start, end, b, 300, rng)
+            waypoints = [
+                list(_along(start, end, f, 1000, rng))
+                for f in sorted(rng.uniform(a, b) for _ in range(rng.randint(0, 3)))
+            ]
+            batch.append(Ride(
+                driver=driver, origin='Synthetic origin', destination='Synthetic destination',
+                origin_lat=origin[0], origin_lon=origin[1],
+                destination_lat=destination[0], destination_lon=destination[1], waypoints=waypoints,
+                departure_time=now + timedelta(seconds=rng.uniform(0, options['days'] * 86400)),
+                available_seats=4,
+            ))
+            if len(batch) == 2000:
+                Ride.objects.bulk_create(batch)
+                batch = []
+        Ride.objects.bulk_create(batch)
+        self.stdout.write(f"Seeded {options['rides']} rides on {len(corridors)} corridors "
+                          f"in {time.perf_counter() - started:.1f}s.")
+
+        radius = options['radius']
+        window = timedelta(hours=options['window_hours'])
+        indexed, scanned, matched = [], [], []
+        for _ in range(options['queries']):
+            start, end = rng.choice(corridors)
+            a, b = sorted(rng.uniform(0, 1) for _ in range(2))
+            pickup, dropoff = _along(start, end, a, 500, rng), _along(start, end, b, 500, rng)
+            after = now + timedelta(seconds=rng.uniform(0, options['days'] * 86400))
+            before = after + window
+            rides = Ride.objects.filter(departure_time__gte=after, departure_time__lt=before)
+
+            t0 = time.perf_counter()
+            found = set(rides.along_route(pickup, dropoff, radius, after, before).values_list('pk', flat=True))
+            t1 = time.perf_counter()
+            expected = {
+                pk for pk, *route in rides.values_list('pk', *routes.COLUMNS)
+                if routes.match(routes.route_points(*route), pickup, dropoff, radius)
+            }
+            t2 = time.perf_counter()
+            if found != expected:
+                self.stderr.write(f"Mismatch for {pickup} -> {dropoff}: {len(found)} vs {len(expected)} rides")
+            indexed.append((t1 - t0) * 1000)
+            scanned.append((t2 - t1) * 1000)
+            matched.append(len(found))
+
+        for name, timings in (('grid', indexed), ('window scan', scanned)):
+            self.stdout.write(f"{name:>11}: p50 {percentile(timings, 50):.1f} ms  "
+                              f"p95 {percentile(timings, 95):.1f} ms  max {max(timings):.1f} ms")
+        self.stdout.write(self.style.SUCCESS(
+            f"{options['queries']} queries, {statistics.mean(matched):.1f} matching rides on average."
+        ))
@@ -0,0 +1,53 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from core.models import GpsPoint
+
+
+class Command(BaseCommand):
+    help = "Downsample old GPS trails to one point per ride per bucket and drop points past retention."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-hours', type=float, default=24,
+                            help="Only compact points recorded before this many hours ago.")
+        parser.add_argument('--bucket-seconds', type=int, default=30,
+                            help="Keep the first point of every bucket of this many seconds.")
+        parser.add_argument('--retention-days', type=float, default=None,
+                            help="Delete points older than this many days outright.")
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        chunk_size = options['chunk_size']
+
+        expired = 0
+        if options['retention_days'] is not None:
+            cutoff = now - timedelta(days=options['retention_days'])
+            expired, _ = GpsPoint.objects.filter(recorded_at__lt=cutoff).delete()
+
+        cutoff = now - timedelta(hours=options['older_than_hours'])
+        bucket = options['bucket_seconds']
+        old = GpsPoint.objects.filter(recorded_at__lt=cutoff)
+        ride_ids = old.order_by().values_list('ride_id', flat=True).distinct()
+
+        compacted = 0
+        for ride_id in list(ride_ids):
+            points = old.filter(ride_id=ride_id).order_by('recorded_at', 'id').values_list('id', 'recorded_at')
+            doomed = []
+            last_bucket = None
+            for point_id, recorded_at in points.iterator(chunk_size=chunk_size):
+                current = int(recorded_at.timestamp()) // bucket
+                if current == last_bucket:
+                    doomed.append(point_id)
+                last_bucket = current
+            for start in range(0, len(doomed), chunk_size):
+                with transaction.atomic():
+                    GpsPoint.objects.filter(id__in=doomed[start:start + chunk_size]).delete()
+            compacted += len(doomed)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Removed {compacted} points by downsampling and {expired} past retention."
+        ))
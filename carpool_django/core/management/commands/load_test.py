@@ -0,0 +1,54 @@
+import asyncio
+import time
+from collections import Counter
+
+import httpx
+from django.core.management.base import BaseCommand
+
+from core.benchmarks import percentile
+
+
+class Command(BaseCommand):
+    help = ("Send concurrent GETs to a running server and report throughput and latency. "
+            "Run it once against the WSGI server and once against the ASGI server to compare them.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000', help="Server to load.")
+        parser.add_argument('--path', action='append', dest='paths',
+                            help="Path to request (repeatable; requests cycle through them). Default: /api/rides/")
+        parser.add_argument('--requests', type=int, default=5000)
+        parser.add_argument('--concurrency', type=int, default=200)
+        parser.add_argument('--token', help="JWT access token, sent as a Bearer header.")
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or ['/api/rides/']
+        headers = {'Authorization': f"Bearer {options['token']}"} if options['token'] else {}
+        timings, statuses, elapsed = asyncio.run(self._run(options['url'], paths, headers, options))
+
+        self.stdout.write(f"{len(timings)} requests at concurrency {options['concurrency']} "
+                          f"in {elapsed:.1f}s: {len(timings) / elapsed:.0f} req/s")
+        self.stdout.write(f"latency p50 {percentile(timings, 50):.1f} ms  p95 {percentile(timings, 95):.1f} ms  "
+                          f"p99 {percentile(timings, 99):.1f} ms  max {max(timings):.1f} ms")
+        summary = ', '.join(f"{status}: {count}" for status, count in sorted(statuses.items(), key=str))
+        style = self.style.SUCCESS if set(statuses) <= {200, 304} else self.style.WARNING
+        self.stdout.write(style(f"responses {summary}"))
+
+    async def _run(self, url, paths, headers, options):
+        timings, statuses = [], Counter()
+        remaining = iter(range(options['requests']))
+        limits = httpx.Limits(max_connections=options['concurrency'])
+
+        async with httpx.AsyncClient(base_url=url, headers=headers, limits=limits, timeout=60) as client:
+            async def worker():
+                for n in remaining:
+                    t0 = time.perf_counter()
+                    try:
+                        response = await client.get(paths[n % len(paths)])
+                        statuses[response.status_code] += 1
+                    except httpx.HTTPError as exc:
+                        statuses[type(exc).__name__] += 1
+                    timings.append((time.perf_counter() - t0) * 1000)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(options['concurrency'])))
+            return timings, statuses, time.perf_counter() - started
@@ -0,0 +1,137 @@
+import itertools
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from carpool_common import routes
+from core.benchmarks import USERNAME_PREFIX
+from core.models import Booking, Ride, User, Vehicle
+
+CITIES = {
+    'Lagos': (6.5244, 3.3792), 'Ibadan': (7.3775, 3.9470), 'Abeokuta': (7.1475, 3.3619),
+    'Ijebu Ode': (6.8194, 3.9173), 'Sagamu': (6.8322, 3.6319), 'Ile Ife': (7.4824, 4.5603),
+    'Oshogbo': (7.7827, 4.5418), 'Akure': (7.2571, 5.2058), 'Ondo': (7.0932, 4.8353),
+    'Ogbomosho': (8.1227, 4.2436), 'Ilorin': (8.4966, 4.5421), 'Benin City': (6.3350, 5.6037),
+}
+PICKUP_SPOTS = ('Park', 'Junction', 'Garage', 'Toll Gate', 'Motor Park', 'Roundabout')
+# Weight of each departure hour: commuter peaks around 7:00 and 17:00.
+HOUR_WEIGHTS = [1, 1, 1, 1, 2, 5, 9, 10, 7, 4, 3, 3, 3, 3, 4, 6, 9, 10, 7, 4, 3, 2, 1, 1]
+PASSWORD = 'bench-password'
+
+
+def _zipf_weights(n, s=1.1):
+    """Cumulative weights for ``random.choices``: item k is picked in proportion to 1 / (k + 1) ** s."""
+    return list(itertools.accumulate(1 / (k + 1) ** s for k in range(n)))
+
+
+class Command(BaseCommand):
+    help = ("Create benchmark users (bench-*), vehicles, rides and bookings with realistic skew: a few "
+            "busy drivers, riders and corridors account for most rides and bookings, and departures "
+            "cluster at commuter peaks. Deterministic for a given --seed. See `manage.py bench`.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--rides', type=int, default=20_000)
+        parser.add_argument('--bookings', type=int, default=30_000)
+        parser.add_argument('--days', type=int, default=14, help="Spread upcoming departures over this many days.")
+        parser.add_argument('--drivers', type=float, default=0.2, help="Fraction of users who drive.")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--reset', action='store_true', help="Delete existing benchmark data first.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        if options['reset']:
+            deleted, _ = User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+            self.stdout.write(f"Deleted {deleted} benchmark objects.")
+        elif User.objects.filter(username__startswith=USERNAME_PREFIX).exists():
+            self.stderr.write("Benchmark data already exists; pass --reset to replace it.")
+            return
+
+        started = time.perf_counter()
+        with transaction.atomic():
+            users = self._users(options['users'])
+            drivers = users[:max(1, int(len(users) * options['drivers']))]
+            vehicles = self._vehicles(rng, drivers)
+            rides = self._rides(rng, drivers, vehicles, options)
+            bookings = self._bookings(rng, users, rides, options['bookings'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {len(users)} users, {len(vehicles)} vehicles, {len(rides)} rides and "
+            f"{bookings} bookings in {time.perf_counter() - started:.1f}s."
+        ))
+
+    def _users(self, count):
+        # One hash for everyone: hashing each password would take most of the run.
+        password = make_password(PASSWORD)
+        return User.objects.bulk_create([
+            User(username=f'{USERNAME_PREFIX}{n:06d}', password=password, email=f'{USERNAME_PREFIX}{n}@example.com')
+            for n in range(count)
+        ], batch_size=1000)
+
+    def _vehicles(self, rng, drivers):
+        vehicles = []
+        for driver in drivers:
+            for n in range(2 if rng.random() < 0.1 else 1):
+                vehicles.append(Vehicle(owner=driver, make=rng.choice(('Toyota', 'Honda', 'Kia', 'Hyundai')),
+                                        model=rng.choice(('Corolla', 'Camry', 'Sienna', 'Accord', 'Rio')),
+                                        plate_number=f'BEN-{driver.pk}-{n}', seats=rng.choice((4, 4, 4, 6, 7))))
+        return Vehicle.objects.bulk_create(vehicles, batch_size=1000)
+
+    def _rides(self, rng, drivers, vehicles, options):
+        corridors = [(a, b) for a in CITIES for b in CITIES if a != b]
+        rng.shuffle(corridors)
+        corridor_weights = _zipf_weights(len(corridors))
+        driver_weights = _zipf_weights(len(drivers))
+        vehicle_of = {vehicle.owner_id: vehicle for vehicle in vehicles}
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+        rides = []
+        for _ in range(options['rides']):
+            origin, destination = rng.choices(corridors, cum_weights=corridor_weights)[0]
+            driver = rng.choices(drivers, cum_weights=driver_weights)[0]
+            # A sixth of the rides have already departed.
+            day = rng.randint(-3, -1) if rng.random() < 1 / 6 else rng.randint(0, options['days'] - 1)
+            hour = rng.choices(range(24), weights=HOUR_WEIGHTS)[0]
+            start, end = CITIES[origin], CITIES[destination]
+            distance_km = routes.distance_m(*start, *end) / 1000
+            rides.append(Ride(
+                driver=driver, vehicle=vehicle_of[driver.pk],
+                origin=f'{origin} {rng.choice(PICKUP_SPOTS)}', destination=f'{destination} {rng.choice(PICKUP_SPOTS)}',
+                origin_lat=start[0], origin_lon=start[1], destination_lat=end[0], destination_lon=end[1],
+                departure_time=today + timedelta(days=day, hours=hour, minutes=rng.choice((0, 15, 30, 45))),
+                available_seats=rng.choice((1, 2, 3, 3, 4, 4, 4, 6)),
+                price_cents=int(distance_km * 30) * 100,
+            ))
+        created = []
+        for i in range(0, len(rides), 2000):
+            created.extend(Ride.objects.bulk_create(rides[i:i + 2000]))
+        return created
+
+    def _bookings(self, rng, users, rides, count):
+        # Popular corridors and busy drivers already cluster rides; riders are skewed the same way.
+        ride_weights = _zipf_weights(len(rides), s=0.6)
+        order = list(range(len(rides)))
+        rng.shuffle(order)
+        rider_weights = _zipf_weights(len(users))
+        taken = {}
+        bookings = []
+        for _ in range(count * 3):
+            if len(bookings) == count:
+                break
+            ride = rides[order[rng.choices(range(len(rides)), cum_weights=ride_weights)[0]]]
+            passenger = rng.choices(users, cum_weights=rider_weights)[0]
+            seats = 2 if rng.random() < 0.2 else 1
+            if passenger.pk == ride.driver_id or taken.get(ride.pk, 0) + seats > ride.available_seats:
+                continue
+            taken[ride.pk] = taken.get(ride.pk, 0) + seats
+            bookings.append(Booking(ride=ride, passenger=passenger, seats=seats))
+        Booking.objects.bulk_create(bookings, batch_size=2000)
+        # Booking.objects.bulk_create doesn't go through reserve_seats; set the counts in one pass per ride.
+        for ride in rides:
+            ride.seats_booked = taken.get(ride.pk, 0)
+        Ride.objects.bulk_update([ride for ride in rides if ride.seats_booked], ['seats_booked'], batch_size=2000)
+        return len(bookings)
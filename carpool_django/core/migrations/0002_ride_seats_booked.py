@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:54
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_seats_booked(apps, schema_editor):
+    Ride = apps.get_model('core', 'Ride')
+    Booking = apps.get_model('core', 'Booking')
+    booked = (
+        Booking.objects.filter(ride=OuterRef('pk'))
+        .order_by()
+        .values('ride')
+        .annotate(total=Sum('seats'))
+        .values('total')
+    )
+    Ride.objects.update(seats_booked=Coalesce(Subquery(booked), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='seats_booked',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_seats_booked, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:57
+
+from django.db import migrations, models
+
+from carpool_common import search
+
+
+def backfill_search_keys(apps, schema_editor):
+    Ride = apps.get_model('core', 'Ride')
+    batch = []
+    for ride in Ride.objects.only('id', 'origin', 'destination').iterator(chunk_size=2000):
+        ride.origin_key = search.normalize(ride.origin)
+        ride.destination_key = search.normalize(ride.destination)
+        batch.append(ride)
+        if len(batch) >= 2000:
+            Ride.objects.bulk_update(batch, ['origin_key', 'destination_key'])
+            batch = []
+    if batch:
+        Ride.objects.bulk_update(batch, ['origin_key', 'destination_key'])
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        for statement in search.TRGM_CREATE_SQL:
+            schema_editor.execute(statement)
+    elif vendor == 'sqlite':
+        schema_editor.execute(search.FTS_CREATE_SQL)
+        schema_editor.execute(search.FTS_REBUILD_SQL)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        for statement in search.TRGM_DROP_SQL:
+            schema_editor.execute(statement)
+    elif vendor == 'sqlite':
+        schema_editor.execute(search.FTS_DROP_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_ride_seats_booked'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='destination_key',
+            field=models.CharField(default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='origin_key',
+            field=models.CharField(default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(backfill_search_keys, migrations.RunPython.noop),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_ride_search_keys'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['passenger', '-created_at'], name='booking_passenger_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['departure_time', 'available_seats'], name='ride_departure_seats_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['origin', 'destination', 'departure_time'], name='ride_route_departure_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['driver', 'departure_time'], name='ride_driver_departure_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(condition=models.Q(('available_seats__gt', models.F('seats_booked'))), fields=['departure_time'], name='ride_open_departure_idx'),
+        ),
+    ]
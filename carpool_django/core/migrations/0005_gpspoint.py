@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GpsPoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recorded_at', models.DateTimeField()),
+                ('lat', models.FloatField()),
+                ('lon', models.FloatField()),
+                ('heading', models.FloatField(default=0)),
+                ('speed', models.FloatField(default=0)),
+                ('ride', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='gps_points', to='core.ride')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ride', 'recorded_at'], name='gpspoint_ride_recorded_idx'), models.Index(fields=['recorded_at'], name='gpspoint_recorded_idx')],
+            },
+        ),
+    ]
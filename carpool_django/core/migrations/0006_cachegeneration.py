@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:13
+
+from django.db import migrations, models
+
+
+def create_rides_generation(apps, schema_editor):
+    CacheGeneration = apps.get_model('core', 'CacheGeneration')
+    CacheGeneration.objects.get_or_create(name='rides')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_gpspoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheGeneration',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_rides_generation, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:21
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RideSchedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('origin', models.CharField(max_length=255)),
+                ('destination', models.CharField(max_length=255)),
+                ('origin_key', models.CharField(default='', editable=False, max_length=255)),
+                ('destination_key', models.CharField(default='', editable=False, max_length=255)),
+                ('departure_time', models.TimeField()),
+                ('weekdays', models.PositiveSmallIntegerField(default=31)),
+                ('starts_on', models.DateField()),
+                ('ends_on', models.DateField(blank=True, null=True)),
+                ('available_seats', models.PositiveIntegerField(default=1)),
+                ('price_cents', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('driver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ride_schedules', to=settings.AUTH_USER_MODEL)),
+                ('vehicle', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.vehicle')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='schedule',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='rides', to='core.rideschedule'),
+        ),
+        migrations.AddConstraint(
+            model_name='ride',
+            constraint=models.UniqueConstraint(fields=('schedule', 'departure_time'), name='ride_schedule_occurrence_unique'),
+        ),
+        migrations.AddIndex(
+            model_name='rideschedule',
+            index=models.Index(fields=['starts_on', 'ends_on'], name='schedule_active_idx'),
+        ),
+    ]
@@ -1,10 +1,34 @@
-from django.db import models
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.expressions import RawSQL
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
+
+from carpool_common import routes, search
 
 
 class User(AbstractUser):
     phone = models.CharField(max_length=30, blank=True)
 
+    @classmethod
+    def from_claims(cls, user_id, using='default'):
+        """A user known only by id, e.g. from a verified token (see core.authentication).
+
+        Every other field is deferred; the first one read loads the whole row.
+        ``user_id`` may be the token's string claim: it is converted to the
+        primary key's type, so ``user.pk`` compares equal to ``driver_id`` etc.
+        """
+        return cls.from_db(using, ['id'], [cls._meta.pk.to_python(user_id)])
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        if fields is not None:
+            # Reading one deferred field loads them all, so a lazy user costs one query.
+            fields = {*fields, *self.get_deferred_fields()}
+        super().refresh_from_db(using, fields, from_queryset)
+
 
 class Vehicle(models.Model):
     owner = models.ForeignKey('core.User', on_delete=models.CASCADE, related_name='vehicles')
@@ -12,29 +36,410 @@ class Vehicle(models.Model):
     model = models.CharField(max_length=100)
     plate_number = models.CharField(max_length=50)
     seats = models.PositiveIntegerField(default=4)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at'], name='vehicle_updated_idx'),
+        ]
 
     def __str__(self):
         return f"{self.make} {self.model} ({self.plate_number})"
 
 
+class RideQuerySet(models.QuerySet):
+    def with_booking_stats(self):
+        """Annotate each ride with ``bookings_count`` in the same query.
+
+        A correlated subquery rather than a join + GROUP BY, so ordered listings
+        can walk the departure_time indexes and stop at the page limit.
+        """
+        counts = (
+            Booking.objects.filter(ride=OuterRef('pk'))
+            .order_by()
+            .values('ride')
+            .annotate(total=Count('pk'))
+            .values('total')
+        )
+        return self.annotate(bookings_count=Coalesce(Subquery(counts), 0))
+
+    def search(self, term, field=None):
+        """Indexed match on origin/destination, annotated with ``search_rank`` (higher is better)."""
+        match = search.match_sql(connections[self.db].vendor, term, field)
+        if match is None:
+            return self
+        where, params = match
+        rank = RawSQL(*search.rank_sql(term, field), output_field=models.IntegerField())
+        if 'search_rank' in self.query.annotations:
+            # Chained searches (e.g. origin and destination) add up their ranks.
+            rank = self.query.annotations['search_rank'] + rank
+        return self.extra(where=[where], params=params).annotate(search_rank=rank)
+
+    def along_route(self, pickup, dropoff, radius_m=routes.DEFAULT_RADIUS_M, after=None, before=None):
+        """Rides whose route passes within ``radius_m`` of ``pickup`` and then ``dropoff`` (``(lat, lon)`` pairs).
+
+        The route grid (``RouteCell``), limited to departures in
+        ``[after, before)``, narrows the rides down in SQL, and
+        ``routes.match`` checks what is left.
+        """
+        ops = connections[self.db].ops
+        after, before = (None if bound is None else ops.adapt_datetimefield_value(bound) for bound in (after, before))
+        where, params = routes.candidates_sql(pickup, dropoff, radius_m, after, before)
+        candidates = self.extra(where=[where], params=params).order_by().values_list('pk', *routes.COLUMNS)
+        matched = [
+            pk for pk, *route in candidates
+            if routes.match(routes.route_points(*route), pickup, dropoff, radius_m)
+        ]
+        return self.filter(pk__in=matched)
+
+    def reserve_seats(self, ride_id, seats):
+        """Atomically claim ``seats`` on a ride; returns False if not enough are left."""
+        updated = self.filter(
+            pk=ride_id, available_seats__gte=F('seats_booked') + seats
+        ).update(seats_booked=F('seats_booked') + seats, updated_at=timezone.now())
+        return updated == 1
+
+    def reserve_seats_bulk(self, seats_by_ride):
+        """``reserve_seats`` for several rides in one UPDATE; all or nothing.
+
+        Returns False (and reserves nothing) if any ride lacks the seats; the
+        caller's transaction should then roll back.
+        """
+        delta = Case(
+            *(When(pk=ride_id, then=Value(seats)) for ride_id, seats in seats_by_ride.items()),
+            output_field=models.PositiveIntegerField(),
+        )
+        updated = self.filter(
+            pk__in=list(seats_by_ride), available_seats__gte=F('seats_booked') + delta
+        ).update(seats_booked=F('seats_booked') + delta, updated_at=timezone.now())
+        return updated == len(seats_by_ride)
+
+    def release_seats(self, ride_id, seats):
+        """Give back seats claimed by ``reserve_seats``."""
+        updated = self.filter(
+            pk=ride_id, seats_booked__gte=seats
+        ).update(seats_booked=F('seats_booked') - seats, updated_at=timezone.now())
+        return updated == 1
+
+    def bulk_create(self, objs, *args, **kwargs):
+        # save() is bypassed: fill in the search keys and index the new rows here.
+        objs = list(objs)
+        for ride in objs:
+            ride.set_search_keys()
+        created = super().bulk_create(objs, *args, **kwargs)
+        index_rides(created, self.db)
+        index_routes(created, self.db)
+        return created
+
+
 class Ride(models.Model):
     driver = models.ForeignKey('core.User', on_delete=models.CASCADE, related_name='rides')
     vehicle = models.ForeignKey('core.Vehicle', on_delete=models.SET_NULL, null=True, blank=True)
     origin = models.CharField(max_length=255)
     destination = models.CharField(max_length=255)
+    # Normalized copies of origin/destination used by carpool_common.search.
+    origin_key = models.CharField(max_length=255, default='', editable=False)
+    destination_key = models.CharField(max_length=255, default='', editable=False)
+    # Geocoded route for carpool_common.routes: both endpoints, plus optional [[lat, lon], ...] waypoints in between.
+    origin_lat = models.FloatField(null=True, blank=True)
+    origin_lon = models.FloatField(null=True, blank=True)
+    destination_lat = models.FloatField(null=True, blank=True)
+    destination_lon = models.FloatField(null=True, blank=True)
+    waypoints = models.JSONField(default=list, blank=True)
     departure_time = models.DateTimeField()
     available_seats = models.PositiveIntegerField(default=1)
+    # Sum of Booking.seats for this ride, kept in step by reserve_seats/release_seats.
+    seats_booked = models.PositiveIntegerField(default=0)
     price_cents = models.IntegerField(default=0)
+    # Validator for conditional requests; also touched by reserve_seats/release_seats.
+    updated_at = models.DateTimeField(auto_now=True)
+    # Set when the ride is a booked occurrence of a recurring schedule.
+    schedule = models.ForeignKey('core.RideSchedule', on_delete=models.SET_NULL, null=True, blank=True, related_name='rides')
+
+    objects = RideQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['departure_time', 'available_seats'], name='ride_departure_seats_idx'),
+            models.Index(fields=['origin', 'destination', 'departure_time'], name='ride_route_departure_idx'),
+            models.Index(fields=['driver', 'departure_time'], name='ride_driver_departure_idx'),
+            # Rides that can still be booked, for ?available_only=true listings.
+            models.Index(
+                fields=['departure_time'],
+                name='ride_open_departure_idx',
+                condition=Q(available_seats__gt=F('seats_booked')),
+            ),
+            models.Index(fields=['updated_at'], name='ride_updated_idx'),
+        ]
+        constraints = [
+            # An occurrence is materialized at most once.
+            models.UniqueConstraint(fields=['schedule', 'departure_time'], name='ride_schedule_occurrence_unique'),
+        ]
 
     def __str__(self):
         return f"Ride {self.id} from {self.origin} to {self.destination}"
 
+    def set_search_keys(self):
+        self.origin_key = search.normalize(self.origin)
+        self.destination_key = search.normalize(self.destination)
+
+    def save(self, *args, **kwargs):
+        self.set_search_keys()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = set(update_fields) | {'updated_at'}
+            if {'origin', 'destination'} & update_fields:
+                update_fields |= {'origin_key', 'destination_key'}
+            kwargs['update_fields'] = update_fields
+        super().save(*args, **kwargs)
+
+    @property
+    def seats_remaining(self):
+        return max(0, self.available_seats - self.seats_booked)
+
+    @property
+    def occurrence(self):
+        """Token identifying this ride as an occurrence of its schedule, or None for one-off rides."""
+        if self.schedule_id is None:
+            return None
+        return RideSchedule.occurrence_token(self.schedule_id, self.departure_time)
+
+    def route_points(self):
+        return routes.route_points(*(getattr(self, column) for column in routes.COLUMNS))
+
+
+def index_rides(rides, using):
+    """Refresh the SQLite FTS rows of ``rides``; PostgreSQL's trigram indexes maintain themselves."""
+    if connections[using].vendor != 'sqlite' or not rides:
+        return
+    with connections[using].cursor() as cursor:
+        cursor.executemany(search.FTS_DELETE_SQL, [[ride.pk] for ride in rides])
+        cursor.executemany(search.FTS_INSERT_SQL, [[ride.pk, ride.origin_key, ride.destination_key] for ride in rides])
+
+
+def index_routes(rides, using):
+    """Rebuild the ``RouteCell`` rows of ``rides`` from their geocoded routes."""
+    if not rides:
+        return
+    cells = RouteCell.objects.using(using)
+    cells.filter(ride__in=[ride.pk for ride in rides]).delete()
+    cells.bulk_create(
+        [
+            RouteCell(ride=ride, cell=cell, departure_time=ride.departure_time, enter_m=enter_m, exit_m=exit_m)
+            for ride in rides
+            if (points := ride.route_points())
+            for cell, enter_m, exit_m in routes.route_cells(points)
+        ],
+        batch_size=1000,
+    )
+
+
+class RouteCell(models.Model):
+    """A grid cell a ride's route crosses, and how far along the route (meters) it enters and leaves it.
+
+    Maintained by ``index_routes``; queried by ``carpool_common.routes.candidates_sql``.
+    """
+    ride = models.ForeignKey('core.Ride', on_delete=models.CASCADE, related_name='route_cells')
+    # carpool_common.routes.cell_key
+    cell = models.BigIntegerField()
+    # Copy of the ride's, so one index covers both the cell and the departure window.
+    departure_time = models.DateTimeField()
+    enter_m = models.FloatField()
+    exit_m = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['cell', 'departure_time'], name='routecell_cell_departure_idx'),
+        ]
+
+    def __str__(self):
+        return f"Route cell {self.cell} of ride {self.ride_id}"
+
+
+class RideSchedule(models.Model):
+    """A ride repeated on ``weekdays`` at ``departure_time`` (UTC) from ``starts_on`` until ``ends_on``.
+
+    Occurrences are not stored: ride listings expand them for the window they
+    show (see ``core.schedules``), and ``materialize`` creates the ``Ride``
+    row when an occurrence is first booked.
+    """
+    driver = models.ForeignKey('core.User', on_delete=models.CASCADE, related_name='ride_schedules')
+    vehicle = models.ForeignKey('core.Vehicle', on_delete=models.SET_NULL, null=True, blank=True)
+    origin = models.CharField(max_length=255)
+    destination = models.CharField(max_length=255)
+    origin_key = models.CharField(max_length=255, default='', editable=False)
+    destination_key = models.CharField(max_length=255, default='', editable=False)
+    departure_time = models.TimeField()
+    # Bit 0 is Monday, as in date.weekday(); the default is Monday to Friday.
+    weekdays = models.PositiveSmallIntegerField(default=0b0011111)
+    starts_on = models.DateField()
+    ends_on = models.DateField(null=True, blank=True)
+    available_seats = models.PositiveIntegerField(default=1)
+    price_cents = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['starts_on', 'ends_on'], name='schedule_active_idx'),
+        ]
+
+    def __str__(self):
+        return f"Schedule {self.id} from {self.origin} to {self.destination}"
+
+    def set_search_keys(self):
+        self.origin_key = search.normalize(self.origin)
+        self.destination_key = search.normalize(self.destination)
+
+    def save(self, *args, **kwargs):
+        self.set_search_keys()
+        super().save(*args, **kwargs)
+
+    def runs_on(self, day):
+        return (
+            bool(self.weekdays >> day.weekday() & 1)
+            and self.starts_on <= day
+            and (self.ends_on is None or day <= self.ends_on)
+        )
+
+    def is_departure(self, departure_time):
+        departure_time = departure_time.astimezone(dt_timezone.utc)
+        day = departure_time.date()
+        return self.runs_on(day) and datetime.combine(day, self.departure_time, tzinfo=dt_timezone.utc) == departure_time
+
+    def departures(self, first_day, last_day):
+        """Departure datetimes on the days from ``first_day`` to ``last_day`` inclusive."""
+        day = max(first_day, self.starts_on)
+        last_day = min(last_day, self.ends_on) if self.ends_on else last_day
+        while day <= last_day:
+            if self.runs_on(day):
+                yield datetime.combine(day, self.departure_time, tzinfo=dt_timezone.utc)
+            day += timedelta(days=1)
+
+    def occurrence_ride(self, departure_time):
+        """Unsaved Ride for one occurrence."""
+        ride = Ride(
+            schedule=self, driver=self.driver, vehicle_id=self.vehicle_id,
+            origin=self.origin, destination=self.destination,
+            origin_key=self.origin_key, destination_key=self.destination_key,
+            departure_time=departure_time, available_seats=self.available_seats,
+            price_cents=self.price_cents,
+        )
+        ride.bookings_count = 0
+        return ride
+
+    def materialize(self, departure_time):
+        """The Ride row for an occurrence, created on first use."""
+        try:
+            with transaction.atomic():
+                ride, _ = Ride.objects.get_or_create(
+                    schedule=self, departure_time=departure_time,
+                    defaults={
+                        'driver_id': self.driver_id, 'vehicle_id': self.vehicle_id,
+                        'origin': self.origin, 'destination': self.destination,
+                        'available_seats': self.available_seats, 'price_cents': self.price_cents,
+                    },
+                )
+        except IntegrityError:
+            # Another request materialized it first.
+            ride = Ride.objects.get(schedule=self, departure_time=departure_time)
+        return ride
+
+    @staticmethod
+    def occurrence_token(schedule_id, departure_time):
+        return f"{schedule_id}-{departure_time.astimezone(dt_timezone.utc):%Y%m%dT%H%M}"
+
+    @classmethod
+    def parse_occurrence(cls, token):
+        """``(schedule_id, departure_time)`` from an occurrence token. Raises ValueError."""
+        schedule_id, _, when = str(token).partition('-')
+        departure_time = datetime.strptime(when, '%Y%m%dT%H%M').replace(tzinfo=dt_timezone.utc)
+        return int(schedule_id), departure_time
+
 
 class Booking(models.Model):
     ride = models.ForeignKey('core.Ride', on_delete=models.CASCADE, related_name='bookings')
     passenger = models.ForeignKey('core.User', on_delete=models.CASCADE, related_name='bookings')
     seats = models.PositiveIntegerField(default=1)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['passenger', '-created_at'], name='booking_passenger_created_idx'),
+            # Incremental exports (core.export) seek on (updated_at, id).
+            models.Index(fields=['updated_at', 'id'], name='booking_updated_idx'),
+        ]
 
     def __str__(self):
         return f"Booking {self.id} for ride {self.ride_id} by {self.passenger.username}"
+
+    def cancel(self):
+        """Delete the booking; its seats go back to the ride in the same transaction (see core.signals).
+
+        The row is locked first so that two concurrent cancels release the seats only once.
+        """
+        with transaction.atomic():
+            booking = Booking.objects.select_for_update().filter(pk=self.pk).first()
+            if booking is not None:
+                booking.delete()
+
+
+class GpsPoint(models.Model):
+    """A GPS fix on a ride's trail, written in batches by the FastAPI gateway."""
+    ride = models.ForeignKey('core.Ride', on_delete=models.CASCADE, related_name='gps_points')
+    recorded_at = models.DateTimeField()
+    lat = models.FloatField()
+    lon = models.FloatField()
+    heading = models.FloatField(default=0)
+    speed = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ride', 'recorded_at'], name='gpspoint_ride_recorded_idx'),
+            models.Index(fields=['recorded_at'], name='gpspoint_recorded_idx'),
+        ]
+
+    def __str__(self):
+        return f"GPS point for ride {self.ride_id} at {self.recorded_at}"
+
+
+class CacheGeneration(models.Model):
+    """Counter bumped whenever the data behind a cached view changes.
+
+    The FastAPI gateway can't see Django's cache or signals, so it compares
+    this value against the generation its cached ``/search`` results were
+    computed at.
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    RIDES = 'rides'
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+    @classmethod
+    def bump(cls, name, using=None):
+        manager = cls.objects.db_manager(using)
+        if not manager.filter(name=name).update(value=F('value') + 1):
+            manager.get_or_create(name=name)
+
+
+class RideChange(models.Model):
+    """Outbox of rides whose seats or listing changed, read by the gateway's availability feed.
+
+    Rows are written in the same transaction as the change, so the gateway
+    sees exactly the committed ones; it only needs the ride id because it
+    reads the ride's current seats itself. The gateway also deletes rows
+    older than its retention.
+    """
+    # Not a foreign key: deleting a ride is a change the feed reports too.
+    ride_id = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"Change of ride {self.ride_id} at {self.created_at}"
+
+    @classmethod
+    def record(cls, ride_ids, using=None):
+        cls.objects.using(using).bulk_create([cls(ride_id=ride_id) for ride_id in set(ride_ids)])
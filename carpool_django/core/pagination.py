@@ -0,0 +1,103 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from carpool_common import cursor as cursors
+
+
+def parse_keys(model, ordering, values):
+    """Cursor values converted to the Python types of their ``ordering`` fields."""
+    return [model._meta.get_field(field.lstrip('-')).to_python(value) for field, value in zip(ordering, values)]
+
+
+def seek_after(ordering, values):
+    """Q for rows ordered after ``values``: (a > x) OR (a = x AND b > y) ..."""
+    condition = Q()
+    equal = {}
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        condition |= Q(**equal, **{f'{name}__{lookup}': value})
+        equal[name] = value
+    return condition
+
+
+class KeysetPagination(pagination.BasePagination):
+    """Seek-based pagination over a view's ``keyset_ordering``, e.g. ``('departure_time', 'id')``.
+
+    No COUNT query and no OFFSET: each page filters for rows strictly after
+    the last key of the previous one, so deep pages cost the same as the
+    first and concurrent inserts never shift or duplicate results.
+
+    Besides querysets it accepts objects with a ``keyset(ordering, values,
+    limit)`` method and a ``sort_value(row, field)`` counterpart to
+    ``getattr``, such as ``core.schedules.MergedRides``.
+    """
+    cursor_query_param = 'cursor'
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = view.keyset_ordering
+        self.page_size = self.get_page_size(request)
+        self.sort_value = getattr(queryset, 'sort_value', getattr)
+
+        try:
+            values = cursors.decode(request.query_params.get(self.cursor_query_param), len(self.ordering))
+            if values is not None:
+                values = parse_keys(queryset.model, self.ordering, values)
+        except (ValueError, TypeError, DjangoValidationError):
+            raise NotFound('Invalid cursor')
+
+        if hasattr(queryset, 'keyset'):
+            rows = queryset.keyset(self.ordering, values, self.page_size + 1)
+        else:
+            queryset = queryset.order_by(*self.ordering)
+            if values is not None:
+                queryset = queryset.filter(seek_after(self.ordering, values))
+            rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        token = cursors.encode([self.sort_value(last, field.lstrip('-')) for field in self.ordering])
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, token)
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+
+class StandardResultsSetPagination(pagination.PageNumberPagination):
+    """Page-number pagination; switches to KeysetPagination when the request carries ``?cursor=``
+    and the view declares a ``keyset_ordering``."""
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if KeysetPagination.cursor_query_param in request.query_params and getattr(view, 'keyset_ordering', None):
+            self.keyset = KeysetPagination()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
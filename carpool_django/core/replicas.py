@@ -0,0 +1,142 @@
+"""Read replicas for safe requests, with read-your-writes stickiness.
+
+``CARPOOL_DB_REPLICAS`` adds one database alias per replica
+(``CARPOOL_READ_REPLICAS``, see settings). ``ReplicaMiddleware`` lets the ORM
+reads of a GET/HEAD/OPTIONS request go to a random replica through
+``ReplicaRouter``; everything else -- writes, unsafe requests, management
+commands, signal handlers -- stays on ``default``.
+
+Replicas lag behind the primary, so a user who just wrote (booked a seat,
+created a ride) must not read an older state back. Any write makes the rest
+of its request read from the primary, and pins the user to the primary for
+``CARPOOL_REPLICA_STICKY_SECONDS`` afterwards. The pin is keyed by the user
+id of the request's JWT (requests without one aren't pinned) and kept in the
+``default`` cache, which must be shared (e.g. Redis) when several workers
+serve the API.
+
+Responses stored in the ride response cache (core.caching) are rendered from
+the primary (``primary()``): an entry stays current until the next
+invalidation, so it must not capture a lagging replica.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS
+
+from carpool_common import tokens
+from .authentication import verified_tokens
+
+CACHE_ALIAS = 'default'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class RequestState:
+    __slots__ = ('replicas', 'wrote')
+
+    def __init__(self, replicas):
+        self.replicas = replicas
+        self.wrote = False
+
+
+_state = ContextVar('carpool_replica_state', default=None)
+
+
+@contextmanager
+def _use(state):
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+
+
+def _request_state(request, pinned):
+    return _use(RequestState(replicas=request.method in SAFE_METHODS and not pinned))
+
+
+@contextmanager
+def primary():
+    """Read from the primary inside this block, e.g. while rendering a response that gets cached."""
+    outer = _state.get()
+    with _use(RequestState(replicas=False)) as state:
+        yield
+    if outer is not None and state.wrote:
+        outer.replicas = False
+        outer.wrote = True
+
+
+def _pin_key(user_id):
+    return f'db:primary:user:{user_id}'
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.replicas:
+            return None
+        return random.choice(settings.CARPOOL_READ_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            # Reads later in the request must see this write.
+            state.replicas = False
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary.
+        aliases = {DEFAULT_DB_ALIAS, *settings.CARPOOL_READ_REPLICAS}
+        return obj1._state.db in aliases and obj2._state.db in aliases
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.CARPOOL_READ_REPLICAS
+
+
+def token_user_id(request):
+    """The user id of the request's valid Bearer token, or None. Uses the cache of verified tokens."""
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    if scheme != 'Bearer' or not token:
+        return None
+    try:
+        return verified_tokens.verify(token.strip())[tokens.USER_ID_CLAIM]
+    except tokens.InvalidToken:
+        return None
+
+
+class ReplicaMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.CARPOOL_READ_REPLICAS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        user_id = token_user_id(request)
+        pinned = user_id is not None and caches[CACHE_ALIAS].get(_pin_key(user_id)) is not None
+        with _request_state(request, pinned) as state:
+            response = self.get_response(request)
+        if state.wrote and user_id is not None:
+            caches[CACHE_ALIAS].set(_pin_key(user_id), True, settings.CARPOOL_REPLICA_STICKY_SECONDS)
+        return response
+
+    async def __acall__(self, request):
+        user_id = token_user_id(request)
+        pinned = user_id is not None and await caches[CACHE_ALIAS].aget(_pin_key(user_id)) is not None
+        with _request_state(request, pinned) as state:
+            response = await self.get_response(request)
+        if state.wrote and user_id is not None:
+            await caches[CACHE_ALIAS].aset(_pin_key(user_id), True, settings.CARPOOL_REPLICA_STICKY_SECONDS)
+        return response
@@ -0,0 +1,220 @@
+"""Lazy expansion of ``RideSchedule`` occurrences into ride listings.
+
+Occurrences have no rows until they are booked. When ``RideViewSet`` lists
+rides, the departures of every schedule in the window are expanded and
+cached per window day range. Those that already have a ``Ride`` are dropped,
+and the rest are merged with the concrete rows by ``MergedRides``. That
+merge takes the first page of concrete rides from the usual index-backed
+query, so the database never sorts more than a page.
+
+In keyset pagination an occurrence sorts before concrete rides with the
+same departure time. It uses ``-schedule_id`` in place of its missing id.
+"""
+import heapq
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from functools import cmp_to_key
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+
+from carpool_common import search
+from . import caching
+from .models import Ride, RideSchedule
+from .pagination import seek_after
+
+# Days of occurrences shown when the request gives no window.
+WINDOW_DAYS = 14
+MAX_WINDOW_DAYS = 92
+SEARCH_FIELDS = {None: ('origin_key', 'destination_key'), 'origin': ('origin_key',), 'destination': ('destination_key',)}
+
+
+def _parse_bound(value, name):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValidationError({name: "Expected an ISO 8601 date or datetime."})
+        parsed = datetime.combine(day, time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, dt_timezone.utc)
+    return parsed
+
+
+def requested_window(request):
+    """``(departure_after, departure_before)`` from the query string; either may be None."""
+    bounds = []
+    for name in ('departure_after', 'departure_before'):
+        value = request.query_params.get(name)
+        bounds.append(_parse_bound(value, name) if value else None)
+    return tuple(bounds)
+
+
+def occurrence_window(after, before):
+    """Window of occurrences to show: the requested one, or from now until ``WINDOW_DAYS`` after today."""
+    now = timezone.now()
+    today = datetime.combine(now.date(), time.min, tzinfo=dt_timezone.utc)
+    start = after or now
+    end = before or max(after or today, today) + timedelta(days=WINDOW_DAYS)
+    return start, min(end, start + timedelta(days=MAX_WINDOW_DAYS))
+
+
+def window_state():
+    """When the default window last changed: the day, and the latest of today's departures already gone.
+
+    Its end moves at midnight and its start passes departures during the day;
+    list cache keys and ETags include this so they never outlive either.
+    """
+    now = timezone.now()
+    departed = [departure for departure, _ in expand(now.date(), now.date()) if departure < now]
+    return f"{now.date().isoformat()}:{departed[-1].time().isoformat() if departed else ''}"
+
+
+def expand(first_day, last_day):
+    """``[(departure_time, schedule_id)]`` of all schedules on those days, cached per day range."""
+    cache = caches[caching.CACHE_ALIAS]
+    key = f'schedules:{caching.generation(caching.SCHEDULE_GENERATION_KEY)}:{first_day}:{last_day}'
+    departures = cache.get(key, version=caching.KEY_VERSION)
+    if departures is None:
+        schedules = RideSchedule.objects.filter(
+            Q(ends_on__isnull=True) | Q(ends_on__gte=first_day), starts_on__lte=last_day,
+        )
+        departures = sorted(
+            (departure, schedule.pk)
+            for schedule in schedules
+            for departure in schedule.departures(first_day, last_day)
+        )
+        cache.set(key, departures, version=caching.KEY_VERSION)
+    return departures
+
+
+class Occurrence:
+    """An unbooked departure of a schedule, sortable like a Ride until it is turned into one."""
+    __slots__ = ('schedule', 'departure_time', 'search_rank')
+
+    def __init__(self, schedule, departure_time, search_rank):
+        self.schedule = schedule
+        self.departure_time = departure_time
+        self.search_rank = search_rank
+
+    def __getattr__(self, name):
+        return getattr(self.schedule, name)
+
+    def ride(self):
+        ride = self.schedule.occurrence_ride(self.departure_time)
+        ride.search_rank = self.search_rank
+        return ride
+
+
+def occurrences(after, before, searches, available_only):
+    """Occurrences in the window that match the list filters and have no Ride row yet."""
+    start, end = occurrence_window(after, before)
+    if start >= end:
+        return []
+    departures = [d for d in expand(start.date(), end.date()) if start <= d[0] < end]
+    if not departures:
+        return []
+
+    schedules = RideSchedule.objects.select_related('driver').in_bulk({schedule_id for _, schedule_id in departures})
+    searches = [(value, field) for value, field in searches if value]
+    ranks = {}
+    for schedule in schedules.values():
+        if available_only and schedule.available_seats < 1:
+            continue
+        rank = 0
+        for value, field in searches:
+            keys = [getattr(schedule, key) for key in SEARCH_FIELDS[field]]
+            if not search.matches(value, keys):
+                break
+            rank += search.rank(value, keys)
+        else:
+            ranks[schedule.pk] = rank if searches else None
+
+    booked = set(
+        Ride.objects.filter(schedule__isnull=False, departure_time__gte=start, departure_time__lt=end)
+        .values_list('schedule_id', 'departure_time')
+    )
+    return [
+        Occurrence(schedules[schedule_id], departure, ranks[schedule_id])
+        for departure, schedule_id in departures
+        if schedule_id in ranks and (schedule_id, departure) not in booked
+    ]
+
+
+def state():
+    """Validator parts for list ETags: anything that changes the expanded occurrences."""
+    return _state(window_state(), RideSchedule.objects.aggregate(last=Max('updated_at'), count=Count('pk')))
+
+
+async def astate():
+    return _state(await sync_to_async(window_state)(),
+                  await RideSchedule.objects.aaggregate(last=Max('updated_at'), count=Count('pk')))
+
+
+def _state(window, stats):
+    return window, stats['last'] and stats['last'].isoformat(), stats['count']
+
+
+class MergedRides:
+    """Concrete rides (a queryset) and ``Occurrence``s, read as one ordered sequence.
+
+    Supports what the paginators need: ``count()`` and slicing for page
+    numbers, ``keyset()``/``sort_value()`` for cursors.
+    """
+    ordered = True
+
+    def __init__(self, queryset, occurrences):
+        self.queryset = queryset
+        self.model = queryset.model
+        self.occurrences = occurrences
+
+    def sort_value(self, row, field):
+        if field == 'id' and (isinstance(row, Occurrence) or row.pk is None):
+            return -row.schedule.pk
+        return getattr(row, field)
+
+    def _sort_key(self, ordering):
+        def compare(a, b):
+            for field in ordering:
+                name = field.lstrip('-')
+                x, y = self.sort_value(a, name), self.sort_value(b, name)
+                if x != y:
+                    result = -1 if x < y else 1
+                    return -result if field.startswith('-') else result
+            return 0
+        return cmp_to_key(compare)
+
+    def _merge(self, rows, occurrences, ordering, start, stop):
+        key = self._sort_key(ordering)
+        merged = heapq.merge(rows, sorted(occurrences, key=key)[:stop], key=key)
+        return [item.ride() if isinstance(item, Occurrence) else item for item in islice(merged, start, stop)]
+
+    def count(self):
+        return self.queryset.count() + len(self.occurrences)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start, stop = index.start or 0, index.stop
+        if stop is None:
+            stop = self.count()
+        ordering = [field for field in self.queryset.query.order_by if isinstance(field, str)]
+        return self._merge(self.queryset[:stop], self.occurrences, ordering, start, stop)
+
+    def keyset(self, ordering, values, limit):
+        queryset = self.queryset.order_by(*ordering)
+        occurrences = self.occurrences
+        if values is not None:
+            queryset = queryset.filter(seek_after(ordering, values))
+            key = self._sort_key(ordering)
+            # A stand-in row holding the cursor's values, to compare occurrences against.
+            cursor = Ride(**{field.lstrip('-'): value for field, value in zip(ordering, values)})
+            occurrences = [o for o in occurrences if key(o) > key(cursor)]
+        return self._merge(queryset[:limit], occurrences, ordering, 0, limit)
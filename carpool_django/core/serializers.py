@@ -1,8 +1,37 @@
 from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError as DjangoValidationError
-from django.db.models import Sum
-from .models import User, Vehicle, Ride, Booking
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from carpool_common import routes
+from .models import User, Vehicle, Ride, RideSchedule, Booking
+
+
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """Primary key field that first looks ids up in ``context[context_key]``.
+
+    Bulk endpoints load every referenced object with one query and pass them
+    in as ``{pk: obj}``, instead of this field querying once per item.
+    """
+
+    def __init__(self, context_key, **kwargs):
+        self.context_key = context_key
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        preloaded = self.context.get(self.context_key)
+        if preloaded is None:
+            return super().to_internal_value(data)
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            return preloaded[int(data)]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -40,24 +69,52 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
 
 class UserProfileSerializer(serializers.ModelSerializer):
     vehicles = serializers.SerializerMethodField()
-    rides_count = serializers.SerializerMethodField()
-    bookings_count = serializers.SerializerMethodField()
+    rides_count = serializers.IntegerField(read_only=True)
+    upcoming_rides_count = serializers.IntegerField(read_only=True)
+    bookings_count = serializers.IntegerField(read_only=True)
+    upcoming_bookings_count = serializers.IntegerField(read_only=True)
+    seats_booked = serializers.IntegerField(read_only=True)
+    total_spend_cents = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = User
-        fields = ('id', 'username', 'email', 'first_name', 'last_name', 'phone', 'date_joined', 'vehicles', 'rides_count', 'bookings_count')
-        read_only_fields = ('id', 'date_joined', 'rides_count', 'bookings_count')
+        fields = ('id', 'username', 'email', 'first_name', 'last_name', 'phone', 'date_joined', 'vehicles',
+                  'rides_count', 'upcoming_rides_count', 'bookings_count', 'upcoming_bookings_count',
+                  'seats_booked', 'total_spend_cents')
+        read_only_fields = ('id', 'date_joined')
+
+    @staticmethod
+    def preload(queryset):
+        """Users with everything the profile shows: stats as subqueries of the user row, vehicles in one more query.
+
+        The stats are read from rides and bookings as they are, so there are no
+        counters to keep in step with concurrent writes.
+        """
+        def total(queryset, field, aggregate):
+            totals = queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(total=aggregate)
+            return Coalesce(Subquery(totals.values('total')), 0)
+
+        now = timezone.now()
+        rides, bookings = Ride.objects.all(), Booking.objects.all()
+        return queryset.annotate(
+            rides_count=total(rides, 'driver', Count('pk')),
+            upcoming_rides_count=total(rides.filter(departure_time__gte=now), 'driver', Count('pk')),
+            bookings_count=total(bookings, 'passenger', Count('pk')),
+            upcoming_bookings_count=total(bookings.filter(ride__departure_time__gte=now), 'passenger', Count('pk')),
+            seats_booked=total(bookings, 'passenger', Sum('seats')),
+            total_spend_cents=total(bookings, 'passenger', Sum(F('seats') * F('ride__price_cents'))),
+        ).prefetch_related('vehicles')
+
+    def to_representation(self, instance):
+        if not hasattr(instance, 'rides_count'):
+            # E.g. after an update: reload with the stats rather than querying them one by one.
+            instance = self.preload(User.objects).get(pk=instance.pk)
+        return super().to_representation(instance)
 
     def get_vehicles(self, obj):
         vehicles = obj.vehicles.all()
         return VehicleSerializer(vehicles, many=True).data
 
-    def get_rides_count(self, obj):
-        return obj.rides.count()
-
-    def get_bookings_count(self, obj):
-        return obj.bookings.count()
-
 
 class VehicleSerializer(serializers.ModelSerializer):
     owner_username = serializers.CharField(source='owner.username', read_only=True)
@@ -75,16 +132,22 @@ class VehicleSerializer(serializers.ModelSerializer):
 
 class RideSerializer(serializers.ModelSerializer):
     driver = UserSerializer(read_only=True)
+    vehicle = PreloadedPrimaryKeyRelatedField(
+        'vehicles', queryset=Vehicle.objects.all(), required=False, allow_null=True
+    )
+    origin_lat = serializers.FloatField(min_value=-90, max_value=90, required=False, allow_null=True)
+    origin_lon = serializers.FloatField(min_value=-180, max_value=180, required=False, allow_null=True)
+    destination_lat = serializers.FloatField(min_value=-90, max_value=90, required=False, allow_null=True)
+    destination_lon = serializers.FloatField(min_value=-180, max_value=180, required=False, allow_null=True)
     available_slots = serializers.SerializerMethodField()
     bookings_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Ride
-        fields = ('id', 'driver', 'vehicle', 'origin', 'destination', 'departure_time', 'available_seats', 'price_cents', 'available_slots', 'bookings_count')
-        read_only_fields = ('id', 'driver')
+        fields = ('id', 'driver', 'vehicle', 'origin', 'destination', 'origin_lat', 'origin_lon', 'destination_lat', 'destination_lon', 'waypoints', 'departure_time', 'available_seats', 'price_cents', 'available_slots', 'bookings_count', 'schedule', 'occurrence')
+        read_only_fields = ('id', 'driver', 'schedule', 'occurrence')
 
     def validate_departure_time(self, value):
-        from django.utils import timezone
         if value <= timezone.now():
             raise serializers.ValidationError("Departure time must be in the future.")
         return value
@@ -99,24 +162,67 @@ class RideSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Price cannot be negative.")
         return value
 
+    def validate_waypoints(self, value):
+        message = f"Expected a list of at most {routes.MAX_WAYPOINTS} [lat, lon] pairs."
+        if not isinstance(value, list) or len(value) > routes.MAX_WAYPOINTS:
+            raise serializers.ValidationError(message)
+        waypoints = []
+        for point in value:
+            try:
+                lat, lon = (float(part) for part in point)
+            except (TypeError, ValueError):
+                raise serializers.ValidationError(message)
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                raise serializers.ValidationError("Coordinates out of range.")
+            waypoints.append([lat, lon])
+        return waypoints
+
+    def validate(self, data):
+        route = {column: data.get(column, getattr(self.instance, column, None)) for column in routes.COLUMNS}
+        for endpoint in ('origin', 'destination'):
+            if (route[f'{endpoint}_lat'] is None) != (route[f'{endpoint}_lon'] is None):
+                raise serializers.ValidationError({f'{endpoint}_lat': "Give both coordinates or neither."})
+        if route['waypoints'] and routes.route_points(**route) is None:
+            raise serializers.ValidationError({"waypoints": "Waypoints need a geocoded origin and destination."})
+        return data
+
     def get_available_slots(self, obj):
-        booked = obj.bookings.aggregate(total=Sum('seats'))['total'] or 0
-        return max(0, obj.available_seats - booked)
+        return obj.seats_remaining
 
     def get_bookings_count(self, obj):
-        return obj.bookings.count()
+        # Querysets from RideViewSet carry ``bookings_count``; freshly saved instances don't.
+        count = getattr(obj, 'bookings_count', None)
+        if count is None:
+            count = obj.bookings.count()
+        return count
 
 
 class BookingSerializer(serializers.ModelSerializer):
+    ride = PreloadedPrimaryKeyRelatedField('rides', queryset=Ride.objects.all(), required=False)
+    # Books an unmaterialized schedule occurrence (the ``occurrence`` token from ride listings) instead of ``ride``.
+    occurrence = serializers.CharField(write_only=True, required=False)
     passenger = UserSerializer(read_only=True)
     ride_details = RideSerializer(source='ride', read_only=True)
     total_price = serializers.SerializerMethodField()
 
     class Meta:
         model = Booking
-        fields = ('id', 'ride', 'ride_details', 'passenger', 'seats', 'total_price', 'created_at')
+        fields = ('id', 'ride', 'occurrence', 'ride_details', 'passenger', 'seats', 'total_price', 'created_at')
         read_only_fields = ('id', 'passenger', 'created_at', 'ride_details')
 
+    def validate_occurrence(self, value):
+        """Resolve the token to ``(schedule, departure_time)``; the Ride is created when the booking is saved."""
+        try:
+            schedule_id, departure_time = RideSchedule.parse_occurrence(value)
+            schedule = RideSchedule.objects.get(pk=schedule_id)
+        except (ValueError, RideSchedule.DoesNotExist):
+            raise serializers.ValidationError("Unknown ride occurrence.")
+        if not schedule.is_departure(departure_time):
+            raise serializers.ValidationError("Unknown ride occurrence.")
+        if departure_time <= timezone.now():
+            raise serializers.ValidationError("This ride has already departed.")
+        return schedule, departure_time
+
     def validate_seats(self, value):
         if value < 1:
             raise serializers.ValidationError("Must book at least 1 seat.")
@@ -124,15 +230,73 @@ class BookingSerializer(serializers.ModelSerializer):
 
     def validate(self, data):
         ride = data.get('ride')
-        seats = data.get('seats')
-        
-        if ride:
-            booked = ride.bookings.aggregate(total=Sum('seats'))['total'] or 0
-            available = ride.available_seats - booked
-            if seats > available:
-                raise serializers.ValidationError(f"Only {available} seats available for this ride.")
+        # Partial updates keep the booking's seats and ride unless they change them.
+        seats = data.get('seats', self.instance.seats if self.instance is not None else 1)
+        occurrence = data.get('occurrence')
+        if ride and occurrence:
+            raise serializers.ValidationError("Give either a ride or an occurrence, not both.")
+        if occurrence:
+            schedule = occurrence[0]
+            if seats > schedule.available_seats:
+                raise serializers.ValidationError(f"Only {schedule.available_seats} seats available for this ride.")
+            return data
+        if not ride:
+            if self.instance is None:
+                raise serializers.ValidationError({"ride": "This field is required."})
+            ride = self.instance.ride
+
+        # Early rejection only; RideViewSet/BookingViewSet re-check atomically when reserving.
+        # A booking being changed already holds its seats on its own ride.
+        held = self.instance.seats if self.instance is not None and self.instance.ride_id == ride.pk else 0
+        if seats > ride.seats_remaining + held:
+            raise serializers.ValidationError(f"Only {ride.seats_remaining + held} seats available for this ride.")
         
         return data
 
     def get_total_price(self, obj):
         return obj.seats * obj.ride.price_cents
+
+
+class WeekdaysField(serializers.Field):
+    """Days of the week as a list, Monday = 0, stored as RideSchedule's bitmask."""
+
+    def to_representation(self, value):
+        return [day for day in range(7) if value >> day & 1]
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list) or not data or not all(
+            isinstance(day, int) and not isinstance(day, bool) and 0 <= day <= 6 for day in data
+        ):
+            raise serializers.ValidationError("Expected a non-empty list of weekdays from 0 (Monday) to 6 (Sunday).")
+        return sum(1 << day for day in set(data))
+
+
+class RideScheduleSerializer(serializers.ModelSerializer):
+    driver = UserSerializer(read_only=True)
+    weekdays = WeekdaysField(required=False)
+
+    class Meta:
+        model = RideSchedule
+        fields = ('id', 'driver', 'vehicle', 'origin', 'destination', 'departure_time', 'weekdays', 'starts_on', 'ends_on', 'available_seats', 'price_cents')
+        read_only_fields = ('id', 'driver')
+
+    def validate_departure_time(self, value):
+        # Occurrence tokens carry minutes.
+        return value.replace(second=0, microsecond=0)
+
+    def validate_available_seats(self, value):
+        if value < 1:
+            raise serializers.ValidationError("Available seats must be at least 1.")
+        return value
+
+    def validate_price_cents(self, value):
+        if value < 0:
+            raise serializers.ValidationError("Price cannot be negative.")
+        return value
+
+    def validate(self, data):
+        starts_on = data.get('starts_on', getattr(self.instance, 'starts_on', None))
+        ends_on = data.get('ends_on', getattr(self.instance, 'ends_on', None))
+        if starts_on and ends_on and ends_on < starts_on:
+            raise serializers.ValidationError({"ends_on": "Must not be before starts_on."})
+        return data
@@ -0,0 +1,82 @@
+from django.db import connections
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from carpool_common import routes, search
+from . import authentication, caching
+from .models import Booking, Ride, RideChange, RideSchedule, User, Vehicle, index_rides, index_routes
+
+
+@receiver(post_save, sender=Ride)
+def index_ride(sender, instance, using, update_fields, **kwargs):
+    index_rides([instance], using)
+    if update_fields is None or set(routes.INDEXED_COLUMNS) & update_fields:
+        index_routes([instance], using)
+
+
+@receiver(post_delete, sender=Ride)
+def unindex_ride(sender, instance, using, **kwargs):
+    if connections[using].vendor != 'sqlite':
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(search.FTS_DELETE_SQL, [instance.pk])
+
+
+@receiver(post_save, sender=Ride)
+@receiver(post_delete, sender=Ride)
+def invalidate_ride(sender, instance, using, **kwargs):
+    caching.invalidate_rides([instance.pk], using=using)
+
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+def invalidate_booked_ride(sender, instance, using, **kwargs):
+    # Seat counts and bookings_count are part of the ride responses.
+    caching.invalidate_rides([instance.ride_id], using=using)
+
+
+@receiver(post_save, sender=Ride)
+@receiver(post_delete, sender=Ride)
+def record_ride_change(sender, instance, using, **kwargs):
+    RideChange.record([instance.pk], using=using)
+
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+def record_booked_ride_change(sender, instance, using, **kwargs):
+    # Booking and cancelling change the ride's seats (see the gateway's availability feed).
+    RideChange.record([instance.ride_id], using=using)
+
+
+@receiver(post_delete, sender=Booking)
+def release_booked_seats(sender, instance, using, **kwargs):
+    # Every delete, not just Booking.cancel(): admin, cascades from the passenger, queryset deletes.
+    # When the ride itself is being deleted this updates nothing.
+    Ride.objects.db_manager(using).release_seats(instance.ride_id, instance.seats)
+
+
+@receiver(post_save, sender=RideSchedule)
+@receiver(post_delete, sender=RideSchedule)
+def invalidate_schedule(sender, instance, using, **kwargs):
+    caching.invalidate_schedules(using=using)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_user_status(sender, instance, using, **kwargs):
+    # Deactivated or deleted users lose access without waiting for the status TTL.
+    authentication.forget_user(instance.pk, using=using)
+
+
+@receiver(post_save, sender=User)
+def touch_user_resources(sender, instance, using, created, update_fields, **kwargs):
+    # Ride and vehicle responses embed the user (but not last_login, which every admin login writes).
+    if created or update_fields == frozenset({'last_login'}):
+        return
+    now = timezone.now()
+    rides = Ride.objects.using(using).filter(driver=instance)
+    ride_ids = list(rides.values_list('pk', flat=True))
+    rides.update(updated_at=now)
+    Vehicle.objects.using(using).filter(owner=instance).update(updated_at=now)
+    caching.invalidate_rides(ride_ids, using=using)
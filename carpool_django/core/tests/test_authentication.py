@@ -0,0 +1,63 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.views import APIView
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.authentication import ClaimsJWTAuthentication
+from core.models import Booking, Ride, User
+
+
+class ClaimsAuthOwnershipTests(TestCase):
+    """Owner checks compare ``request.user.pk`` with foreign key ids, so it must not be the string claim."""
+
+    def setUp(self):
+        caches['default'].clear()
+        patcher = mock.patch.object(APIView, 'authentication_classes', [ClaimsJWTAuthentication])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.driver = User.objects.create_user('driver')
+        self.passenger = User.objects.create_user('passenger')
+        self.ride = Ride.objects.create(driver=self.driver, origin='Berlin', destination='Leipzig',
+                                        departure_time=timezone.now() + timedelta(days=1), available_seats=3)
+
+    def auth(self, user):
+        return {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(user)}'}
+
+    def test_user_from_claims_has_integer_pk(self):
+        self.assertEqual(User.from_claims(str(self.driver.pk)).pk, self.driver.pk)
+
+    def test_owner_can_update_and_delete_ride(self):
+        response = self.client.patch(f'/api/rides/{self.ride.pk}/', {'price_cents': 900},
+                                     content_type='application/json', **self.auth(self.driver))
+        self.assertEqual(response.status_code, 200)
+        self.ride.refresh_from_db()
+        self.assertEqual(self.ride.price_cents, 900)
+
+        response = self.client.delete(f'/api/rides/{self.ride.pk}/', **self.auth(self.driver))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Ride.objects.filter(pk=self.ride.pk).exists())
+
+    def test_other_user_cannot_update_or_delete_ride(self):
+        response = self.client.patch(f'/api/rides/{self.ride.pk}/', {'price_cents': 900},
+                                     content_type='application/json', **self.auth(self.passenger))
+        self.assertEqual(response.status_code, 403)
+        response = self.client.delete(f'/api/rides/{self.ride.pk}/', **self.auth(self.passenger))
+        self.assertEqual(response.status_code, 403)
+        self.ride.refresh_from_db()
+        self.assertEqual(self.ride.price_cents, 0)
+
+    def test_passenger_can_cancel_own_booking(self):
+        response = self.client.post('/api/bookings/', {'ride': self.ride.pk, 'seats': 2},
+                                    content_type='application/json', **self.auth(self.passenger))
+        self.assertEqual(response.status_code, 201)
+        booking = Booking.objects.get(passenger=self.passenger)
+
+        response = self.client.post(f'/api/bookings/{booking.pk}/cancel/', **self.auth(self.passenger))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Booking.objects.filter(pk=booking.pk).exists())
+        self.ride.refresh_from_db()
+        self.assertEqual(self.ride.seats_booked, 0)
@@ -0,0 +1,229 @@
+import threading
+from datetime import timedelta
+
+from django.core.cache import caches
+from django.db import connection
+from django.test import Client, TestCase, TransactionTestCase
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.models import Booking, Ride, User
+
+
+def auth(user):
+    return {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(user)}'}
+
+
+def create_ride(driver, seats):
+    return Ride.objects.create(driver=driver, origin='Berlin', destination='Leipzig',
+                               departure_time=timezone.now() + timedelta(days=1), available_seats=seats)
+
+
+class BookingUpdateTests(TestCase):
+    """Changing a booking's seats or ride moves seats like booking and cancelling do."""
+
+    def setUp(self):
+        caches['default'].clear()
+        driver = User.objects.create_user('driver')
+        self.passenger = User.objects.create_user('passenger')
+        self.ride = create_ride(driver, 3)
+        self.other_ride = create_ride(driver, 2)
+        response = self.client.post('/api/bookings/', {'ride': self.ride.pk, 'seats': 1},
+                                    content_type='application/json', **auth(self.passenger))
+        self.assertEqual(response.status_code, 201)
+        self.booking = Booking.objects.get(pk=response.json()['id'])
+
+    def update(self, data):
+        return self.client.put(f'/api/bookings/{self.booking.pk}/', data, content_type='application/json',
+                               **auth(self.passenger))
+
+    def seats_booked(self, ride):
+        ride.refresh_from_db()
+        return ride.seats_booked
+
+    def test_more_seats_are_reserved(self):
+        response = self.update({'ride': self.ride.pk, 'seats': 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.seats_booked(self.ride), 3)
+
+    def test_fewer_seats_are_released(self):
+        self.update({'ride': self.ride.pk, 'seats': 3})
+        response = self.update({'ride': self.ride.pk, 'seats': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.seats_booked(self.ride), 1)
+
+    def test_no_more_seats_than_the_ride_has(self):
+        Ride.objects.reserve_seats(self.ride.pk, 1)
+        response = self.update({'ride': self.ride.pk, 'seats': 3})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.seats_booked(self.ride), 2)
+        self.booking.refresh_from_db()
+        self.assertEqual(self.booking.seats, 1)
+
+    def test_patch_seats_without_ride(self):
+        response = self.client.patch(f'/api/bookings/{self.booking.pk}/', {'seats': 2},
+                                     content_type='application/json', **auth(self.passenger))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['ride'], self.ride.pk)
+        self.assertEqual(self.seats_booked(self.ride), 2)
+
+    def test_patch_without_seats_keeps_them(self):
+        self.update({'ride': self.ride.pk, 'seats': 2})
+        response = self.client.patch(f'/api/bookings/{self.booking.pk}/', {'ride': self.other_ride.pk},
+                                     content_type='application/json', **auth(self.passenger))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['seats'], 2)
+        self.assertEqual(self.seats_booked(self.other_ride), 2)
+
+    def test_ride_is_required_when_booking(self):
+        response = self.client.post('/api/bookings/', {'seats': 1}, content_type='application/json',
+                                    **auth(self.passenger))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ride', response.json())
+
+    def test_moving_to_another_ride_moves_the_seats(self):
+        response = self.update({'ride': self.other_ride.pk, 'seats': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.seats_booked(self.ride), 0)
+        self.assertEqual(self.seats_booked(self.other_ride), 2)
+
+    def test_moving_to_a_full_ride_keeps_the_booking(self):
+        Ride.objects.reserve_seats(self.other_ride.pk, 2)
+        response = self.update({'ride': self.other_ride.pk, 'seats': 1})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.seats_booked(self.ride), 1)
+        self.assertEqual(self.seats_booked(self.other_ride), 2)
+
+
+class BookingDeleteTests(TestCase):
+    """However a booking goes away, its seats go back to the ride -- once."""
+
+    def setUp(self):
+        self.driver = User.objects.create_user('driver')
+        self.passenger = User.objects.create_user('passenger')
+        self.ride = create_ride(self.driver, 3)
+        Ride.objects.reserve_seats(self.ride.pk, 2)
+        self.booking = Booking.objects.create(ride=self.ride, passenger=self.passenger, seats=2)
+
+    def seats_booked(self):
+        self.ride.refresh_from_db()
+        return self.ride.seats_booked
+
+    def test_cancel_releases_the_seats_once(self):
+        self.booking.cancel()
+        self.booking.cancel()
+        self.assertEqual(self.seats_booked(), 0)
+
+    def test_deleting_the_passenger_releases_the_seats(self):
+        self.passenger.delete()
+        self.assertFalse(Booking.objects.exists())
+        self.assertEqual(self.seats_booked(), 0)
+
+    def test_queryset_delete_releases_the_seats(self):
+        Booking.objects.filter(ride=self.ride).delete()
+        self.assertEqual(self.seats_booked(), 0)
+
+    def test_deleting_the_ride_deletes_its_bookings(self):
+        self.ride.delete()
+        self.assertFalse(Booking.objects.exists())
+
+
+class BulkBookingTests(TestCase):
+    """Items in a bulk booking succeed or fail one by one, and only the booked ones take seats."""
+
+    def setUp(self):
+        caches['default'].clear()
+        driver = User.objects.create_user('driver')
+        self.passenger = User.objects.create_user('passenger')
+        self.ride = create_ride(driver, 3)
+        self.other_ride = create_ride(driver, 2)
+
+    def test_mixed_batch_with_an_oversubscribed_ride(self):
+        response = self.client.post('/api/bookings/bulk/', [
+            {'ride': self.ride.pk, 'seats': 2},
+            {'ride': self.other_ride.pk, 'seats': 1},
+            # Only one seat is left on the first ride after the first item.
+            {'ride': self.ride.pk, 'seats': 2},
+            {'ride': self.ride.pk, 'seats': 1},
+        ], content_type='application/json', **auth(self.passenger))
+        self.assertEqual(response.status_code, 207)
+        data = response.json()
+        self.assertEqual((data['created'], data['failed']), (3, 1))
+        bookings = Booking.objects.filter(passenger=self.passenger)
+        self.assertEqual([result.get('id') for result in data['results']],
+                         [bookings.get(ride=self.ride, seats=2).pk, bookings.get(ride=self.other_ride).pk, None,
+                          bookings.get(ride=self.ride, seats=1).pk])
+        self.assertEqual(data['results'][2], {
+            'index': 2, 'errors': {'non_field_errors': ["Only 1 seats available for this ride."]},
+        })
+        self.ride.refresh_from_db()
+        self.other_ride.refresh_from_db()
+        self.assertEqual((self.ride.seats_booked, self.other_ride.seats_booked), (3, 1))
+
+    def test_nothing_booked_is_a_400(self):
+        response = self.client.post('/api/bookings/bulk/', [{'ride': self.other_ride.pk, 'seats': 3}],
+                                    content_type='application/json', **auth(self.passenger))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Booking.objects.exists())
+        self.other_ride.refresh_from_db()
+        self.assertEqual(self.other_ride.seats_booked, 0)
+
+
+class ConcurrentBookingTests(TransactionTestCase):
+    """Passengers racing for the last seats never book more than the ride has."""
+
+    PASSENGERS = 8
+    SEATS = 3
+
+    def setUp(self):
+        caches['default'].clear()
+        driver = User.objects.create_user('driver')
+        self.passengers = [User.objects.create_user(f'passenger{i}') for i in range(self.PASSENGERS)]
+        self.ride = create_ride(driver, self.SEATS)
+
+    def race(self, request):
+        barrier = threading.Barrier(len(self.passengers))
+        statuses = []
+
+        def run(passenger):
+            client = Client(raise_request_exception=False)
+            barrier.wait()
+            try:
+                statuses.append(request(client, passenger).status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(passenger,)) for passenger in self.passengers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return statuses
+
+    def assert_not_oversold(self):
+        self.ride.refresh_from_db()
+        booked = sum(Booking.objects.filter(ride=self.ride).values_list('seats', flat=True))
+        self.assertEqual(self.ride.seats_booked, booked)
+        self.assertLessEqual(booked, self.SEATS)
+        return booked
+
+    def test_concurrent_bookings(self):
+        statuses = self.race(lambda client, passenger: client.post(
+            '/api/bookings/', {'ride': self.ride.pk, 'seats': 1}, content_type='application/json', **auth(passenger),
+        ))
+        self.assertEqual(sorted(statuses), [201] * self.SEATS + [400] * (self.PASSENGERS - self.SEATS))
+        self.assertEqual(self.assert_not_oversold(), self.SEATS)
+
+    def test_concurrent_seat_increases(self):
+        # One seat left, and every other seat held by a one-seat booking that now asks for a second.
+        self.passengers = self.passengers[:self.SEATS - 1]
+        bookings = {}
+        for passenger in self.passengers:
+            Ride.objects.reserve_seats(self.ride.pk, 1)
+            bookings[passenger.pk] = Booking.objects.create(ride=self.ride, passenger=passenger, seats=1).pk
+        statuses = self.race(lambda client, passenger: client.put(
+            f'/api/bookings/{bookings[passenger.pk]}/', {'ride': self.ride.pk, 'seats': 2},
+            content_type='application/json', **auth(passenger),
+        ))
+        self.assertEqual(sorted(statuses), [200] + [400] * (len(self.passengers) - 1))
+        self.assertEqual(self.assert_not_oversold(), self.SEATS)
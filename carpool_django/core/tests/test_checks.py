@@ -0,0 +1,22 @@
+from django.core.checks import run_checks
+from django.test import SimpleTestCase, override_settings
+
+LOCMEM = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'checks'}}
+
+
+class SharedCacheCheckTests(SimpleTestCase):
+    def errors(self):
+        return [message.id for message in run_checks(tags=['caches'])]
+
+    @override_settings(CACHES=LOCMEM, CARPOOL_WORKERS=4)
+    def test_local_memory_cache_with_several_workers_fails(self):
+        self.assertEqual(self.errors(), ['core.E001'])
+
+    @override_settings(CACHES=LOCMEM, CARPOOL_WORKERS=1)
+    def test_local_memory_cache_with_one_worker_passes(self):
+        self.assertEqual(self.errors(), [])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                                           'LOCATION': 'redis://localhost:6379/1'}}, CARPOOL_WORKERS=4)
+    def test_shared_cache_with_several_workers_passes(self):
+        self.assertEqual(self.errors(), [])
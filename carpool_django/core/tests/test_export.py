@@ -0,0 +1,29 @@
+from django.test import TestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.models import User
+
+
+class ExportParameterTests(TestCase):
+    """Bad watermarks get a fixed message, never the parser's own error text."""
+
+    def setUp(self):
+        admin = User.objects.create_user('admin', is_staff=True)
+        self.headers = {'Authorization': f'Bearer {AccessToken.for_user(admin)}'}
+
+    def errors(self, query):
+        response = self.client.get(f'/api/export/bookings.ndjson?{query}', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+        return response.json()
+
+    def test_since(self):
+        for since in ('yesterday', '2030-13-45T00:00:00'):
+            self.assertEqual(self.errors(f'since={since}'), {'since': 'must be an integer or an ISO-8601 datetime'})
+
+    def test_since_id(self):
+        self.assertEqual(self.errors('since=2030-01-01T00:00:00&since_id=abc'), {'since_id': 'must be an integer'})
+
+    def test_valid_watermark(self):
+        response = self.client.get('/api/export/bookings.ndjson?since=2030-01-01T00:00:00&since_id=3',
+                                   headers=self.headers)
+        self.assertEqual(response.status_code, 200)
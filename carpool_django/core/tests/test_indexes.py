@@ -0,0 +1,84 @@
+from datetime import timedelta
+
+from django.core.cache import caches
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core import export
+from core.models import Booking, Ride, User
+
+RIDES = 200
+
+
+class MainQueryIndexTests(TestCase):
+    """The main query of each hot listing reads its table through the index added for it.
+
+    The query is the one the endpoint actually runs, captured from a request
+    and fed to EXPLAIN. PostgreSQL is told to avoid sequential scans, which
+    it would otherwise prefer on a table this small.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.passenger = User.objects.create_user('passenger')
+        drivers = [User.objects.create_user(f'driver{i}') for i in range(10)]
+        departure = timezone.now() + timedelta(days=1)
+        rides = Ride.objects.bulk_create([
+            Ride(driver=drivers[i % len(drivers)], origin=f'Origin {i % 7}', destination=f'Destination {i % 5}',
+                 departure_time=departure + timedelta(hours=i), available_seats=3, seats_booked=3 if i % 4 else 1)
+            for i in range(RIDES)
+        ])
+        Booking.objects.bulk_create([Booking(ride=ride, passenger=cls.passenger, seats=1) for ride in rides[::3]])
+        cls.driver = drivers[0]
+
+    def setUp(self):
+        caches['default'].clear()
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                # TestCase runs in a transaction, so this lasts until the test ends.
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def main_query(self, path, table, user=None):
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(user)}'} if user else {}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path, **headers)
+        self.assertEqual(response.status_code, 200)
+        prefix = f'SELECT "{table}"."id"'
+        selects = [query['sql'] for query in queries if query['sql'].startswith(prefix) and 'ORDER BY' in query['sql']]
+        self.assertEqual(len(selects), 1, f"expected one ordered SELECT from {table}")
+        return selects[0]
+
+    def plan(self, sql, params=()):
+        explain = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        with connection.cursor() as cursor:
+            cursor.execute(explain + sql, params)
+            return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+
+    def assert_uses_index(self, path, table, index, user=None):
+        plan = self.plan(self.main_query(path, table, user))
+        self.assertIn(index, plan, f"{path} does not use {index}:\n{plan}")
+
+    def test_ride_list(self):
+        self.assert_uses_index('/api/rides/', 'core_ride', 'ride_departure_seats_idx')
+
+    def test_available_ride_list(self):
+        self.assert_uses_index('/api/rides/?available_only=true', 'core_ride', 'ride_open_departure_idx')
+
+    def test_my_rides(self):
+        self.assert_uses_index('/api/rides/my_rides/', 'core_ride', 'ride_driver_departure_idx', self.driver)
+
+    def test_booking_list(self):
+        self.assert_uses_index('/api/bookings/', 'core_booking', 'booking_passenger_created_idx', self.passenger)
+
+    def test_my_bookings(self):
+        self.assert_uses_index('/api/bookings/my_bookings/', 'core_booking', 'booking_passenger_created_idx',
+                               self.passenger)
+
+    def test_incremental_booking_export(self):
+        # Streamed, so the query is built here rather than captured from a request.
+        since = Booking.objects.order_by('updated_at').values_list('updated_at', 'id')[10]
+        plan = self.plan(*export.rows('bookings', *since).query.sql_with_params())
+        self.assertIn('booking_updated_idx', plan, f"the bookings export does not use booking_updated_idx:\n{plan}")
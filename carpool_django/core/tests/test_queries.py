@@ -0,0 +1,56 @@
+from datetime import timedelta
+
+from django.core.cache import caches
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.models import Booking, Ride, User, Vehicle
+
+RIDES = 30
+
+
+class ListQueryCountTests(TestCase):
+    """Listing pages costs the same number of queries whatever their size (no per-row queries)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.passenger = User.objects.create_user('passenger')
+        departure = timezone.now() + timedelta(days=1)
+        for i in range(RIDES):
+            driver = User.objects.create_user(f'driver{i}')
+            vehicle = Vehicle.objects.create(owner=driver, make='Skoda', model='Octavia', plate_number=f'B-{i}')
+            ride = Ride.objects.create(driver=driver, vehicle=vehicle, origin='Berlin', destination='Leipzig',
+                                       departure_time=departure + timedelta(minutes=i), available_seats=4,
+                                       seats_booked=2)
+            Booking.objects.create(ride=ride, passenger=cls.passenger, seats=2)
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def count_queries(self, path, page_size, **headers):
+        caches['default'].clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path, {'page_size': page_size}, **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), page_size)
+        return len(queries)
+
+    def assert_constant(self, path, **headers):
+        counts = {page_size: self.count_queries(path, page_size, **headers) for page_size in (1, 10, RIDES)}
+        self.assertEqual(len(set(counts.values())), 1, f"queries by page size: {counts}")
+
+    def test_ride_list(self):
+        self.assert_constant('/api/rides/')
+
+    def test_booking_list(self):
+        self.assert_constant('/api/bookings/',
+                             HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.passenger)}')
+
+    def test_ride_list_counts_come_from_annotations(self):
+        response = self.client.get('/api/rides/', {'page_size': 1})
+        ride = response.json()['results'][0]
+        self.assertEqual(ride['bookings_count'], 1)
+        self.assertEqual(ride['available_slots'], 2)
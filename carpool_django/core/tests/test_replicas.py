@@ -0,0 +1,119 @@
+import sqlite3
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import skipUnless
+
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.models import Ride, User
+
+REPLICA = 'test_replica'
+WINDOW = 0.5
+PATH = '/api/users/me/'
+
+
+def headers(user):
+    return {'Authorization': f'Bearer {AccessToken.for_user(user)}'}
+
+
+@skipUnless(connection.vendor == 'sqlite' and not connection.is_in_memory_db(),
+            "the replica is a copy of the SQLite test database file")
+@override_settings(CARPOOL_READ_REPLICAS=[REPLICA], DATABASE_ROUTERS=['core.replicas.ReplicaRouter'],
+                   CARPOOL_REPLICA_STICKY_SECONDS=WINDOW)
+class ReadYourWritesTests(TransactionTestCase):
+    """GETs read a replica, and a write pins its user -- only that user -- to the primary for the window.
+
+    The replica is a snapshot of the test database taken before the primary
+    moves on, so every response shows which of the two served it: the replica
+    still has the users' empty ``last_name`` and the ride's old price.
+    """
+
+    # Resolved in setUpClass, after the replica alias is added (the runner only creates the test database).
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        connections.settings[REPLICA] = {**connections.settings[DEFAULT_DB_ALIAS],
+                                         'NAME': str(Path(cls.directory.name) / 'replica.db')}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections[REPLICA].close()
+        del connections[REPLICA]
+        del connections.settings[REPLICA]
+        cls.directory.cleanup()
+
+    def setUp(self):
+        caches['default'].clear()
+        self.writer = User.objects.create_user('writer', first_name='before')
+        self.reader = User.objects.create_user('reader', first_name='before')
+        self.ride = Ride.objects.create(driver=self.writer, origin='Berlin', destination='Leipzig',
+                                        departure_time=timezone.now() + timedelta(days=1), available_seats=3,
+                                        price_cents=1000)
+        self.replicate()
+        User.objects.update(last_name='primary')
+        Ride.objects.update(price_cents=1200)
+
+    def replicate(self):
+        """Copy the primary over the replica, standing in for replication."""
+        connections[REPLICA].close()
+        source = sqlite3.connect(connection.settings_dict['NAME'])
+        target = sqlite3.connect(connections[REPLICA].settings_dict['NAME'])
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+
+    def get(self, user):
+        response = self.client.get(PATH, headers=headers(user))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def write(self):
+        response = self.client.put(PATH, {'first_name': 'after'}, content_type='application/json',
+                                   headers=headers(self.writer))
+        self.assertEqual(response.status_code, 200)
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.get(self.writer)['last_name'], '')
+
+    def test_writer_reads_the_primary_within_the_window(self):
+        self.write()
+        started = time.monotonic()
+        data = self.get(self.writer)
+        self.assertLess(time.monotonic() - started, WINDOW, "too slow to check inside the window")
+        self.assertEqual((data['first_name'], data['last_name']), ('after', 'primary'))
+
+    def test_other_users_keep_reading_the_replica(self):
+        self.write()
+        self.assertEqual(self.get(self.reader)['last_name'], '')
+
+    def test_writer_reads_the_replica_after_the_window(self):
+        self.write()
+        time.sleep(WINDOW + 0.1)
+        data = self.get(self.writer)
+        self.assertEqual((data['first_name'], data['last_name']), ('before', ''))
+
+    def test_cached_responses_are_rendered_from_the_primary(self):
+        response = self.client.get(f'/api/rides/{self.ride.pk}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['price_cents'], 1200)
+
+    async def test_async_requests_are_pinned_too(self):
+        response = await self.async_client.put(PATH, {'first_name': 'after'}, content_type='application/json',
+                                               headers=headers(self.writer))
+        self.assertEqual(response.status_code, 200)
+        response = await self.async_client.get(PATH, headers=headers(self.writer))
+        self.assertEqual(response.json()['last_name'], 'primary')
+        response = await self.async_client.get(PATH, headers=headers(self.reader))
+        self.assertEqual(response.json()['last_name'], '')
@@ -0,0 +1,149 @@
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import TestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core import schedules
+from core.models import Booking, Ride, RideSchedule, User
+
+# A Monday noon, far enough ahead that every departure below is in the future for real too.
+NOW = datetime(2030, 1, 7, 12, 0, tzinfo=dt_timezone.utc)
+TODAY = NOW.date()
+
+
+def at(days, hour):
+    return datetime.combine(TODAY + timedelta(days=days), time(hour), tzinfo=dt_timezone.utc)
+
+
+def frozen(moment=NOW):
+    return mock.patch('django.utils.timezone.now', return_value=moment)
+
+
+class ScheduleTestCase(TestCase):
+    """Daily 08:00 and 18:00 schedules from yesterday to three days ahead, and one-off rides around them."""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.driver = User.objects.create_user('driver')
+        self.passenger = User.objects.create_user('passenger')
+        self.schedules = {
+            hour: RideSchedule.objects.create(
+                driver=self.driver, origin='Berlin', destination='Leipzig', departure_time=time(hour),
+                weekdays=0b1111111, starts_on=TODAY - timedelta(days=1), ends_on=TODAY + timedelta(days=3),
+                available_seats=3, price_cents=900,
+            )
+            for hour in (8, 18)
+        }
+        self.rides = [
+            Ride.objects.create(driver=self.driver, origin='Berlin', destination='Dresden', departure_time=departure,
+                                available_seats=2)
+            for departure in (at(-1, 10), at(1, 18), at(2, 9), at(5, 10))
+        ]
+
+    def expected(self):
+        """Listing keys in cursor order: occurrences from now on, before concrete rides departing at the same time."""
+        occurrences = [(at(day, hour), 0, RideSchedule.occurrence_token(self.schedules[hour].pk, at(day, hour)))
+                       for day in range(4) for hour in (8, 18) if at(day, hour) >= NOW]
+        concrete = [(ride.departure_time, 1, ride.pk) for ride in self.rides]
+        return [key for _, _, key in sorted(occurrences + concrete)]
+
+    @staticmethod
+    def key(item):
+        return item['id'] or item['occurrence']
+
+    def assertListed(self, items, expected):
+        """``items`` are the ``expected`` rides by departure time; page numbers order by nothing else."""
+        self.assertCountEqual([self.key(item) for item in items], expected)
+        departures = [item['departure_time'] for item in items]
+        self.assertEqual(departures, sorted(departures))
+
+
+class OccurrenceWindowTests(ScheduleTestCase):
+    def test_default_window_starts_now(self):
+        with frozen():
+            start, end = schedules.occurrence_window(None, None)
+            departures = [o.departure_time for o in schedules.occurrences(None, None, [], False)]
+        self.assertEqual((start, end), (NOW, at(schedules.WINDOW_DAYS, 0)))
+        self.assertEqual(departures, [at(0, 18), at(1, 8), at(1, 18), at(2, 8), at(2, 18), at(3, 8), at(3, 18)])
+
+    def test_requested_window_is_kept(self):
+        with frozen():
+            self.assertEqual(schedules.occurrence_window(at(-1, 0), at(1, 0)), (at(-1, 0), at(1, 0)))
+
+    def test_departed_occurrences_leave_the_cached_list(self):
+        with frozen(at(0, 7)):
+            before = [self.key(item) for item in self.client.get('/api/rides/?page_size=50').json()['results']]
+        with frozen(at(0, 9)):
+            response = self.client.get('/api/rides/?page_size=50')
+        departed = RideSchedule.occurrence_token(self.schedules[8].pk, at(0, 8))
+        self.assertIn(departed, before)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertNotIn(departed, [self.key(item) for item in response.json()['results']])
+
+
+class MergedRidesTests(ScheduleTestCase):
+    """Pages through concrete rides and occurrences as one list, both ways the API paginates."""
+
+    def pages(self, url):
+        seen = []
+        while url:
+            with frozen():
+                data = self.client.get(url).json()
+            self.assertLessEqual(len(data['results']), 3)
+            seen.extend(data['results'])
+            url = data['next']
+        return seen
+
+    def test_page_numbers(self):
+        with frozen():
+            self.assertEqual(self.client.get('/api/rides/?page_size=3').json()['count'], 11)
+        self.assertListed(self.pages('/api/rides/?page_size=3'), self.expected())
+
+    def test_cursor(self):
+        self.assertEqual([self.key(item) for item in self.pages('/api/rides/?page_size=3&cursor=')], self.expected())
+
+    def test_slices_and_keyset(self):
+        with frozen():
+            merged = schedules.MergedRides(Ride.objects.order_by('departure_time', 'id'),
+                                           schedules.occurrences(None, None, [], False))
+            self.assertEqual(merged.count(), 11)
+            rows = merged[5:8]
+            after = merged.keyset(('departure_time', 'id'), [rows[0].departure_time, merged.sort_value(rows[0], 'id')],
+                                  2)
+        self.assertEqual([ride.pk or ride.occurrence for ride in rows], self.expected()[5:8])
+        self.assertEqual([ride.pk or ride.occurrence for ride in after], self.expected()[6:8])
+        # Occurrences come out as unsaved rides.
+        self.assertEqual([ride.pk for ride in rows if ride.schedule_id], [None, None])
+
+
+class MaterializeTests(ScheduleTestCase):
+    def test_creates_the_ride_once(self):
+        schedule = self.schedules[18]
+        ride = schedule.materialize(at(1, 18))
+        self.assertEqual(schedule.materialize(at(1, 18)).pk, ride.pk)
+        ride.refresh_from_db()
+        self.assertEqual(
+            (ride.schedule_id, ride.driver_id, ride.origin, ride.available_seats, ride.price_cents, ride.seats_booked),
+            (schedule.pk, self.driver.pk, 'Berlin', 3, 900, 0),
+        )
+        self.assertEqual(ride.occurrence, RideSchedule.occurrence_token(schedule.pk, at(1, 18)))
+
+    def test_materialized_occurrence_is_listed_as_its_ride(self):
+        ride = self.schedules[18].materialize(at(1, 18))
+        expected = [ride.pk if key == ride.occurrence else key for key in self.expected()]
+        with frozen():
+            data = self.client.get('/api/rides/?page_size=50').json()
+        self.assertListed(data['results'], expected)
+
+    def test_booking_an_occurrence_materializes_it(self):
+        token = RideSchedule.occurrence_token(self.schedules[8].pk, at(2, 8))
+        with frozen():
+            response = self.client.post('/api/bookings/', {'occurrence': token, 'seats': 2},
+                                        content_type='application/json',
+                                        headers={'Authorization': f'Bearer {AccessToken.for_user(self.passenger)}'})
+        self.assertEqual(response.status_code, 201)
+        ride = Ride.objects.get(schedule=self.schedules[8], departure_time=at(2, 8))
+        self.assertEqual(Booking.objects.get(pk=response.json()['id']).ride_id, ride.pk)
+        self.assertEqual(ride.seats_booked, 2)
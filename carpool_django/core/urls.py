@@ -1,17 +1,44 @@
-from django.urls import path, include
+from django.conf import settings
+from django.urls import path, re_path, include
 from rest_framework.routers import DefaultRouter
+
+from . import async_views
 from .views import (
-    VehicleViewSet, RideViewSet, BookingViewSet,
-    UserRegistrationView, UserProfileView
+    VehicleViewSet, RideViewSet, RideScheduleViewSet, BookingViewSet,
+    UserRegistrationView, UserProfileView, SlowQueriesView, ExportView
 )
 
 router = DefaultRouter()
 router.register(r'vehicles', VehicleViewSet, basename='vehicle')
 router.register(r'rides', RideViewSet, basename='ride')
+router.register(r'ride-schedules', RideScheduleViewSet, basename='ride-schedule')
 router.register(r'bookings', BookingViewSet, basename='booking')
 
-urlpatterns = [
+profile_view = UserProfileView.as_view()
+
+if settings.CARPOOL_ASYNC_READS:
+    # GETs of the hot read endpoints through core.async_views; other methods still reach the viewsets.
+    # Named like the router's routes, so metrics label the requests the same either way.
+    read_path = async_views.read_path
+    urlpatterns = [
+        path('rides/', read_path(async_views.ride_list, RideViewSet.as_view({'get': 'list', 'post': 'create'})),
+             name='ride-list'),
+        re_path(r'^rides/(?P<pk>[0-9]+)/$', read_path(async_views.ride_detail, RideViewSet.as_view({
+            'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy',
+        })), name='ride-detail'),
+        re_path(r'^rides/(?P<pk>[0-9]+)/availability/$', read_path(
+            async_views.ride_availability, RideViewSet.as_view({'get': 'availability'}),
+        ), name='ride-availability'),
+    ]
+    profile_view = read_path(async_views.profile, profile_view)
+else:
+    urlpatterns = []
+
+urlpatterns += [
     path('', include(router.urls)),
     path('auth/register/', UserRegistrationView.as_view(), name='user_register'),
-    path('users/me/', UserProfileView.as_view(), name='user_profile'),
+    path('users/me/', profile_view, name='user_profile'),
+    path('metrics/slow-queries/', SlowQueriesView.as_view(), name='slow_queries'),
+    re_path(r'^export/(?P<dataset>rides|bookings|vehicles)\.(?P<encoding>ndjson|csv)$', ExportView.as_view(),
+            name='export'),
 ]
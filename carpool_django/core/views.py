@@ -1,23 +1,29 @@
-from rest_framework import viewsets, permissions, status, filters, pagination
+from rest_framework import viewsets, permissions, status, filters
 from rest_framework.decorators import action
+from rest_framework.negotiation import BaseContentNegotiation
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.settings import api_settings
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from django.db.models import Q, Sum
-from .models import User, Vehicle, Ride, Booking
+from django.db import transaction
+from django.db.models import F, Prefetch, Q
+
+from carpool_common import routes
+from . import caching, export, instrumentation, replicas, schedules
+from .bulk import bulk_items, bulk_response, referenced_ids, validate_items
+from .conditional import conditional, list_validators, object_validators
+from .models import User, Vehicle, Ride, RideChange, RideSchedule, Booking
+from .pagination import StandardResultsSetPagination
 from .serializers import (
-    VehicleSerializer, RideSerializer, BookingSerializer,
+    VehicleSerializer, RideSerializer, RideScheduleSerializer, BookingSerializer,
     UserSerializer, UserRegistrationSerializer, UserProfileSerializer
 )
 
 
-class StandardResultsSetPagination(pagination.PageNumberPagination):
-    page_size = 10
-    page_size_query_param = 'page_size'
-    max_page_size = 100
-
-
 class UserRegistrationView(APIView):
     permission_classes = [permissions.AllowAny]
 
@@ -36,8 +42,8 @@ class UserProfileView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request):
-        serializer = UserProfileSerializer(request.user)
-        return Response(serializer.data)
+        user = UserProfileSerializer.preload(User.objects).get(pk=request.user.pk)
+        return Response(UserProfileSerializer(user).data)
 
     def put(self, request):
         serializer = UserProfileSerializer(request.user, data=request.data, partial=True)
@@ -47,6 +53,53 @@ class UserProfileView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class SlowQueriesView(APIView):
+    """Latest queries slower than CARPOOL_SLOW_QUERY_MS, with the project frames that ran them."""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            "threshold_ms": instrumentation.queries.threshold_ms,
+            "total": instrumentation.queries.slow_total,
+            "samples": instrumentation.queries.samples(),
+        })
+
+
+class IgnoreClientContentNegotiation(BaseContentNegotiation):
+    """Exports pick their format from the URL; errors are rendered with the first renderer."""
+
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+class ExportView(APIView):
+    """Stream a whole table as NDJSON or CSV (see core.export), e.g. ``/api/export/rides.ndjson?since=1200``."""
+    permission_classes = [permissions.IsAdminUser]
+    content_negotiation_class = IgnoreClientContentNegotiation
+
+    def get(self, request, dataset, encoding):
+        # Fixed messages: the parsers' own errors would echo internals back to the client.
+        since_id = request.query_params.get('since_id')
+        if since_id is not None and not since_id.isdecimal():
+            raise ValidationError({"since_id": "must be an integer"})
+        try:
+            since, since_id = export.parse_since(request.query_params.get('since'), since_id)
+        except ValueError:
+            raise ValidationError({"since": "must be an integer or an ISO-8601 datetime"})
+        queryset = export.rows(dataset, since, since_id)
+        encoder = export.ENCODERS[encoding](export.DATASETS[dataset][1])
+        if isinstance(request._request, ASGIRequest):
+            content = export.astream(queryset, encoder)
+        else:
+            content = export.stream(queryset, encoder)
+        response = StreamingHttpResponse(content, content_type=export.CONTENT_TYPES[encoding])
+        response['Content-Disposition'] = f'attachment; filename="{dataset}.{encoding}"'
+        return response
+
+
 class VehicleViewSet(viewsets.ModelViewSet):
     serializer_class = VehicleSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
@@ -59,23 +112,31 @@ class VehicleViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         return Vehicle.objects.all()
 
+    def list(self, request, *args, **kwargs):
+        return conditional(
+            request,
+            lambda: list_validators(request, self.filter_queryset(self.get_queryset())),
+            lambda: super(VehicleViewSet, self).list(request, *args, **kwargs),
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        return conditional(
+            request,
+            lambda: object_validators(request, Vehicle.objects, kwargs['pk']),
+            lambda: super(VehicleViewSet, self).retrieve(request, *args, **kwargs),
+        )
+
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
     def perform_update(self, serializer):
-        if serializer.instance.owner != self.request.user:
-            return Response(
-                {"error": "You can only update your own vehicles"},
-                status=status.HTTP_403_FORBIDDEN
-            )
+        if serializer.instance.owner_id != self.request.user.pk:
+            raise PermissionDenied("You can only update your own vehicles")
         serializer.save()
 
     def perform_destroy(self, instance):
-        if instance.owner != self.request.user:
-            return Response(
-                {"error": "You can only delete your own vehicles"},
-                status=status.HTTP_403_FORBIDDEN
-            )
+        if instance.owner_id != self.request.user.pk:
+            raise PermissionDenied("You can only delete your own vehicles")
         instance.delete()
 
     @action(detail=False, methods=['get'], permission_classes=[permissions.IsAuthenticated])
@@ -89,62 +150,191 @@ class RideViewSet(viewsets.ModelViewSet):
     serializer_class = RideSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     pagination_class = StandardResultsSetPagination
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
-    search_fields = ['origin', 'destination']
+    filter_backends = [filters.OrderingFilter]
     ordering_fields = ['departure_time', 'price_cents']
     ordering = ['departure_time']
+    keyset_ordering = ('departure_time', 'id')
 
     def get_queryset(self):
-        queryset = Ride.objects.all()
-        origin = self.request.query_params.get('origin')
-        destination = self.request.query_params.get('destination')
-        available_only = self.request.query_params.get('available_only', 'false').lower() == 'true'
-
-        if origin:
-            queryset = queryset.filter(origin__icontains=origin)
-        if destination:
-            queryset = queryset.filter(destination__icontains=destination)
+        return self._filter(Ride.objects.select_related('driver').with_booking_stats())
+
+    def _list_filters(self):
+        params = self.request.query_params
+        searches = [(params.get('search'), None), (params.get('origin'), 'origin'), (params.get('destination'), 'destination')]
+        available_only = params.get('available_only', 'false').lower() == 'true'
+        return searches, available_only, schedules.requested_window(self.request), self._route()
+
+    def _route(self):
+        """``(pickup, dropoff, radius_m)`` from ``?pickup=lat,lon&dropoff=lat,lon&radius=``, or None."""
+        params = self.request.query_params
+        if 'pickup' not in params and 'dropoff' not in params:
+            return None
+        points = {}
+        for name in ('pickup', 'dropoff'):
+            try:
+                points[name] = routes.parse_point(params.get(name))
+            except ValueError:
+                raise ValidationError({name: 'must be "lat,lon" with coordinates in range'})
+        try:
+            radius = float(params.get('radius', routes.DEFAULT_RADIUS_M))
+        except ValueError:
+            radius = -1
+        if not 0 < radius <= routes.MAX_RADIUS_M:
+            raise ValidationError({'radius': f"Expected meters between 0 and {routes.MAX_RADIUS_M}."})
+        return points['pickup'], points['dropoff'], radius
+
+    def _filter(self, queryset):
+        searches, available_only, (after, before), route = self._list_filters()
+
+        # Indexed search (see carpool_common.search)
+        for value, field in searches:
+            if value:
+                queryset = queryset.search(value, field)
+        if any(value for value, _ in searches):
+            # Best matches first unless the client asked for ?ordering=
+            self.ordering = ['-search_rank', 'departure_time']
         if available_only:
-            queryset = queryset.filter(available_seats__gt=0)
+            queryset = queryset.filter(available_seats__gt=F('seats_booked'))
+        if after:
+            queryset = queryset.filter(departure_time__gte=after)
+        if before:
+            queryset = queryset.filter(departure_time__lt=before)
+        if route:
+            # Grid-pruned route matching (see carpool_common.routes)
+            queryset = queryset.along_route(*route, after=after, before=before)
 
         return queryset
 
+    def paginate_queryset(self, queryset):
+        if self.action == 'list':
+            # Unbooked occurrences of ride schedules are listed alongside concrete rides.
+            searches, available_only, (after, before), route = self._list_filters()
+            # Schedules aren't geocoded, so route searches only return concrete rides.
+            occurrences = [] if route else schedules.occurrences(after, before, searches, available_only)
+            if occurrences:
+                queryset = schedules.MergedRides(queryset, occurrences)
+        return super().paginate_queryset(queryset)
+
+    def _cached(self, key, render):
+        # Read-through: ride responses are the same for every user (see core.caching).
+        data = caching.get(key) if key else None
+        if data is not None:
+            return Response(data, headers={'X-Cache': 'HIT'})
+        if key:
+            # Cached until invalidated, so never from a lagging replica.
+            with replicas.primary():
+                response = render()
+        else:
+            response = render()
+        if key and response.status_code == status.HTTP_200_OK:
+            caching.put(key, response.data)
+        response['X-Cache'] = 'MISS'
+        return response
+
+    def _ride_key(self, kind):
+        pk = self.kwargs[self.lookup_field]
+        return caching.ride_key(kind, int(pk)) if pk.isdigit() else None
+
+    def list(self, request, *args, **kwargs):
+        # The validators skip the booking stats annotation: updated_at already moves with seats_booked.
+        return conditional(
+            request,
+            lambda: list_validators(request, self._filter(Ride.objects.all()), *schedules.state()),
+            lambda: self._cached(
+                caching.list_key(request, schedules.window_state()), lambda: super(RideViewSet, self).list(request, *args, **kwargs)
+            ),
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        return conditional(
+            request,
+            lambda: object_validators(request, Ride.objects, kwargs['pk']),
+            lambda: self._cached(
+                self._ride_key('detail'), lambda: super(RideViewSet, self).retrieve(request, *args, **kwargs)
+            ),
+        )
+
     def perform_create(self, serializer):
         serializer.save(driver=self.request.user)
 
     def perform_update(self, serializer):
-        if serializer.instance.driver != self.request.user:
-            return Response(
-                {"error": "You can only update your own rides"},
-                status=status.HTTP_403_FORBIDDEN
-            )
+        if serializer.instance.driver_id != self.request.user.pk:
+            raise PermissionDenied("You can only update your own rides")
         serializer.save()
 
     def perform_destroy(self, instance):
-        if instance.driver != self.request.user:
-            return Response(
-                {"error": "You can only delete your own rides"},
-                status=status.HTTP_403_FORBIDDEN
-            )
+        if instance.driver_id != self.request.user.pk:
+            raise PermissionDenied("You can only delete your own rides")
         instance.delete()
 
+    @action(detail=False, methods=['post'], permission_classes=[permissions.IsAuthenticated])
+    def bulk(self, request):
+        """Create a list of rides in one transaction, reporting each item's outcome."""
+        items = bulk_items(request.data)
+        vehicles = Vehicle.objects.in_bulk(referenced_ids(items, 'vehicle'))
+        valid, errors = validate_items(RideSerializer, items, dict(self.get_serializer_context(), vehicles=vehicles))
+        with transaction.atomic():
+            rides = Ride.objects.bulk_create([Ride(driver=request.user, **data) for data in valid.values()])
+            # bulk_create sends no post_save, so invalidate here.
+            caching.invalidate_rides([ride.pk for ride in rides])
+            RideChange.record([ride.pk for ride in rides])
+        created = {index: ride.pk for index, ride in zip(valid, rides)}
+        return bulk_response(len(items), created, errors)
+
     @action(detail=False, methods=['get'], permission_classes=[permissions.IsAuthenticated])
     def my_rides(self, request):
-        rides = Ride.objects.filter(driver=request.user)
+        rides = (
+            Ride.objects.filter(driver=request.user)
+            .select_related('driver')
+            .with_booking_stats()
+            .order_by('departure_time')
+        )
         serializer = self.get_serializer(rides, many=True)
         return Response(serializer.data)
 
     @action(detail=True, methods=['get'])
     def availability(self, request, pk=None):
-        ride = self.get_object()
-        booked = ride.bookings.aggregate(total=Sum('seats'))['total'] or 0
-        available = max(0, ride.available_seats - booked)
-        return Response({
-            "ride_id": ride.id,
-            "total_seats": ride.available_seats,
-            "booked_seats": booked,
-            "available_seats": available
-        })
+        def render():
+            ride = self.get_object()
+            return Response({
+                "ride_id": ride.id,
+                "total_seats": ride.available_seats,
+                "booked_seats": ride.seats_booked,
+                "available_seats": ride.seats_remaining
+            })
+        return conditional(
+            request,
+            lambda: object_validators(request, Ride.objects, pk),
+            lambda: self._cached(self._ride_key('availability'), render),
+        )
+
+    @action(detail=False, methods=['get'], url_path='cache-stats', permission_classes=[permissions.IsAdminUser])
+    def cache_stats(self, request):
+        return Response(caching.stats)
+
+
+class RideScheduleViewSet(viewsets.ModelViewSet):
+    """Recurring rides. Their occurrences show up in ride listings and are booked by occurrence token."""
+    serializer_class = RideScheduleSerializer
+    permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    pagination_class = StandardResultsSetPagination
+    ordering = ['-id']
+
+    def get_queryset(self):
+        return RideSchedule.objects.select_related('driver').order_by('-id')
+
+    def perform_create(self, serializer):
+        serializer.save(driver=self.request.user)
+
+    def perform_update(self, serializer):
+        if serializer.instance.driver_id != self.request.user.pk:
+            raise PermissionDenied("You can only update your own schedules")
+        serializer.save()
+
+    def perform_destroy(self, instance):
+        if instance.driver_id != self.request.user.pk:
+            raise PermissionDenied("You can only delete your own schedules")
+        instance.delete()
 
 
 class BookingViewSet(viewsets.ModelViewSet):
@@ -153,34 +343,123 @@ class BookingViewSet(viewsets.ModelViewSet):
     pagination_class = StandardResultsSetPagination
     ordering_fields = ['created_at']
     ordering = ['-created_at']
+    keyset_ordering = ('-created_at', '-id')
 
     def get_queryset(self):
-        return Booking.objects.filter(passenger=self.request.user)
+        return self._with_related(Booking.objects.filter(passenger=self.request.user).order_by('-created_at'))
+
+    @staticmethod
+    def _with_related(queryset):
+        rides = Ride.objects.select_related('driver').with_booking_stats()
+        return queryset.select_related('passenger').prefetch_related(Prefetch('ride', queryset=rides))
 
     def perform_create(self, serializer):
-        serializer.save(passenger=self.request.user)
+        ride = serializer.validated_data.get('ride')
+        occurrence = serializer.validated_data.pop('occurrence', None)
+        seats = serializer.validated_data.get('seats', 1)
+        with transaction.atomic():
+            if occurrence is not None:
+                ride = occurrence[0].materialize(occurrence[1])
+            reserved = Ride.objects.reserve_seats(ride.pk, seats)
+            ride.refresh_from_db(fields=['available_seats', 'seats_booked'])
+            if not reserved:
+                raise ValidationError(f"Only {ride.seats_remaining} seats available for this ride.")
+            serializer.save(passenger=self.request.user, ride=ride)
+
+    def perform_update(self, serializer):
+        """Change ``seats`` and/or move the booking, claiming and returning seats in the same transaction."""
+        if serializer.instance.passenger_id != self.request.user.pk:
+            raise PermissionDenied("You can only change your own bookings")
+        occurrence = serializer.validated_data.pop('occurrence', None)
+        with transaction.atomic():
+            # Seats and ride as committed, not as loaded before validation.
+            booking = Booking.objects.select_for_update().get(pk=serializer.instance.pk)
+            ride = serializer.validated_data.get('ride') or booking.ride
+            if occurrence is not None:
+                ride = occurrence[0].materialize(occurrence[1])
+            seats = serializer.validated_data.get('seats', booking.seats)
+            if ride.pk == booking.ride_id:
+                held, delta = booking.seats, seats - booking.seats
+                reserved = delta <= 0 or Ride.objects.reserve_seats(ride.pk, delta)
+                if delta < 0:
+                    Ride.objects.release_seats(ride.pk, -delta)
+            else:
+                held = 0
+                reserved = Ride.objects.reserve_seats(ride.pk, seats)
+                if reserved:
+                    Ride.objects.release_seats(booking.ride_id, booking.seats)
+                    # save() below only signals for the new ride.
+                    caching.invalidate_rides([booking.ride_id])
+                    RideChange.record([booking.ride_id])
+            if not reserved:
+                ride.refresh_from_db(fields=['available_seats', 'seats_booked'])
+                raise ValidationError(f"Only {ride.seats_remaining + held} seats available for this ride.")
+            serializer.save(ride=ride)
 
     def perform_destroy(self, instance):
-        if instance.passenger != self.request.user:
-            return Response(
-                {"error": "You can only cancel your own bookings"},
-                status=status.HTTP_403_FORBIDDEN
-            )
-        instance.delete()
+        if instance.passenger_id != self.request.user.pk:
+            raise PermissionDenied("You can only cancel your own bookings")
+        instance.cancel()
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """Book a list of rides in one transaction, reporting each item's outcome.
+
+        Items are served in order while seats last; the seat check for all
+        affected rides is the one locking query that loads them.
+        """
+        items = bulk_items(request.data)
+        with transaction.atomic():
+            rides = Ride.objects.select_for_update().in_bulk(referenced_ids(items, 'ride'))
+            valid, errors = validate_items(BookingSerializer, items, dict(self.get_serializer_context(), rides=rides))
+            self._materialize_occurrences(valid.values(), rides)
+            wanted, bookings = {}, {}
+            for index, data in valid.items():
+                ride, seats = data['ride'], data.get('seats', 1)
+                left = ride.seats_remaining - wanted.get(ride.pk, 0)
+                if seats > left:
+                    errors[index] = {api_settings.NON_FIELD_ERRORS_KEY: [f"Only {left} seats available for this ride."]}
+                    continue
+                wanted[ride.pk] = wanted.get(ride.pk, 0) + seats
+                bookings[index] = Booking(passenger=request.user, **data)
+            if bookings:
+                if not Ride.objects.reserve_seats_bulk(wanted):
+                    # Only reachable without row locks (SQLite) if another writer got in first.
+                    raise ValidationError("Seat availability changed while booking; please retry.")
+                Booking.objects.bulk_create(bookings.values())
+                caching.invalidate_rides(wanted)
+                RideChange.record(wanted)
+        created = {index: booking.pk for index, booking in bookings.items()}
+        return bulk_response(len(items), created, errors)
+
+    @staticmethod
+    def _materialize_occurrences(items, rides):
+        """Point items that book a schedule occurrence at its (possibly new) Ride, locked like the rest."""
+        materialized = {}
+        for data in items:
+            occurrence = data.pop('occurrence', None)
+            if occurrence is not None:
+                if occurrence not in materialized:
+                    materialized[occurrence] = occurrence[0].materialize(occurrence[1])
+                data['ride'] = materialized[occurrence]
+        if materialized:
+            rides.update(Ride.objects.select_for_update().in_bulk([ride.pk for ride in materialized.values()]))
+            for data in items:
+                data['ride'] = rides[data['ride'].pk]
 
     @action(detail=False, methods=['get'])
     def my_bookings(self, request):
-        bookings = Booking.objects.filter(passenger=request.user)
+        bookings = self._with_related(Booking.objects.filter(passenger=request.user).order_by('-created_at'))
         serializer = self.get_serializer(bookings, many=True)
         return Response(serializer.data)
 
     @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
     def cancel(self, request, pk=None):
         booking = self.get_object()
-        if booking.passenger != request.user:
+        if booking.passenger_id != request.user.pk:
             return Response(
                 {"error": "You can only cancel your own bookings"},
                 status=status.HTTP_403_FORBIDDEN
             )
-        booking.delete()
+        booking.cancel()
         return Response({"message": "Booking cancelled successfully"}, status=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,54 @@
+import os
+
+from fastapi import HTTPException
+
+from carpool_common import tokens as shared
+
+SECRET_KEY = os.environ.get('CARPOOL_SECRET_KEY', 'dev-secret-for-carpool-backend')
+TOKEN_CACHE_SIZE = int(os.environ.get('GATEWAY_TOKEN_CACHE_SIZE', '10000'))
+# Upper bound for tokens without an ``exp`` claim.
+TOKEN_CACHE_TTL = float(os.environ.get('GATEWAY_TOKEN_CACHE_TTL', '300'))
+
+
+class TokenCache(shared.TokenCache):
+    """``carpool_common.tokens.TokenCache`` answering invalid tokens with a 401."""
+
+    def verify(self, token):
+        try:
+            return super().verify(token)
+        except shared.InvalidToken:
+            raise HTTPException(status_code=401, detail='Invalid token')
+
+
+def validate_jwt(token: str):
+    try:
+        return shared.verify(token, SECRET_KEY)
+    except shared.InvalidToken:
+        raise HTTPException(status_code=401, detail='Invalid token')
+
+
+class TokenSession:
+    """Identity bound to a websocket at handshake.
+
+    Per-message tokens are only re-verified when they differ from the last
+    accepted one or it has expired, and must belong to the same user.
+    """
+
+    def __init__(self, cache, token):
+        self.cache = cache
+        self.claims = cache.verify(token)
+        self.token = token
+        self.user_id = self.claims[shared.USER_ID_CLAIM]
+
+    def check(self, token):
+        expires_at = self.claims.get('exp')
+        if token == self.token and (expires_at is None or self.cache.clock() < expires_at):
+            return self.claims
+        claims = self.cache.verify(token)
+        if claims[shared.USER_ID_CLAIM] != self.user_id:
+            raise HTTPException(status_code=401, detail='Token belongs to another user')
+        self.token, self.claims = token, claims
+        return claims
+
+
+tokens = TokenCache(SECRET_KEY, TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
@@ -0,0 +1,252 @@
+"""Server-sent seat availability updates (``GET /rides/availability/stream``).
+
+Django writes the id of every ride whose seats or listing changed to the
+``core_ridechange`` outbox, in the transaction that changed it (see
+core.signals). ``AvailabilityFeed`` polls the outbox every ``poll_interval``
+seconds, reads the current seats of the changed rides that somebody
+subscribed to in one query, and offers them to the matching subscriptions:
+by ride id, or by origin/destination (normalized substring, like
+``?origin=``/``?destination=`` on ``/api/rides/``).
+
+A subscription keeps only the latest update per ride and is sent at most
+one batch per ``push_interval`` seconds, so a burst of bookings on a ride
+costs its watchers one event. Every gateway worker polls on its own; the
+outbox is read-only for them apart from deleting rows past ``retention``,
+which goes to ``primary`` when the feed reads from a replica.
+
+Outbox ids are assigned before commit, so a transaction can commit a lower
+id after a higher one was read. Ids skipped over are checked again for
+``GAP_TIMEOUT`` seconds before they are given up as rolled back.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from carpool_common import search
+
+AVAILABILITY_POLL_INTERVAL = float(os.environ.get('GATEWAY_AVAILABILITY_POLL', '0.5'))
+AVAILABILITY_PUSH_INTERVAL = float(os.environ.get('GATEWAY_AVAILABILITY_INTERVAL', '1'))
+AVAILABILITY_RETENTION = float(os.environ.get('GATEWAY_AVAILABILITY_RETENTION', '3600'))
+MAX_RIDES = 100
+KEEPALIVE = 15
+GAP_TIMEOUT = 10
+# A larger jump is not a few in-flight transactions (e.g. a sequence restart); don't track it.
+MAX_GAP = 1000
+PRUNE_EVERY = 60
+BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """What one client watches, and the updates waiting for it (latest per ride)."""
+
+    def __init__(self, ride_ids, origin='', destination='', push_interval=AVAILABILITY_PUSH_INTERVAL):
+        self.ride_ids = set(ride_ids)
+        self.origin = search.normalize(origin)
+        self.destination = search.normalize(destination)
+        self.push_interval = push_interval
+        self.delivered = 0
+        self.coalesced = 0
+        self._pending = {}
+        self._ready = asyncio.Event()
+
+    @property
+    def route(self):
+        return (self.origin, self.destination) if self.origin or self.destination else None
+
+    def offer(self, update):
+        if update['ride_id'] in self._pending:
+            self.coalesced += 1
+        self._pending[update['ride_id']] = update
+        self._ready.set()
+
+    async def batches(self, keepalive=KEEPALIVE):
+        """Batches of updates, at most one per ``push_interval``; an empty batch after ``keepalive`` idle seconds."""
+        loop = asyncio.get_running_loop()
+        last = None
+        while True:
+            try:
+                await asyncio.wait_for(self._ready.wait(), keepalive)
+            except asyncio.TimeoutError:
+                yield []
+                continue
+            if last is not None and (delay := last + self.push_interval - loop.time()) > 0:
+                # Whatever else changes meanwhile joins this batch.
+                await asyncio.sleep(delay)
+            self._ready.clear()
+            batch, self._pending = list(self._pending.values()), {}
+            last = loop.time()
+            self.delivered += len(batch)
+            yield batch
+
+
+def route_matches(route, origin_key, destination_key):
+    origin, destination = route
+    return origin in (origin_key or '') and destination in (destination_key or '')
+
+
+def event(update):
+    return f"event: availability\ndata: {json.dumps(update, separators=(',', ':'))}\n\n"
+
+
+class AvailabilityFeed:
+    def __init__(self, pool, poll_interval=AVAILABILITY_POLL_INTERVAL, push_interval=AVAILABILITY_PUSH_INTERVAL,
+                 retention=AVAILABILITY_RETENTION, clock=time.monotonic, primary=None):
+        self.pool = pool
+        self.primary = primary or pool
+        self.poll_interval = poll_interval
+        self.push_interval = push_interval
+        self.retention = retention
+        self.clock = clock
+        self.last_id = None
+        self.changes = 0
+        self.published = 0
+        self.failed_polls = 0
+        self.subscriptions = set()
+        self._gaps = {}
+        self._by_ride = {}
+        self._by_route = {}
+        self._task = None
+        self._pruned_at = None
+
+    def subscribe(self, ride_ids=(), origin='', destination=''):
+        subscription = Subscription(ride_ids, origin, destination, self.push_interval)
+        self.subscriptions.add(subscription)
+        for ride_id in subscription.ride_ids:
+            self._by_ride.setdefault(ride_id, set()).add(subscription)
+        if subscription.route is not None:
+            self._by_route.setdefault(subscription.route, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.discard(subscription)
+        for ride_id in subscription.ride_ids:
+            subscribers = self._by_ride.get(ride_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._by_ride[ride_id]
+        if subscription.route is not None:
+            subscribers = self._by_route.get(subscription.route)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._by_route[subscription.route]
+
+    async def snapshot(self, ride_ids):
+        """Current availability of ``ride_ids``, sent when a subscription opens."""
+        rows = await self._load(ride_ids)
+        return [self._update(row) for row in rows.values()]
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll()
+                if self._pruned_at is None or self.clock() - self._pruned_at >= PRUNE_EVERY:
+                    self._pruned_at = self.clock()
+                    await self.prune()
+            except Exception:
+                self.failed_polls += 1
+                logger.exception("Failed to read the ride change outbox")
+            await asyncio.sleep(self.poll_interval)
+
+    async def poll(self):
+        """Read new outbox rows and offer the rides' current seats to their subscribers."""
+        if self.last_id is None:
+            # Start from now: subscribers get a snapshot when they connect.
+            rows = await self.pool.fetchall('SELECT MAX(id) AS id FROM core_ridechange')
+            self.last_id = rows[0]['id'] or 0
+            return
+
+        p = self.pool.placeholder
+        now = self.clock()
+        self._gaps = {gap: seen for gap, seen in self._gaps.items() if now - seen < GAP_TIMEOUT}
+        where, params = f'id > {p}', [self.last_id]
+        if self._gaps:
+            where += f" OR id IN ({', '.join([p] * len(self._gaps))})"
+            params.extend(self._gaps)
+        rows = await self.pool.fetchall(
+            f'SELECT id, ride_id FROM core_ridechange WHERE {where} ORDER BY id LIMIT {BATCH_SIZE}', params)
+        if not rows:
+            return
+
+        expected = self.last_id + 1
+        for row in rows:
+            self._gaps.pop(row['id'], None)
+            if row['id'] > self.last_id:
+                if row['id'] - expected <= MAX_GAP:
+                    self._gaps.update((gap, now) for gap in range(expected, row['id']))
+                expected = row['id'] + 1
+                self.last_id = row['id']
+        self.changes += len(rows)
+
+        watched = {row['ride_id'] for row in rows}
+        if not self._by_route:
+            watched &= self._by_ride.keys()
+        if watched:
+            self._publish(watched, await self._load(watched))
+
+    def _publish(self, ride_ids, rows):
+        for ride_id in ride_ids:
+            row = rows.get(ride_id)
+            update = self._update(row) if row is not None else {'ride_id': ride_id, 'deleted': True}
+            subscribers = set(self._by_ride.get(ride_id, ()))
+            if row is not None:
+                for route, route_subscribers in self._by_route.items():
+                    if route_matches(route, row['origin_key'], row['destination_key']):
+                        subscribers |= route_subscribers
+            for subscription in subscribers:
+                subscription.offer(update)
+                self.published += 1
+
+    async def _load(self, ride_ids):
+        ride_ids = list(ride_ids)
+        if not ride_ids:
+            return {}
+        placeholders = ', '.join([self.pool.placeholder] * len(ride_ids))
+        rows = await self.pool.fetchall(
+            'SELECT id, origin_key, destination_key, available_seats, seats_booked '
+            f'FROM core_ride WHERE id IN ({placeholders})', ride_ids)
+        return {row['id']: row for row in rows}
+
+    @staticmethod
+    def _update(row):
+        # Same shape as Django's /api/rides/{id}/availability/.
+        return {
+            'ride_id': row['id'],
+            'total_seats': row['available_seats'],
+            'booked_seats': row['seats_booked'],
+            'available_seats': max(row['available_seats'] - row['seats_booked'], 0),
+        }
+
+    async def prune(self):
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.retention)
+        await self.primary.execute(f'DELETE FROM core_ridechange WHERE created_at < {self.primary.placeholder}',
+                                   (self.primary.timestamp(cutoff),))
+
+    def metrics(self):
+        return {
+            'subscriptions': len(self.subscriptions),
+            'watched_rides': len(self._by_ride),
+            'watched_routes': len(self._by_route),
+            'last_id': self.last_id,
+            'changes': self.changes,
+            'published': self.published,
+            'pending_gaps': len(self._gaps),
+            'failed_polls': self.failed_polls,
+        }
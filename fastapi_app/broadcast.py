@@ -0,0 +1,244 @@
+"""Broadcast backends that carry GPS updates between gateway workers.
+
+Every worker publishes the fixes it receives to the backend and delivers
+whatever the backend hands back -- its own messages included -- to its local
+``ConnectionManager``. With the in-memory backend that loop stays inside one
+process; the others let ``/ws/gps`` run under several uvicorn workers.
+
+Selected by ``GATEWAY_BROADCAST``:
+
+- ``memory`` (default): single process.
+- ``postgres``: ``LISTEN/NOTIFY`` on the gateway database.
+- ``unix:///path/to/gps.sock``: a small line-oriented broker on a Unix socket.
+  The first worker to start runs it; ``python -m fastapi_app.broadcast PATH``
+  runs it standalone.
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import sys
+
+from . import db
+
+BROADCAST_URL = os.environ.get('GATEWAY_BROADCAST', 'memory')
+NOTIFY_CHANNEL = 'carpool_gps'
+# Bytes the broker buffers for a worker that isn't reading before disconnecting it;
+# the worker reconnects and carries on from the next fix.
+BROKER_CLIENT_BUFFER = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastBackend:
+    async def start(self, deliver):
+        """Begin delivering messages; ``deliver(ride_id, message)`` is called for each one."""
+        self._deliver = deliver
+
+    async def publish(self, ride_id, message):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+
+class MemoryBackend(BroadcastBackend):
+    async def publish(self, ride_id, message):
+        self._deliver(ride_id, message)
+
+
+class PostgresBackend(BroadcastBackend):
+    """``LISTEN/NOTIFY`` on one channel. NOTIFY payloads are capped at 8000 bytes."""
+
+    def __init__(self, config, channel=NOTIFY_CHANNEL):
+        self.config = config
+        self.channel = channel
+        self._listener = None
+        self._publisher = None
+        self._lock = asyncio.Lock()
+
+    async def start(self, deliver):
+        await super().start(deliver)
+        self._listener = await asyncio.to_thread(db.connect_postgres, self.config)
+        self._publisher = await asyncio.to_thread(db.connect_postgres, self.config)
+        with self._listener.cursor() as cur:
+            cur.execute(f'LISTEN {self.channel}')
+        asyncio.get_running_loop().add_reader(self._listener.fileno(), self._on_notify)
+
+    def _on_notify(self):
+        self._listener.poll()
+        while self._listener.notifies:
+            notify = self._listener.notifies.pop(0)
+            envelope = json.loads(notify.payload)
+            self._deliver(envelope['ride_id'], envelope['message'])
+
+    async def publish(self, ride_id, message):
+        payload = json.dumps({'ride_id': ride_id, 'message': message}, separators=(',', ':'))
+        async with self._lock:
+            await asyncio.to_thread(self._notify, payload)
+
+    def _notify(self, payload):
+        with self._publisher.cursor() as cur:
+            cur.execute('SELECT pg_notify(%s, %s)', (self.channel, payload))
+
+    async def stop(self):
+        if self._listener is not None:
+            asyncio.get_running_loop().remove_reader(self._listener.fileno())
+            self._listener.close()
+        if self._publisher is not None:
+            self._publisher.close()
+
+
+class UnixSocketBroker:
+    """Relays every newline-terminated message it receives to all connected workers.
+
+    Relaying never waits for a worker: one that lets more than ``max_buffer``
+    bytes pile up is disconnected rather than slowing down everyone else.
+    """
+
+    def __init__(self, path, max_buffer=BROKER_CLIENT_BUFFER):
+        self.path = path
+        self.max_buffer = max_buffer
+        self.clients = set()
+        self.server = None
+        self._handlers = set()
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self._handle, path=self.path)
+
+    async def _handle(self, reader, writer):
+        self.clients.add(writer)
+        self._handlers.add(asyncio.current_task())
+        try:
+            while line := await reader.readline():
+                for client in list(self.clients):
+                    try:
+                        if client.transport.get_write_buffer_size() > self.max_buffer:
+                            raise BufferError('worker is not reading')
+                        client.write(line)
+                    except Exception:
+                        logger.warning("Disconnecting a broadcast client", exc_info=True)
+                        self.clients.discard(client)
+                        client.close()
+        finally:
+            self.clients.discard(writer)
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def stop(self):
+        self.server.close()
+        for client in list(self.clients):
+            client.close()
+        # Closing the transports ends each handler's read loop.
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self.server.wait_closed()
+
+
+class UnixSocketBackend(BroadcastBackend):
+    def __init__(self, path):
+        self.path = path
+        self.broker = None
+        self._reader = None
+        self._writer = None
+        self._task = None
+
+    async def start(self, deliver):
+        await super().start(deliver)
+        await self._connect()
+        self._task = asyncio.create_task(self._listen())
+
+    async def _connect(self):
+        try:
+            self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            await self._elect_broker()
+            self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+
+    async def _elect_broker(self):
+        # Serialize workers racing to replace a missing or stale socket.
+        with open(self.path + '.lock', 'w') as lock:
+            await asyncio.to_thread(fcntl.flock, lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    _, writer = await asyncio.open_unix_connection(self.path)
+                    writer.close()
+                    return
+                except (FileNotFoundError, ConnectionRefusedError):
+                    pass
+                if os.path.exists(self.path):
+                    os.unlink(self.path)
+                self.broker = UnixSocketBroker(self.path)
+                await self.broker.start()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    async def _listen(self):
+        while True:
+            await self._receive()
+            # The broker went away (its worker exited): take over or reconnect.
+            self._writer.close()
+            while True:
+                try:
+                    await self._connect()
+                    break
+                except OSError:
+                    await asyncio.sleep(0.1)
+
+    async def _receive(self):
+        """Deliver messages until the broker connection ends; a bad message is logged and skipped."""
+        while True:
+            try:
+                line = await self._reader.readline()
+            except ConnectionError:
+                return
+            except ValueError:
+                # Longer than the stream's limit; readline() already discarded it.
+                logger.warning("Skipped an oversized broadcast message")
+                continue
+            if not line:
+                return
+            try:
+                envelope = json.loads(line)
+                self._deliver(envelope['ride_id'], envelope['message'])
+            except Exception:
+                logger.exception("Failed to deliver broadcast message %.200r", line)
+
+    async def publish(self, ride_id, message):
+        line = json.dumps({'ride_id': ride_id, 'message': message}, separators=(',', ':')).encode() + b'\n'
+        try:
+            self._writer.write(line)
+            await self._writer.drain()
+        except ConnectionError:
+            # Dropped while reconnecting; the next fix supersedes it anyway.
+            pass
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        if self.broker is not None:
+            await self.broker.stop()
+
+
+def create_backend(url=BROADCAST_URL):
+    if url == 'memory':
+        return MemoryBackend()
+    if url == 'postgres':
+        if not db.DOCKER_ENV:
+            raise ValueError('GATEWAY_BROADCAST=postgres needs the PostgreSQL database (DOCKER_ENV)')
+        return PostgresBackend(db.DB_CONFIG)
+    if url.startswith('unix://'):
+        return UnixSocketBackend(url[len('unix://'):])
+    raise ValueError(f'Unknown GATEWAY_BROADCAST backend: {url}')
+
+
+async def _serve_forever(path):
+    broker = UnixSocketBroker(path)
+    await broker.start()
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(_serve_forever(sys.argv[1]))
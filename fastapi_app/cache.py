@@ -0,0 +1,40 @@
+"""Cache of ``/search`` results.
+
+Entries are tagged with the ``rides`` row of ``core_cachegeneration``, which
+Django bumps whenever a ride, booking or driver changes. A lookup costs one
+primary-key read of that row instead of the search query, and an entry is
+only served while the generation it was computed at is still current.
+"""
+import os
+from collections import OrderedDict
+
+SEARCH_CACHE_SIZE = int(os.environ.get('GATEWAY_SEARCH_CACHE_SIZE', '1000'))
+GENERATION_SQL = "SELECT value FROM core_cachegeneration WHERE name = 'rides'"
+
+
+class SearchCache:
+    def __init__(self, maxsize=SEARCH_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, generation):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != generation:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, generation, rows):
+        if generation is None or self.maxsize <= 0:
+            return
+        self._entries[key] = (generation, rows)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def metrics(self):
+        return {'size': len(self._entries), 'capacity': self.maxsize, 'hits': self.hits, 'misses': self.misses}
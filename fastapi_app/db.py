@@ -0,0 +1,204 @@
+import asyncio
+import os
+import sqlite3
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import timezone
+
+from .metrics import queries
+
+# Database connection configuration
+DOCKER_ENV = os.environ.get('DOCKER_ENV')
+
+if DOCKER_ENV:
+    DB_CONFIG = {
+        'dbname': os.environ.get('POSTGRES_DB', 'carpool'),
+        'user': os.environ.get('POSTGRES_USER', 'carpool_user'),
+        'password': os.environ.get('POSTGRES_PASSWORD', 'carpool_password'),
+        'host': os.environ.get('POSTGRES_HOST', 'db'),
+        'port': os.environ.get('POSTGRES_PORT', '5432'),
+    }
+else:
+    DATABASE = os.path.join(os.path.dirname(__file__), '..', 'carpool_django', 'carpool.db')
+
+# Read replica for search and the availability feed: a libpq DSN ("host=replica dbname=carpool ..."
+# or postgresql://...) in Docker, a SQLite file otherwise. Unset, everything reads the primary.
+REPLICA = os.environ.get('GATEWAY_DB_REPLICA')
+
+POOL_MIN_SIZE = int(os.environ.get('GATEWAY_DB_POOL_MIN', '1'))
+POOL_MAX_SIZE = int(os.environ.get('GATEWAY_DB_POOL_MAX', '10'))
+POOL_ACQUIRE_TIMEOUT = float(os.environ.get('GATEWAY_DB_ACQUIRE_TIMEOUT', '5'))
+
+
+class PoolTimeout(TimeoutError):
+    pass
+
+
+def connect_postgres(config):
+    """Connect with a dict of connection parameters or a DSN string."""
+    import psycopg2
+
+    conn = psycopg2.connect(config) if isinstance(config, str) else psycopg2.connect(**config)
+    # The gateway only reads; don't leave an idle transaction open between requests.
+    conn.autocommit = True
+    return conn
+
+
+def connect_sqlite(path):
+    # Connections are handed between worker threads, but the pool only ever
+    # lends one to a single caller at a time.
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+class ConnectionPool:
+    """Bounded pool of DB-API connections with an asyncio front end.
+
+    Queries run in the default thread executor so handlers never block the
+    event loop on psycopg2/sqlite3 calls.
+    """
+
+    def __init__(self, connect, vendor, placeholder, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                 acquire_timeout=POOL_ACQUIRE_TIMEOUT):
+        if min_size > max_size:
+            raise ValueError('min_size cannot exceed max_size')
+        self._connect = connect
+        self.vendor = vendor
+        self.placeholder = placeholder
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self._idle = deque()
+        self._slots = None
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._acquired = 0
+        self._timeouts = 0
+        self._acquire_seconds = 0.0
+        self._acquire_max = 0.0
+
+    async def open(self):
+        self._slots = asyncio.Semaphore(self.max_size)
+        for _ in range(self.min_size):
+            self._idle.append(await asyncio.to_thread(self._connect))
+            self._size += 1
+
+    async def close(self):
+        while self._idle:
+            conn = self._idle.popleft()
+            self._size -= 1
+            await asyncio.to_thread(conn.close)
+
+    @asynccontextmanager
+    async def acquire(self):
+        started = time.perf_counter()
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            raise PoolTimeout(f'No database connection available within {self.acquire_timeout}s')
+        finally:
+            self._waiting -= 1
+
+        try:
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                conn = await asyncio.to_thread(self._connect)
+                self._size += 1
+        except BaseException:
+            self._slots.release()
+            raise
+
+        elapsed = time.perf_counter() - started
+        self._acquired += 1
+        self._acquire_seconds += elapsed
+        self._acquire_max = max(self._acquire_max, elapsed)
+        self._in_use += 1
+        healthy = False
+        try:
+            yield conn
+            healthy = True
+        finally:
+            self._in_use -= 1
+            if healthy:
+                self._idle.append(conn)
+            else:
+                # A failed query may leave the connection mid-transaction; drop it.
+                self._size -= 1
+                await asyncio.to_thread(conn.close)
+            self._slots.release()
+
+    async def fetchall(self, query, params=()):
+        async with self.acquire() as conn:
+            # Timed here rather than in the worker thread, so a slow query's stack shows the handler.
+            started = time.perf_counter()
+            try:
+                return await asyncio.to_thread(self._fetchall, conn, query, params)
+            finally:
+                queries.record(query, time.perf_counter() - started)
+
+    @staticmethod
+    def _fetchall(conn, query, params):
+        cur = conn.cursor()
+        try:
+            cur.execute(query, params)
+            columns = [col[0] for col in cur.description]
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+        finally:
+            cur.close()
+
+    async def execute(self, query, params=()):
+        """Run a write and commit it; returns the number of affected rows."""
+        async with self.acquire() as conn:
+            return await asyncio.to_thread(self._execute, conn, query, params)
+
+    @staticmethod
+    def _execute(conn, query, params):
+        cur = conn.cursor()
+        try:
+            cur.execute(query, params)
+            # psycopg2 connections are in autocommit mode; sqlite3 opened a transaction.
+            conn.commit()
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    def timestamp(self, value):
+        """Query parameter comparing an aware datetime against Django's DateTimeField columns."""
+        if self.vendor == 'sqlite':
+            # Django stores UTC text there, so compare as text in the same format.
+            return value.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        return value
+
+    def metrics(self):
+        return {
+            'size': self._size,
+            'idle': len(self._idle),
+            'in_use': self._in_use,
+            'waiting': self._waiting,
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'acquired_total': self._acquired,
+            'acquire_timeouts': self._timeouts,
+            'acquire_avg_ms': (self._acquire_seconds / self._acquired * 1000) if self._acquired else 0.0,
+            'acquire_max_ms': self._acquire_max * 1000,
+        }
+
+
+def create_pool(replica=False):
+    """Build the pool for the backend selected by ``DOCKER_ENV``.
+
+    With ``replica``, the pool reads ``GATEWAY_DB_REPLICA``; None when it isn't set.
+    """
+    if replica and not REPLICA:
+        return None
+    if DOCKER_ENV:
+        config = REPLICA if replica else DB_CONFIG
+        return ConnectionPool(lambda: connect_postgres(config), 'postgresql', '%s')
+    path = REPLICA if replica else DATABASE
+    return ConnectionPool(lambda: connect_sqlite(path), 'sqlite', '?')
@@ -0,0 +1,90 @@
+"""Compact binary frames for GPS position updates.
+
+A frame is a 4-byte header -- version, frame type, fix count (uint16) --
+followed by ``count`` fixed-size records, all little-endian::
+
+    ride_id    uint64
+    lat, lon   int32, degrees * 1e7
+    heading    float32, degrees
+    speed      float32, m/s
+    timestamp  float64, Unix seconds
+
+That is 32 bytes per fix. Clients opt in by offering the ``carpool.gps.v1``
+websocket subprotocol; everyone else keeps getting JSON.
+"""
+import math
+import struct
+import time
+
+SUBPROTOCOL = 'carpool.gps.v1'
+VERSION = 1
+POSITIONS = 1
+
+HEADER = struct.Struct('<BBH')
+FIX = struct.Struct('<Qiiffd')
+MAX_FIXES = 0xFFFF
+SCALE = 10_000_000
+
+
+def encode(fixes):
+    """Pack fix dicts (ride_id, lat, lon, heading, speed, timestamp) into one frame."""
+    if len(fixes) > MAX_FIXES:
+        raise ValueError(f'At most {MAX_FIXES} fixes per frame')
+    buf = bytearray(HEADER.size + FIX.size * len(fixes))
+    HEADER.pack_into(buf, 0, VERSION, POSITIONS, len(fixes))
+    offset = HEADER.size
+    for fix in fixes:
+        FIX.pack_into(
+            buf, offset, fix['ride_id'], round(fix['lat'] * SCALE), round(fix['lon'] * SCALE),
+            fix['heading'], fix['speed'], fix['timestamp'],
+        )
+        offset += FIX.size
+    return bytes(buf)
+
+
+def decode(data):
+    """Unpack a frame into fix dicts. Raises ValueError if it is malformed."""
+    if len(data) < HEADER.size:
+        raise ValueError('Frame too short')
+    version, kind, count = HEADER.unpack_from(data, 0)
+    if version != VERSION or kind != POSITIONS:
+        raise ValueError('Unsupported frame')
+    if len(data) != HEADER.size + FIX.size * count:
+        raise ValueError('Frame length does not match fix count')
+    fixes = []
+    for ride_id, lat, lon, heading, speed, timestamp in FIX.iter_unpack(memoryview(data)[HEADER.size:]):
+        fixes.append(_fix(ride_id, lat / SCALE, lon / SCALE, heading, speed, timestamp))
+    return fixes
+
+
+def fix_from_json(data):
+    """Validate a JSON GPS message into a fix dict. Raises ValueError."""
+    try:
+        values = (
+            int(data['ride_id']), float(data['lat']), float(data['lon']),
+            float(data.get('heading', 0.0)), float(data.get('speed', 0.0)),
+            float(data.get('timestamp') or time.time()),
+        )
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('ride_id, lat and lon are required numbers')
+    return _fix(*values)
+
+
+def _fix(ride_id, lat, lon, heading, speed, timestamp):
+    if not 0 <= ride_id < 2 ** 64:
+        raise ValueError('ride_id out of range')
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError('Coordinates out of range')
+    if not all(math.isfinite(v) and abs(v) < 1e30 for v in (heading, speed, timestamp)):
+        raise ValueError('heading, speed and timestamp must be finite')
+    return {'ride_id': ride_id, 'lat': lat, 'lon': lon, 'heading': heading, 'speed': speed, 'timestamp': timestamp}
+
+
+def latest_per_ride(fixes):
+    """Keep only the newest fix for each ride in a batch."""
+    latest = {}
+    for fix in fixes:
+        current = latest.get(fix['ride_id'])
+        if current is None or fix['timestamp'] >= current['timestamp']:
+            latest[fix['ride_id']] = fix
+    return list(latest.values())
@@ -0,0 +1,184 @@
+import asyncio
+import os
+from collections import OrderedDict, defaultdict
+
+from fastapi import WebSocket
+
+from . import frames
+
+MAX_PENDING = int(os.environ.get('GATEWAY_WS_MAX_PENDING', '32'))
+SEND_TIMEOUT = float(os.environ.get('GATEWAY_WS_SEND_TIMEOUT', '5'))
+
+
+class Subscriber:
+    """A websocket plus its bounded outbound queue and sender task.
+
+    Queued messages are keyed: a newer message with the same key (the ride id
+    for GPS fixes) replaces the pending one, so a slow client only ever gets
+    the latest position per ride. When the queue is full the oldest entry is
+    dropped.
+
+    Binary subscribers get every pending fix packed into a single frame per
+    send; JSON subscribers get one message per fix.
+    """
+
+    def __init__(self, websocket: WebSocket, max_pending=MAX_PENDING, send_timeout=SEND_TIMEOUT, binary=False):
+        self.websocket = websocket
+        self.binary = binary
+        self.rides = set()
+        self.max_pending = max_pending
+        self.send_timeout = send_timeout
+        self.delivered = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self._pending = OrderedDict()
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def offer(self, key, message):
+        if key in self._pending:
+            del self._pending[key]
+            self.coalesced += 1
+        elif len(self._pending) >= self.max_pending:
+            self._pending.popitem(last=False)
+            self.dropped += 1
+        self._pending[key] = message
+        self._ready.set()
+
+    def send(self, message):
+        """Queue a one-off message (errors, acks) that is never coalesced."""
+        self.offer(object(), message)
+
+    async def run(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self._pending:
+                if self.binary:
+                    await self._send_batch()
+                    continue
+                key, message = self._pending.popitem(last=False)
+                if isinstance(key, int):
+                    message = {'ride_id': key, 'gps': message}
+                await self._send(self.websocket.send_json(message))
+
+    async def _send_batch(self):
+        pending, self._pending = self._pending, OrderedDict()
+        fixes = []
+        for key, message in pending.items():
+            if isinstance(key, int):
+                fixes.append(message)
+            else:
+                await self._send(self.websocket.send_json(message))
+        for start in range(0, len(fixes), frames.MAX_FIXES):
+            await self._send(self.websocket.send_bytes(frames.encode(fixes[start:start + frames.MAX_FIXES])))
+
+    async def _send(self, coro):
+        await asyncio.wait_for(coro, self.send_timeout)
+        self.delivered += 1
+
+
+class ConnectionManager:
+    """Per-ride pub/sub for GPS updates.
+
+    Publishing only touches the subscribers of that ride and never awaits a
+    socket: each connection drains its own queue in a separate task, so a
+    slow or dead client cannot hold up the others. A sender that fails or
+    times out evicts its connection.
+    """
+
+    def __init__(self, max_pending=MAX_PENDING, send_timeout=SEND_TIMEOUT):
+        self.max_pending = max_pending
+        self.send_timeout = send_timeout
+        self.subscribers = {}
+        self.rides = defaultdict(set)
+        self.published = 0
+        self.received = 0
+        self.evicted = 0
+        # Counters carried over from closed connections
+        self._closed = {'delivered': 0, 'coalesced': 0, 'dropped': 0}
+
+    async def connect(self, websocket: WebSocket, binary=False):
+        await websocket.accept(subprotocol=frames.SUBPROTOCOL if binary else None)
+        subscriber = Subscriber(websocket, self.max_pending, self.send_timeout, binary)
+        self.subscribers[websocket] = subscriber
+        subscriber._task = asyncio.create_task(self._drain(subscriber))
+        return subscriber
+
+    async def _drain(self, subscriber):
+        try:
+            await subscriber.run()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.evicted += 1
+            self.disconnect(subscriber.websocket)
+            try:
+                await subscriber.websocket.close(code=1011)
+            except Exception:
+                pass
+
+    def disconnect(self, websocket: WebSocket):
+        subscriber = self.subscribers.pop(websocket, None)
+        if subscriber is None:
+            return
+        for name in self._closed:
+            self._closed[name] += getattr(subscriber, name)
+        for ride_id in subscriber.rides:
+            self._unlink(ride_id, subscriber)
+        subscriber.rides.clear()
+        if subscriber._task is not None and subscriber._task is not asyncio.current_task():
+            subscriber._task.cancel()
+
+    def subscribe(self, websocket: WebSocket, ride_ids):
+        subscriber = self.subscribers.get(websocket)
+        if subscriber is None:
+            return
+        for ride_id in ride_ids:
+            subscriber.rides.add(ride_id)
+            self.rides[ride_id].add(subscriber)
+
+    def unsubscribe(self, websocket: WebSocket, ride_ids):
+        subscriber = self.subscribers.get(websocket)
+        if subscriber is None:
+            return
+        for ride_id in ride_ids:
+            subscriber.rides.discard(ride_id)
+            self._unlink(ride_id, subscriber)
+
+    def _unlink(self, ride_id, subscriber):
+        subscribers = self.rides.get(ride_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.rides[ride_id]
+
+    def send(self, websocket: WebSocket, message: dict):
+        subscriber = self.subscribers.get(websocket)
+        if subscriber is not None:
+            subscriber.send(message)
+
+    def deliver(self, websocket: WebSocket, ride_id, message: dict):
+        """Queue a GPS fix for a single connection, e.g. the last known position on subscribe."""
+        subscriber = self.subscribers.get(websocket)
+        if subscriber is not None:
+            subscriber.offer(ride_id, message)
+
+    def publish(self, ride_id, message: dict):
+        """Queue a GPS fix (see ``frames``) for everyone subscribed to ``ride_id``."""
+        self.published += 1
+        for subscriber in self.rides.get(ride_id, ()):
+            subscriber.offer(ride_id, message)
+
+    def metrics(self):
+        subscribers = self.subscribers.values()
+        return {
+            'connections': len(self.subscribers),
+            'rides': len(self.rides),
+            'received': self.received,
+            'published': self.published,
+            'delivered': self._closed['delivered'] + sum(s.delivered for s in subscribers),
+            'coalesced': self._closed['coalesced'] + sum(s.coalesced for s in subscribers),
+            'dropped': self._closed['dropped'] + sum(s.dropped for s in subscribers),
+            'evicted': self.evicted,
+        }
@@ -0,0 +1,182 @@
+"""Batched persistence of GPS fixes into ``core_gpspoint``.
+
+The websocket handler only ever does a non-blocking ``submit``; a single
+background task drains the bounded queue and writes a batch whenever it
+fills up or ``interval`` seconds pass. When the database falls behind and
+the queue is full, new fixes are dropped and counted rather than slowing
+down the live stream.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+TRAIL_QUEUE_SIZE = int(os.environ.get('GATEWAY_TRAIL_QUEUE', '10000'))
+TRAIL_BATCH_SIZE = int(os.environ.get('GATEWAY_TRAIL_BATCH', '500'))
+TRAIL_FLUSH_INTERVAL = float(os.environ.get('GATEWAY_TRAIL_INTERVAL', '1'))
+# Rides a connection remembers the driver check for before starting over.
+DRIVER_CACHE_SIZE = 1000
+# Ride ids per lookup query, well below SQLite's bound-parameter limit.
+DRIVER_LOOKUP_CHUNK = 500
+
+logger = logging.getLogger(__name__)
+
+# Points for rides that don't exist (anymore) are skipped rather than failing the batch.
+POSTGRES_INSERT = (
+    "INSERT INTO core_gpspoint (ride_id, recorded_at, lat, lon, heading, speed) "
+    "SELECT v.ride_id, to_timestamp(v.ts), v.lat, v.lon, v.heading, v.speed "
+    "FROM (VALUES %s) AS v (ride_id, ts, lat, lon, heading, speed) "
+    "JOIN core_ride r ON r.id = v.ride_id"
+)
+SQLITE_INSERT = (
+    "INSERT INTO core_gpspoint (ride_id, recorded_at, lat, lon, heading, speed) "
+    "SELECT ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM core_ride WHERE id = ?)"
+)
+
+
+class TrailWriter:
+    def __init__(self, pool, queue_size=TRAIL_QUEUE_SIZE, batch_size=TRAIL_BATCH_SIZE,
+                 interval=TRAIL_FLUSH_INTERVAL):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.accepted = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failed_batches = 0
+        self.last_flush_ms = 0.0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        # Write whatever is still queued.
+        while not self.queue.empty():
+            await self._flush(self._take(self.batch_size))
+
+    def submit(self, fixes):
+        for fix in fixes:
+            try:
+                self.queue.put_nowait(fix)
+                self.accepted += 1
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+    def _take(self, limit):
+        batch = []
+        while len(batch) < limit and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.interval
+            while len(batch) < self.batch_size:
+                batch.extend(self._take(self.batch_size - len(batch)))
+                remaining = deadline - loop.time()
+                if len(batch) >= self.batch_size or remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # stop() cancels this task: let a started write finish rather than
+            # lose the batch and hand its connection back while a thread still uses it.
+            flush = asyncio.ensure_future(self._flush(batch))
+            try:
+                await asyncio.shield(flush)
+            except asyncio.CancelledError:
+                await flush
+                raise
+
+    async def _flush(self, batch):
+        if not batch:
+            return
+        started = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                await asyncio.to_thread(self._write, conn, batch)
+        except Exception:
+            self.failed_batches += 1
+            logger.exception("Failed to write %d GPS points", len(batch))
+            return
+        self.flushes += 1
+        self.flushed += len(batch)
+        self.last_flush_ms = (time.perf_counter() - started) * 1000
+
+    def _write(self, conn, batch):
+        cur = conn.cursor()
+        try:
+            if self.pool.vendor == 'postgresql':
+                from psycopg2.extras import execute_values
+
+                rows = [(f['ride_id'], f['timestamp'], f['lat'], f['lon'], f['heading'], f['speed']) for f in batch]
+                execute_values(cur, POSTGRES_INSERT, rows, page_size=len(rows))
+            else:
+                rows = [
+                    (f['ride_id'], _sqlite_datetime(f['timestamp']), f['lat'], f['lon'], f['heading'], f['speed'], f['ride_id'])
+                    for f in batch
+                ]
+                # sqlite3 opens a transaction before the first INSERT: one commit per batch.
+                cur.executemany(SQLITE_INSERT, rows)
+                conn.commit()
+        finally:
+            cur.close()
+
+    def metrics(self):
+        return {
+            'queued': self.queue.qsize(),
+            'queue_capacity': self.queue.maxsize,
+            'accepted': self.accepted,
+            'dropped': self.dropped,
+            'flushed': self.flushed,
+            'flushes': self.flushes,
+            'failed_batches': self.failed_batches,
+            'last_flush_ms': self.last_flush_ms,
+        }
+
+
+class DriverCheck:
+    """Which rides a websocket's user drives, so only drivers' fixes reach the trail.
+
+    Each ride is looked up once per connection, on the primary: a ride created
+    a moment ago may not have reached a replica yet.
+    """
+
+    def __init__(self, pool, user_id):
+        self.pool = pool
+        self.user_id = user_id
+        self.drives = {}
+
+    async def filter(self, fixes):
+        """The fixes in ``fixes`` for rides this user drives."""
+        if len(self.drives) > DRIVER_CACHE_SIZE:
+            self.drives.clear()
+        unknown = list({fix['ride_id'] for fix in fixes} - self.drives.keys())
+        p = self.pool.placeholder
+        for start in range(0, len(unknown), DRIVER_LOOKUP_CHUNK):
+            chunk = unknown[start:start + DRIVER_LOOKUP_CHUNK]
+            rows = await self.pool.fetchall(
+                f"SELECT id FROM core_ride WHERE driver_id = {p} AND id IN ({', '.join([p] * len(chunk))})",
+                [self.user_id, *chunk],
+            )
+            driven = {row['id'] for row in rows}
+            self.drives.update((ride_id, ride_id in driven) for ride_id in chunk)
+        return [fix for fix in fixes if self.drives[fix['ride_id']]]
+
+
+def _sqlite_datetime(timestamp):
+    # Same text format Django's SQLite backend stores for DateTimeField (UTC).
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
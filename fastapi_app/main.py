@@ -1,30 +1,56 @@
-import os
-import jwt
-from typing import List
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import List, Optional, Union
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-import psycopg2
-from psycopg2.extras import RealDictCursor
 
-# Database connection configuration
-DOCKER_ENV = os.environ.get('DOCKER_ENV')
+from carpool_common import cursor as cursors
+from carpool_common import metrics, routes, search
+from . import availability, frames
+from .auth import TokenSession, tokens
+from .broadcast import create_backend
+from .cache import GENERATION_SQL, SearchCache
+from .db import PoolTimeout, create_pool
+from .hub import ConnectionManager
+from .ingest import DriverCheck, TrailWriter
+from .metrics import MetricsMiddleware, export, queries, registry
+from .positions import PositionStore
 
-if DOCKER_ENV:
-    DB_CONFIG = {
-        'dbname': os.environ.get('POSTGRES_DB', 'carpool'),
-        'user': os.environ.get('POSTGRES_USER', 'carpool_user'),
-        'password': os.environ.get('POSTGRES_PASSWORD', 'carpool_password'),
-        'host': os.environ.get('POSTGRES_HOST', 'db'),
-        'port': os.environ.get('POSTGRES_PORT', '5432'),
-    }
-else:
-    import sqlite3
-    DATABASE = os.path.join(os.path.dirname(__file__), '..', 'carpool_django', 'carpool.db')
 
-SECRET_KEY = os.environ.get('CARPOOL_SECRET_KEY', 'dev-secret-for-carpool-backend')
+search_cache = SearchCache()
 
-app = FastAPI(title='Carpool FastAPI Gateway')
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.db = create_pool()
+    await app.state.db.open()
+    # Search and the availability feed read from GATEWAY_DB_REPLICA when it is set.
+    replica = create_pool(replica=True)
+    if replica is not None:
+        await replica.open()
+    app.state.replica = replica or app.state.db
+    app.state.broadcast = create_backend()
+    await app.state.broadcast.start(on_fix)
+    app.state.trails = TrailWriter(app.state.db)
+    app.state.trails.start()
+    app.state.availability = availability.AvailabilityFeed(app.state.replica, primary=app.state.db)
+    app.state.availability.start()
+    try:
+        yield
+    finally:
+        await app.state.availability.stop()
+        await app.state.broadcast.stop()
+        await app.state.trails.stop()
+        if replica is not None:
+            await replica.close()
+        await app.state.db.close()
+
+
+app = FastAPI(title='Carpool FastAPI Gateway', lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -33,6 +59,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Added last, so it is the outermost middleware and times the others too.
+app.add_middleware(MetricsMiddleware)
 
 
 class RideSearchResult(BaseModel):
@@ -42,83 +70,392 @@ class RideSearchResult(BaseModel):
     departure_time: str
     available_seats: int
     price_cents: int
+    # Set for route searches (?pickup=&dropoff=): how far the route passes from each point.
+    pickup_distance_m: Optional[float] = None
+    dropoff_distance_m: Optional[float] = None
 
 
-def validate_jwt(token: str):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        return payload
-    except Exception as e:
-        raise HTTPException(status_code=401, detail='Invalid token')
+class RideSearchPage(BaseModel):
+    next: Optional[str]
+    results: List[RideSearchResult]
+
 
+@app.get('/search', response_model=Union[RideSearchPage, List[RideSearchResult]])
+async def ride_search(request: Request, q: str = '', token: str = '', cursor: Optional[str] = None,
+                      page_size: int = Query(20, ge=1, le=100), pickup: Optional[str] = None,
+                      dropoff: Optional[str] = None,
+                      radius: float = Query(routes.DEFAULT_RADIUS_M, gt=0, le=routes.MAX_RADIUS_M),
+                      departure_after: Optional[str] = None, departure_before: Optional[str] = None):
+    """Rides matching ``q``, best match first.
 
-@app.get('/search', response_model=List[RideSearchResult])
-def ride_search(q: str = '', token: str = ''):
+    Passing ``cursor`` (empty for the first page) switches to keyset pagination
+    over ``(departure_time, id)``, using the same cursor format as the Django
+    API, and returns ``{"next", "results"}``.
+
+    ``pickup`` and ``dropoff`` (``lat,lon``) limit results to rides whose route
+    passes within ``radius`` meters of both, in that order (see
+    ``carpool_common.routes``). ``departure_after``/``departure_before`` (ISO
+    8601, UTC unless given) bound the departure time.
+    """
     if token:
-        validate_jwt(token)
+        tokens.verify(token)
+    route = None
+    if pickup is not None or dropoff is not None:
+        route = (_parse_point(pickup, 'pickup'), _parse_point(dropoff, 'dropoff'), radius)
+    window = (_parse_time(departure_after, 'departure_after'), _parse_time(departure_before, 'departure_before'))
+
+    # The generation comes from the same database as the rows, so cached results match it.
+    db = app.state.replica
+    try:
+        generation = await db.fetchall(GENERATION_SQL)
+        generation = generation[0]['value'] if generation else None
+        key = (q, cursor, page_size if cursor is not None else None, route, window)
+        rows = search_cache.get(key, generation)
+        if rows is None:
+            rows = await _search_rows(db, q, cursor, page_size, route, window)
+            search_cache.put(key, generation, rows)
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail='Database busy')
+
+    if cursor is None:
+        return rows
+    next_url = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        token = cursors.encode([rows[-1]['departure_time'], rows[-1]['id']])
+        next_url = str(request.url.include_query_params(cursor=token))
+    return {'next': next_url, 'results': rows}
+
+
+def _parse_point(value, name):
+    try:
+        return routes.parse_point(value)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=f'{name}: {exc}')
+
+
+def _parse_time(value, name):
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f'{name}: expected an ISO 8601 date or datetime')
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
 
-    if DOCKER_ENV:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+
+async def _search_rows(db, q, cursor, page_size, route=None, window=(None, None)):
+    p = db.placeholder
+    columns = ["id", "origin", "destination", "departure_time", "available_seats", "price_cents"]
+    where, params = [], []
+    match = search.match_sql(db.vendor, q, placeholder=p)
+    if match:
+        where.append(match[0])
+        params.extend(match[1])
+    window = [bound and db.timestamp(bound) for bound in window]
+    for bound, op in zip(window, ('>=', '<')):
+        if bound:
+            where.append(f"departure_time {op} {p}")
+            params.append(bound)
+    if route:
+        candidates, candidate_params = routes.candidates_sql(*route, *window, placeholder=p)
+        where.append(candidates)
+        params.extend(candidate_params)
+        columns.extend(routes.COLUMNS)
+
+    if cursor is None:
+        order = "departure_time"
+        if match:
+            rank, rank_params = search.rank_sql(q, placeholder=p)
+            order = f"{rank} DESC, departure_time"
+            params.extend(rank_params)
+        limit = ""
     else:
-        conn = sqlite3.connect(DATABASE)
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-    
-    query = "SELECT id, origin, destination, departure_time, available_seats, price_cents FROM core_ride"
-    params = []
-    if q:
-        query += " WHERE origin LIKE %s OR destination LIKE %s" if DOCKER_ENV else " WHERE origin LIKE ? OR destination LIKE ?"
-        params.extend([f"%{q}%", f"%{q}%"])
-    
-    cur.execute(query, params)
-    rows = cur.fetchall()
-    results = [dict(r) for r in rows]
-    conn.close()
-    return results
-
-
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-
-    async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            await connection.send_json(message)
+        try:
+            after = cursors.decode(cursor, 2)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid cursor')
+        if after:
+            where.append(f"(departure_time > {p} OR (departure_time = {p} AND id > {p}))")
+            params.extend([after[0], after[0], after[1]])
+        order = "departure_time, id"
+        # Route candidates are only confirmed below, so the page is cut after that.
+        limit = "" if route else f" LIMIT {page_size + 1}"
+
+    query = f"SELECT {', '.join(columns)} FROM core_ride"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += f" ORDER BY {order}{limit}"
+    rows = await db.fetchall(query, params)
+    if route:
+        # Exact distance checks are CPU-bound; keep them off the event loop.
+        rows = await asyncio.to_thread(_match_route, rows, *route)
+        if cursor is not None:
+            rows = rows[:page_size + 1]
+    return rows
+
+
+def _match_route(rows, pickup, dropoff, radius):
+    matched = []
+    for row in rows:
+        points = routes.route_points(*(row.pop(column) for column in routes.COLUMNS))
+        distances = routes.match(points, pickup, dropoff, radius)
+        if distances:
+            row['pickup_distance_m'], row['dropoff_distance_m'] = distances
+            matched.append(row)
+    return matched
+
+
+@app.get('/cache/stats')
+def cache_stats():
+    return search_cache.metrics()
+
+
+@app.get('/pool/stats')
+def pool_stats():
+    return app.state.db.metrics()
+
+
+def parse_ride_ids(value):
+    """Ride ids from a list or a comma-separated string; None if any id is not an integer."""
+    if isinstance(value, str):
+        value = [v for v in value.split(',') if v.strip()]
+    if not isinstance(value, list):
+        return None
+    try:
+        return [int(v) for v in value]
+    except (TypeError, ValueError):
+        return None
 
 
 manager = ConnectionManager()
+positions = PositionStore()
+
+
+def on_fix(ride_id, fix):
+    """Every fix delivered by the broadcast backend, from any worker."""
+    positions.update(fix)
+    manager.publish(ride_id, fix)
+
+
+def subscribe(websocket: WebSocket, ride_ids):
+    manager.subscribe(websocket, ride_ids)
+    # Late joiners get the last known position straight away.
+    for ride_id in ride_ids:
+        position = positions.get(ride_id)
+        if position is not None:
+            manager.deliver(websocket, ride_id, position.as_fix())
+
+
+class RidePosition(BaseModel):
+    ride_id: int
+    lat: float
+    lon: float
+    heading: float
+    speed: float
+    timestamp: float
+
+
+class NearbyRide(RidePosition):
+    distance_m: float
+
+
+@app.get('/rides/nearby', response_model=List[NearbyRide])
+def rides_nearby(lat: float = Query(..., ge=-90, le=90), lon: float = Query(..., ge=-180, le=180),
+                 radius: float = Query(1000, gt=0, le=50_000), limit: int = Query(50, ge=1, le=500),
+                 token: str = ''):
+    """Rides whose last fix lies within ``radius`` meters, nearest first."""
+    tokens.verify(token)
+    return [dict(position.as_fix(), distance_m=d) for d, position in positions.nearby(lat, lon, radius, limit)]
+
+
+@app.get('/rides/{ride_id}/position', response_model=RidePosition)
+def ride_position(ride_id: int, token: str = ''):
+    tokens.verify(token)
+    position = positions.get(ride_id)
+    if position is None:
+        raise HTTPException(status_code=404, detail='No recent position for this ride')
+    return position.as_fix()
+
+
+@app.get('/rides/availability/stream')
+async def availability_stream(ride_ids: str = '', origin: str = '', destination: str = ''):
+    """Server-sent ``availability`` events for ``?ride_ids=1,2`` and/or rides from ``?origin=`` to ``?destination=``.
+
+    Opens with the current availability of the listed rides; after that, an
+    event whenever one of the watched rides is booked, cancelled, changed or
+    deleted (see ``availability``).
+    """
+    ids = parse_ride_ids(ride_ids)
+    if ids is None:
+        raise HTTPException(status_code=400, detail='ride_ids must be a comma-separated list of integers')
+    if len(ids) > availability.MAX_RIDES:
+        raise HTTPException(status_code=400, detail=f'At most {availability.MAX_RIDES} ride_ids')
+    if not ids and not (origin.strip() or destination.strip()):
+        raise HTTPException(status_code=400, detail='Pass ride_ids, origin or destination')
+
+    feed = app.state.availability
+    subscription = feed.subscribe(ids, origin, destination)
+    try:
+        initial = await feed.snapshot(ids)
+    except BaseException:
+        feed.unsubscribe(subscription)
+        raise
+
+    async def events():
+        try:
+            yield ''.join(availability.event(update) for update in initial) or ': subscribed\n\n'
+            async for batch in subscription.batches():
+                yield ''.join(availability.event(update) for update in batch) or ': keepalive\n\n'
+        finally:
+            feed.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.get('/ws/stats')
+def ws_stats():
+    return manager.metrics()
+
+
+@app.get('/ingest/stats')
+def ingest_stats():
+    return app.state.trails.metrics()
+
+
+export('carpool_ws', manager.metrics, {
+    'connections': ('gauge', 'Open GPS websocket connections.'),
+    'rides': ('gauge', 'Rides with at least one websocket subscriber.'),
+    'received': ('counter', 'Messages received from GPS websocket clients.'),
+    'published': ('counter', 'GPS fixes published to subscribers.'),
+    'delivered': ('counter', 'Messages sent to GPS websocket clients.'),
+    'coalesced': ('counter', 'Queued GPS fixes replaced by a newer fix of the same ride.'),
+    'dropped': ('counter', 'Outbound messages dropped from full websocket queues.'),
+    'evicted': ('counter', 'Websocket connections closed for failing or timing out on a send.'),
+})
+export('carpool_db_pool', lambda: app.state.db.metrics(), {
+    'size': ('gauge', 'Open gateway database connections.'),
+    'in_use': ('gauge', 'Gateway database connections lent out.'),
+    'waiting': ('gauge', 'Requests waiting for a gateway database connection.'),
+    'acquire_timeouts': ('counter', 'Requests that got no gateway database connection in time.'),
+})
+export('carpool_ingest', lambda: app.state.trails.metrics(), {
+    'queued': ('gauge', 'GPS fixes waiting for the trail writer.'),
+    'accepted': ('counter', 'GPS fixes queued for the trail writer.'),
+    'dropped': ('counter', 'GPS fixes dropped because the trail writer queue was full.'),
+    'flushed': ('counter', 'GPS fixes written to the trail.'),
+    'failed_batches': ('counter', 'Trail batches that failed to write.'),
+})
+export('carpool_availability', lambda: app.state.availability.metrics(), {
+    'subscriptions': ('gauge', 'Open availability streams.'),
+    'changes': ('counter', 'Ride changes read from the outbox.'),
+    'published': ('counter', 'Availability updates offered to subscriptions.'),
+    'failed_polls': ('counter', 'Outbox polls that failed.'),
+})
+export('carpool_search_cache', search_cache.metrics, {
+    'size': ('gauge', 'Cached /search results.'),
+    'hits': ('counter', '/search cache hits.'),
+    'misses': ('counter', '/search cache misses.'),
+})
+
+
+@app.get('/metrics')
+def prometheus_metrics():
+    return Response(registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get('/db/slow-queries')
+def slow_queries():
+    return {'threshold_ms': queries.threshold_ms, 'total': queries.slow_total, 'samples': queries.samples()}
+
+
+async def publish_fixes(fixes, drivers):
+    # Every fix is persisted by the worker that received it; the trail keeps the full batch,
+    # but only for rides the sender drives (``drivers`` is the connection's DriverCheck).
+    app.state.trails.submit(await drivers.filter(fixes))
+    # Live subscribers only need the newest position of each ride in a batch.
+    for fix in frames.latest_per_ride(fixes):
+        await app.state.broadcast.publish(fix['ride_id'], fix)
 
 
 @app.websocket('/ws/gps')
-async def gps_ws(websocket: WebSocket, token: str = ''):
+async def gps_ws(websocket: WebSocket, token: str = '', ride_ids: str = ''):
+    """GPS stream. Clients receive fixes only for rides they subscribe to, either via
+    ``?ride_ids=1,2`` or ``{"action": "subscribe"|"unsubscribe", "ride_ids": [...]}``.
+
+    Offering the ``carpool.gps.v1`` subprotocol switches outgoing fixes to binary
+    frames (see ``frames``). Drivers may send either JSON fixes carrying a token or
+    binary frames, which are covered by the connection's token; ``{"action":
+    "auth", "token": ...}`` replaces that token before it expires.
+    """
     if token == '':
         await websocket.close(code=1008)
         return
     try:
-        validate_jwt(token)
+        session = TokenSession(tokens, token)
     except HTTPException:
         await websocket.close(code=1008)
         return
+    drivers = DriverCheck(app.state.db, session.user_id)
 
-    await manager.connect(websocket)
+    await manager.connect(websocket, binary=frames.SUBPROTOCOL in websocket.scope.get('subprotocols', []))
+    subscribe(websocket, parse_ride_ids(ride_ids) or [])
     try:
         while True:
-            data = await websocket.receive_json()
-            if "token" in data and "ride_id" in data:
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+            manager.received += 1
+            if message.get('bytes') is not None:
+                try:
+                    session.check(session.token)
+                    fixes = frames.decode(message['bytes'])
+                except HTTPException as exc:
+                    manager.send(websocket, {"error": exc.detail})
+                    continue
+                except ValueError as exc:
+                    manager.send(websocket, {"error": str(exc)})
+                    continue
+                await publish_fixes(fixes, drivers)
+                continue
+
+            try:
+                data = json.loads(message.get('text') or '')
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                manager.send(websocket, {"error": "Expected a JSON object"})
+                continue
+            action = data.get("action")
+            if action in ("subscribe", "unsubscribe"):
+                ids = parse_ride_ids(data.get("ride_ids"))
+                if ids is None:
+                    manager.send(websocket, {"error": "ride_ids must be a list of integers"})
+                elif action == "subscribe":
+                    subscribe(websocket, ids)
+                else:
+                    manager.unsubscribe(websocket, ids)
+            elif action == "auth":
+                try:
+                    session.check(data.get("token", ""))
+                except HTTPException as exc:
+                    manager.send(websocket, {"error": exc.detail})
+            elif "token" in data and "ride_id" in data:
                 try:
-                    validate_jwt(data["token"])
-                    await manager.broadcast({"ride_id": data["ride_id"], "gps": data})
-                except HTTPException:
-                    await websocket.send_json({"error": "Invalid token"})
+                    session.check(data["token"])
+                    fix = frames.fix_from_json(data)
+                except HTTPException as exc:
+                    manager.send(websocket, {"error": exc.detail})
+                    continue
+                except ValueError as exc:
+                    manager.send(websocket, {"error": str(exc)})
+                    continue
+                # Only the position is forwarded -- never the sender's token.
+                await publish_fixes([fix], drivers)
             else:
-                await websocket.send_json({"error": "Token or ride_id missing"})
+                manager.send(websocket, {"error": "Token or ride_id missing"})
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
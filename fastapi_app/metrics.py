@@ -0,0 +1,61 @@
+"""Request metrics for the gateway (see ``carpool_common.metrics``).
+
+``MetricsMiddleware`` times every HTTP request and records it under the path
+template of the route that handled it (``/rides/{ride_id}/position``), with
+the queries ``ConnectionPool.fetchall`` ran for it. Websocket, pool and
+ingest numbers the gateway already keeps are read at scrape time through
+``export``.
+"""
+import os
+import time
+
+from carpool_common import metrics
+
+# Queries taking at least this many milliseconds are sampled for /db/slow-queries.
+SLOW_QUERY_MS = float(os.environ.get('GATEWAY_SLOW_QUERY_MS', '100'))
+
+registry = metrics.Registry()
+queries = metrics.QueryLog(SLOW_QUERY_MS, ignore=(__file__, os.path.join(os.path.dirname(__file__), 'db.py')))
+requests = metrics.RequestMetrics(registry, queries)
+
+
+def export(prefix, read, kinds):
+    """Publish the numbers of a ``metrics()`` dict: ``kinds`` maps its keys to (kind, help)."""
+    def collect():
+        values = read()
+        return [
+            (f'{prefix}_{key}_total' if kind == 'counter' else f'{prefix}_{key}', kind, help, values[key])
+            for key, (kind, help) in kinds.items()
+        ]
+    registry.collect(collect)
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, so streaming responses and websockets pass through untouched."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        response = {'status': 500, 'size': 0}
+
+        async def send_and_measure(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            elif message['type'] == 'http.response.body':
+                response['size'] += len(message.get('body', b''))
+            await send(message)
+
+        with metrics.track(f"{scope['method']} {scope['path']}") as stats:
+            try:
+                await self.app(scope, receive, send_and_measure)
+            finally:
+                # The router leaves the matched route in the scope.
+                route = scope.get('route')
+                requests.observe(getattr(route, 'path', metrics.UNMATCHED), scope['method'],
+                                 response['status'], time.perf_counter() - started, response['size'], stats)
@@ -0,0 +1,114 @@
+"""Last known position of every active ride, with a grid index for radius queries.
+
+Fed by every fix that reaches this worker (through the broadcast backend, so
+all workers hold the same picture). Rides that stop reporting for ``ttl``
+seconds are dropped.
+"""
+import math
+import os
+import time
+from collections import OrderedDict
+
+from carpool_common.routes import METERS_PER_DEGREE, distance_m
+
+POSITION_TTL = float(os.environ.get('GATEWAY_POSITION_TTL', '120'))
+# ~1.1 km of latitude per cell
+CELL_DEGREES = 0.01
+
+
+class Position:
+    __slots__ = ('ride_id', 'lat', 'lon', 'heading', 'speed', 'timestamp', 'seen', 'cell')
+
+    def as_fix(self):
+        return {
+            'ride_id': self.ride_id, 'lat': self.lat, 'lon': self.lon,
+            'heading': self.heading, 'speed': self.speed, 'timestamp': self.timestamp,
+        }
+
+
+class PositionStore:
+    def __init__(self, ttl=POSITION_TTL, cell_degrees=CELL_DEGREES, clock=time.monotonic):
+        self.ttl = ttl
+        self.cell_degrees = cell_degrees
+        self.clock = clock
+        # ride_id -> Position, least recently updated first, so expiry stops at the first fresh entry.
+        self._positions = OrderedDict()
+        self._cells = {}
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees))
+
+    def update(self, fix):
+        now = self.clock()
+        position = self._positions.get(fix['ride_id'])
+        if position is None:
+            position = Position()
+            position.ride_id = fix['ride_id']
+            position.cell = None
+        elif fix['timestamp'] < position.timestamp:
+            return  # out-of-order fix from another worker
+        position.lat = fix['lat']
+        position.lon = fix['lon']
+        position.heading = fix['heading']
+        position.speed = fix['speed']
+        position.timestamp = fix['timestamp']
+        position.seen = now
+
+        cell = self._cell(position.lat, position.lon)
+        if cell != position.cell:
+            if position.cell is not None:
+                self._unindex(position)
+            self._cells.setdefault(cell, {})[position.ride_id] = position
+            position.cell = cell
+        self._positions[position.ride_id] = position
+        self._positions.move_to_end(position.ride_id)
+        self.expire(now)
+
+    def _unindex(self, position):
+        bucket = self._cells[position.cell]
+        del bucket[position.ride_id]
+        if not bucket:
+            del self._cells[position.cell]
+
+    def expire(self, now=None):
+        cutoff = (self.clock() if now is None else now) - self.ttl
+        while self._positions:
+            ride_id, position = next(iter(self._positions.items()))
+            if position.seen > cutoff:
+                break
+            del self._positions[ride_id]
+            self._unindex(position)
+
+    def get(self, ride_id):
+        self.expire()
+        return self._positions.get(ride_id)
+
+    def nearby(self, lat, lon, radius_m, limit=None):
+        """``(distance_m, Position)`` pairs within ``radius_m`` of the point, nearest first."""
+        self.expire()
+        dlat = radius_m / METERS_PER_DEGREE
+        dlon = radius_m / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+        lat_lo, lon_lo = self._cell(lat - dlat, lon - dlon)
+        lat_hi, lon_hi = self._cell(lat + dlat, lon + dlon)
+
+        cells = self._cells
+        if (lat_hi - lat_lo + 1) * (lon_hi - lon_lo + 1) > len(cells):
+            # Wide radius over a sparse grid: cheaper to scan the occupied cells.
+            buckets = [bucket for (i, j), bucket in cells.items()
+                       if lat_lo <= i <= lat_hi and lon_lo <= j <= lon_hi]
+        else:
+            buckets = [cells.get((i, j)) for i in range(lat_lo, lat_hi + 1) for j in range(lon_lo, lon_hi + 1)]
+
+        found = []
+        for bucket in buckets:
+            if not bucket:
+                continue
+            for position in bucket.values():
+                d = distance_m(lat, lon, position.lat, position.lon)
+                if d <= radius_m:
+                    found.append((d, position))
+        found.sort(key=lambda pair: pair[0])
+        return found[:limit] if limit else found
+
+    def __len__(self):
+        return len(self._positions)
@@ -0,0 +1,63 @@
+"""A gateway worker's broadcast side, driven over stdin by test_broadcast.
+
+``python -m fastapi_app.tests.broadcast_worker URL NAME`` starts the backend
+for ``URL`` and answers one command per line:
+
+- ``sync``: publish until its own message comes back, i.e. the broker
+  relays to it; prints ``synced`` (``unsynced`` after a timeout).
+- ``round N WORKERS``: publish ``{"from": NAME, "round": N}`` and print the
+  names seen in round ``N`` once ``WORKERS`` of them arrived (or after a
+  timeout).
+- ``stop``: stop the backend and exit.
+"""
+import asyncio
+import json
+import sys
+
+from fastapi_app.broadcast import create_backend
+
+TIMEOUT = 5
+
+
+async def main(url, name):
+    loop = asyncio.get_running_loop()
+    seen = {}
+    arrived = asyncio.Event()
+
+    def deliver(ride_id, message):
+        seen.setdefault(message['round'], set()).add(message['from'])
+        arrived.set()
+
+    async def wait_for(round_, count):
+        deadline = loop.time() + TIMEOUT
+        while len(seen.get(round_, ())) < count and loop.time() < deadline:
+            arrived.clear()
+            try:
+                await asyncio.wait_for(arrived.wait(), 0.1)
+            except asyncio.TimeoutError:
+                pass
+        return sorted(seen.get(round_, ()))
+
+    backend = create_backend(url)
+    await backend.start(deliver)
+    print('broker' if getattr(backend, 'broker', None) is not None else 'ready', flush=True)
+    syncs = 0
+    while command := (await loop.run_in_executor(None, sys.stdin.readline)).split():
+        if command[0] == 'sync':
+            syncs += 1
+            round_ = f'sync-{name}-{syncs}'
+            deadline = loop.time() + TIMEOUT
+            while name not in seen.get(round_, ()) and loop.time() < deadline:
+                await backend.publish(1, {'from': name, 'round': round_})
+                await asyncio.sleep(0.1)
+            print('synced' if name in seen.get(round_, ()) else 'unsynced', flush=True)
+        elif command[0] == 'round':
+            await backend.publish(1, {'from': name, 'round': command[1]})
+            print(json.dumps(await wait_for(command[1], int(command[2]))), flush=True)
+        elif command[0] == 'stop':
+            break
+    await backend.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(*sys.argv[1:3]))
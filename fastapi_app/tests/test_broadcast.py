@@ -0,0 +1,147 @@
+"""GPS broadcast across gateway worker processes (``GATEWAY_BROADCAST=unix://...``).
+
+Each worker is a separate Python process running the real backend (see
+``broadcast_worker``); they elect the broker among themselves through the
+socket's lock file, exactly as uvicorn workers do. Misbehaving peers are
+played in process, over raw connections to the broker.
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from fastapi_app.broadcast import UnixSocketBackend
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Worker:
+    def __init__(self, url, name):
+        self.name = name
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'fastapi_app.tests.broadcast_worker', url, name],
+            cwd=ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+        )
+        self.is_broker = None
+
+    def wait_started(self):
+        self.is_broker = self.readline() == 'broker'
+
+    def readline(self):
+        line = self.process.stdout.readline().strip()
+        if not line:
+            raise AssertionError(f"worker {self.name} exited with {self.process.wait()}")
+        return line
+
+    def send(self, command):
+        self.process.stdin.write(command + '\n')
+        self.process.stdin.flush()
+
+    def close(self):
+        if self.process.poll() is None:
+            self.send('stop')
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+
+class UnixSocketBroadcastTests(unittest.TestCase):
+    WORKERS = 3
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.url = f'unix://{os.path.join(directory.name, "gps.sock")}'
+
+    def start(self, count):
+        workers = []
+        for index in range(count):
+            worker = Worker(self.url, f'worker{index}')
+            self.addCleanup(worker.close)
+            workers.append(worker)
+        # All of them race to become the broker.
+        for worker in workers:
+            worker.wait_started()
+        return workers
+
+    def sync(self, workers):
+        for worker in workers:
+            worker.send('sync')
+            self.assertEqual(worker.readline(), 'synced', f"{worker.name} is not connected to a broker")
+
+    def round(self, workers, number):
+        for worker in workers:
+            worker.send(f'round {number} {len(workers)}')
+        return {worker.name: json.loads(worker.readline()) for worker in workers}
+
+    def test_every_worker_gets_every_workers_fixes(self):
+        workers = self.start(self.WORKERS)
+        self.assertEqual(sum(worker.is_broker for worker in workers), 1)
+        self.sync(workers)
+        names = sorted(worker.name for worker in workers)
+        self.assertEqual(self.round(workers, 1), {name: names for name in names})
+
+    def test_workers_take_over_when_the_broker_exits(self):
+        workers = self.start(self.WORKERS)
+        broker = next(worker for worker in workers if worker.is_broker)
+        broker.process.kill()
+        broker.process.wait()
+        survivors = [worker for worker in workers if worker is not broker]
+        self.sync(survivors)
+        names = sorted(worker.name for worker in survivors)
+        self.assertEqual(self.round(survivors, 2), {name: names for name in names})
+
+
+
+class UnixSocketPeerTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'gps.sock')
+        self.delivered = asyncio.Queue()
+        self.backend = UnixSocketBackend(self.path)
+        await self.backend.start(lambda ride_id, message: self.delivered.put_nowait((ride_id, message)))
+        self.addAsyncCleanup(self.backend.stop)
+
+    async def peer(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        self.addCleanup(writer.close)
+        return reader, writer
+
+    async def test_malformed_messages_are_skipped(self):
+        _, writer = await self.peer()
+        with self.assertLogs('fastapi_app.broadcast', 'ERROR') as logs:
+            writer.write(b'not json\n{"ride_id": 1}\n{"ride_id": 2, "message": {"lat": 6.5}}\n')
+            await writer.drain()
+            self.assertEqual(await asyncio.wait_for(self.delivered.get(), 5), (2, {'lat': 6.5}))
+        self.assertEqual(len(logs.records), 2)
+        await self.backend.publish(3, {'lat': 6.6})
+        self.assertEqual(await asyncio.wait_for(self.delivered.get(), 5), (3, {'lat': 6.6}))
+
+    async def test_a_worker_that_stops_reading_is_disconnected(self):
+        self.backend.broker.max_buffer = 64 * 1024
+        reader, _ = await self.peer()
+        while len(self.backend.broker.clients) < 2:
+            await asyncio.sleep(0.01)
+        message = {'padding': 'x' * 1000}
+        with self.assertLogs('fastapi_app.broadcast', 'WARNING'):
+            for _ in range(2000):
+                if len(self.backend.broker.clients) < 2:
+                    break
+                await self.backend.publish(1, message)
+                await self.delivered.get()
+        self.assertEqual(len(self.backend.broker.clients), 1)
+        # Everyone else still gets every fix.
+        await self.backend.publish(2, message)
+        self.assertEqual(await asyncio.wait_for(self.delivered.get(), 5), (2, message))
+
+
+if __name__ == '__main__':
+    unittest.main()
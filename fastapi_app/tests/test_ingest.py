@@ -0,0 +1,106 @@
+"""TrailWriter shutdown while a batch is being written, and which fixes reach the trail."""
+import asyncio
+import contextlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from fastapi_app.db import ConnectionPool, connect_sqlite
+from fastapi_app.ingest import DriverCheck, TrailWriter
+
+
+class Pool:
+    """Stands in for ``db.Pool``: one connection whose writes take a while, checked for misuse."""
+
+    vendor = 'sqlite'
+
+    def __init__(self):
+        self.checked_out = 0
+        self.writing = 0
+        self.written = 0
+        self.misused = []
+        self.started = threading.Event()
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        self.checked_out += 1
+        try:
+            yield self
+        finally:
+            self.checked_out -= 1
+
+    # The connection and its cursor.
+    def cursor(self):
+        return self
+
+    def executemany(self, sql, rows):
+        self.writing += 1
+        if self.writing > 1:
+            self.misused.append('concurrent writes')
+        self.started.set()
+        time.sleep(0.2)
+        if not self.checked_out:
+            self.misused.append('released during a write')
+        self.written += len(rows)
+        self.writing -= 1
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def fixes(count, ride_id=1):
+    return [{'ride_id': ride_id, 'lat': 6.5, 'lon': 3.4, 'heading': 0.0, 'speed': 0.0, 'timestamp': time.time()}
+            for _ in range(count)]
+
+
+class TrailWriterStopTests(unittest.IsolatedAsyncioTestCase):
+    async def test_stop_waits_for_the_batch_being_written(self):
+        pool = Pool()
+        writer = TrailWriter(pool, batch_size=10, interval=0.01)
+        writer.start()
+        writer.submit(fixes(10))
+        await asyncio.to_thread(pool.started.wait, 5)
+        writer.submit(fixes(5))
+        await writer.stop()
+        self.assertEqual(pool.misused, [])
+        self.assertEqual((pool.written, writer.flushed), (15, 15))
+
+
+
+class DriverCheckTests(unittest.IsolatedAsyncioTestCase):
+    """Rides 1 and 2 are driven by user 7, ride 3 by user 8."""
+
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'db.sqlite3')
+        with contextlib.closing(sqlite3.connect(path)) as conn:
+            conn.execute("CREATE TABLE core_ride (id INTEGER PRIMARY KEY, driver_id INTEGER)")
+            conn.executemany("INSERT INTO core_ride VALUES (?, ?)", [(1, 7), (2, 7), (3, 8)])
+            conn.commit()
+        self.pool = ConnectionPool(lambda: connect_sqlite(path), 'sqlite', '?', min_size=0, max_size=1)
+        await self.pool.open()
+        self.addAsyncCleanup(self.pool.close)
+
+    async def test_only_the_drivers_rides_pass(self):
+        check = DriverCheck(self.pool, '7')
+        batch = fixes(2, ride_id=1) + fixes(1, ride_id=3) + fixes(1, ride_id=2) + fixes(1, ride_id=99)
+        self.assertEqual([fix['ride_id'] for fix in await check.filter(batch)], [1, 1, 2])
+
+    async def test_each_ride_is_looked_up_once(self):
+        check = DriverCheck(self.pool, 8)
+        await check.filter(fixes(1, ride_id=3))
+        acquired = self.pool.metrics()['acquired_total']
+        self.assertEqual(len(await check.filter(fixes(3, ride_id=3) + fixes(1, ride_id=1))), 3)
+        self.assertEqual(len(await check.filter(fixes(1, ride_id=1))), 0)
+        self.assertEqual(self.pool.metrics()['acquired_total'] - acquired, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()